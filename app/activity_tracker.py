@@ -0,0 +1,91 @@
+import time
+from typing import Dict, Iterable, Optional
+from app.records import Record
+
+
+def fingerprint(records: Iterable[Record]) -> int:
+    """Hash of the records' stable fields: equal as long as the account did nothing."""
+    return hash(frozenset(record.stable_values() for record in records))
+
+
+class _Activity:
+    __slots__ = ("last_change", "factor", "fingerprint")
+
+    def __init__(self, last_change: float):
+        self.last_change = last_change
+        self.factor = 1.0
+        self.fingerprint: Optional[int] = None
+
+
+class ActivityTracker:
+    """
+    Tracks when each (account, fetch type) result last changed and derives a polling
+    interval multiplier from it: every unchanged fetch stretches the interval by `growth`
+    up to `max_factor`, every change shrinks it by `shrink` down to `min_factor`.
+    """
+
+    def __init__(self, min_factor: float = 0.5, max_factor: float = 10.0, growth: float = 1.5, shrink: float = 0.5):
+        self.min_factor = min_factor
+        self.max_factor = max_factor
+        self.growth = growth
+        self.shrink = shrink
+
+        # account_id -> fetch type -> activity
+        self._accounts: Dict[str, Dict[str, _Activity]] = {}
+
+    def record(self, account_id: str, fetch_type: str, changed: bool):
+        """Record whether the latest fetch result of `fetch_type` differed from the previous one."""
+        now = time.time()
+        activities = self._accounts.setdefault(account_id, {})
+        activity = activities.get(fetch_type)
+
+        if activity is None:
+            activities[fetch_type] = _Activity(now)
+            return
+
+        if changed:
+            activity.last_change = now
+            activity.factor = max(self.min_factor, activity.factor * self.shrink)
+        else:
+            activity.factor = min(self.max_factor, activity.factor * self.growth)
+
+    def observe(self, account_id: str, fetch_type: str, records: Iterable[Record]):
+        """
+        Record a fetch result, counting it as changed only when its stable fields differ
+        from the previous result's: mark prices and PnL move on every fetch of an account
+        with open positions, which would keep it at the fastest interval.
+        """
+        current = fingerprint(records)
+        activity = self._accounts.get(account_id, {}).get(fetch_type)
+        previous = activity.fingerprint if activity else None
+
+        self.record(account_id, fetch_type, changed=current != previous)
+        self._accounts[account_id][fetch_type].fingerprint = current
+
+    def interval_factor(self, account_id: str, fetch_types: Iterable[str]) -> float:
+        """Multiplier for the base interval of a task fetching `fetch_types`: the most active type wins."""
+        activities = self._accounts.get(account_id)
+        if not activities:
+            return 1.0
+
+        factors = [activities[t].factor for t in fetch_types if t in activities]
+        return min(factors) if factors else 1.0
+
+    def last_change(self, account_id: str, fetch_type: str) -> Optional[float]:
+        activity = self._accounts.get(account_id, {}).get(fetch_type)
+        return activity.last_change if activity else None
+
+    def forget(self, account_id: str):
+        self._accounts.pop(account_id, None)
+
+    def stats(self) -> Dict[str, float]:
+        factors = [a.factor for activities in self._accounts.values() for a in activities.values()]
+        return {
+            "tracked": len(factors),
+            "avg_interval_factor": round(sum(factors) / len(factors), 3) if factors else 1.0,
+            "at_floor": sum(1 for f in factors if f <= self.min_factor),
+            "at_ceiling": sum(1 for f in factors if f >= self.max_factor),
+        }
+
+
+activity_tracker = ActivityTracker()
@@ -0,0 +1,213 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+from app.ccxt.adapters import get_adapter
+from app.ccxt.base import BaseAdapter
+from app.utils.logging import get_logger
+
+logger = get_logger("adapter_pool")
+
+
+def credentials_fingerprint(exchange: str, credentials: Optional[dict]) -> str:
+    raw = json.dumps([exchange, credentials or {}], sort_keys=True)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class PooledAdapter:
+    __slots__ = ("account_id", "adapter", "fingerprint", "leases", "last_used", "retired")
+
+    def __init__(self, account_id: str, adapter: BaseAdapter, fingerprint: str):
+        self.account_id = account_id
+        self.adapter = adapter
+        self.fingerprint = fingerprint
+        self.leases = 0
+        self.last_used = time.monotonic()
+        self.retired = False
+
+
+class AdapterPool:
+    """
+    Keeps one initialized adapter per account and hands it out to fetch tasks and
+    websocket runners. Adapters are closed after `idle_ttl` seconds without a lease,
+    when the pool grows beyond `max_size` (least recently used first) or when the
+    account's credentials change.
+    """
+
+    def __init__(self, idle_ttl: float = 300.0, max_size: int = 5000, sweep_interval: float = 30.0):
+        self.idle_ttl = idle_ttl
+        self.max_size = max_size
+        self.sweep_interval = sweep_interval
+
+        # account_id -> PooledAdapter, ordered from least to most recently used
+        self._entries: "OrderedDict[str, PooledAdapter]" = OrderedDict()
+        self._build_locks: Dict[str, asyncio.Lock] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._rebuilds = 0
+        self._build_failures = 0
+        self._builds = 0
+        self._build_time_total = 0.0
+        self._build_time_max = 0.0
+
+    async def start(self):
+        if self._sweeper and not self._sweeper.done():
+            return
+        self._sweeper = asyncio.create_task(self._sweep_loop(), name="adapter-pool-sweeper")
+        logger.info(f"Adapter pool started (idle_ttl={self.idle_ttl}s, max_size={self.max_size})")
+
+    async def stop(self):
+        if self._sweeper:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+
+        entries = list(self._entries.values())
+        self._entries.clear()
+        self._build_locks.clear()
+        await asyncio.gather(*[self._close_entry(entry) for entry in entries], return_exceptions=True)
+        logger.info(f"Adapter pool stopped, closed {len(entries)} adapters")
+
+    @asynccontextmanager
+    async def lease(self, account_id: str, exchange: str, credentials: Optional[dict]) -> AsyncIterator[BaseAdapter]:
+        entry = await self._acquire(account_id, exchange, credentials)
+        try:
+            yield entry.adapter
+        finally:
+            entry.leases -= 1
+            entry.last_used = time.monotonic()
+            if entry.retired and entry.leases == 0:
+                await self._close_entry(entry)
+
+    async def invalidate(self, account_id: str):
+        entry = self._entries.pop(account_id, None)
+        if entry:
+            logger.info(f"Invalidated pooled adapter for account[{account_id}]")
+            await self._retire(entry)
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self._hits + self._misses
+        return {
+            "size": len(self._entries),
+            "leased": sum(1 for entry in self._entries.values() if entry.leases > 0),
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_rate": self._hits / lookups if lookups else 0.0,
+            "evictions": self._evictions,
+            "rebuilds": self._rebuilds,
+            "build_failures": self._build_failures,
+            "build_latency_avg_ms": (self._build_time_total / self._builds * 1000) if self._builds else 0.0,
+            "build_latency_max_ms": self._build_time_max * 1000,
+        }
+
+    def _checkout(self, entry: PooledAdapter) -> PooledAdapter:
+        entry.leases += 1
+        entry.last_used = time.monotonic()
+        self._entries.move_to_end(entry.account_id)
+        return entry
+
+    async def _acquire(self, account_id: str, exchange: str, credentials: Optional[dict]) -> PooledAdapter:
+        fingerprint = credentials_fingerprint(exchange, credentials)
+
+        entry = self._entries.get(account_id)
+        if entry and entry.fingerprint == fingerprint:
+            self._hits += 1
+            return self._checkout(entry)
+
+        lock = self._build_locks.setdefault(account_id, asyncio.Lock())
+        async with lock:
+            # Another task may have built the adapter while we were waiting
+            entry = self._entries.get(account_id)
+            if entry and entry.fingerprint == fingerprint:
+                self._hits += 1
+                return self._checkout(entry)
+
+            if entry:
+                logger.info(f"Credentials changed for account[{account_id}], rebuilding adapter")
+                self._rebuilds += 1
+                del self._entries[account_id]
+                await self._retire(entry)
+
+            self._misses += 1
+            entry = await self._build(account_id, exchange, credentials, fingerprint)
+            self._entries[account_id] = entry
+            self._checkout(entry)
+
+        await self._enforce_capacity()
+        return entry
+
+    async def _build(self, account_id: str, exchange: str, credentials: Optional[dict], fingerprint: str) -> PooledAdapter:
+        started = time.perf_counter()
+        adapter = await get_adapter(exchange, credentials)
+        try:
+            await adapter.__aenter__()
+        except Exception:
+            self._build_failures += 1
+            await adapter.__aexit__(None, None, None)
+            raise
+
+        elapsed = time.perf_counter() - started
+        self._builds += 1
+        self._build_time_total += elapsed
+        self._build_time_max = max(self._build_time_max, elapsed)
+        logger.info(f"Built {exchange} adapter for account[{account_id}] in {elapsed * 1000:.1f}ms")
+
+        return PooledAdapter(account_id, adapter, fingerprint)
+
+    async def _retire(self, entry: PooledAdapter):
+        # Leased adapters are closed by the last lease holder
+        entry.retired = True
+        if entry.leases == 0:
+            await self._close_entry(entry)
+
+    async def _close_entry(self, entry: PooledAdapter):
+        lock = self._build_locks.get(entry.account_id)
+        if entry.account_id not in self._entries and lock and not lock.locked():
+            del self._build_locks[entry.account_id]
+
+        try:
+            await entry.adapter.__aexit__(None, None, None)
+        except Exception as e:
+            logger.warning(f"Error closing adapter for account[{entry.account_id}]: {e}")
+
+    async def _enforce_capacity(self):
+        if len(self._entries) <= self.max_size:
+            return
+
+        for account_id, entry in list(self._entries.items()):
+            if len(self._entries) <= self.max_size:
+                break
+            if entry.leases > 0:
+                continue
+
+            del self._entries[account_id]
+            self._evictions += 1
+            await self._retire(entry)
+
+    async def _evict_idle(self):
+        deadline = time.monotonic() - self.idle_ttl
+        for account_id, entry in list(self._entries.items()):
+            if entry.leases > 0 or entry.last_used > deadline:
+                continue
+
+            del self._entries[account_id]
+            self._evictions += 1
+            logger.debug(f"Evicting idle adapter for account[{account_id}]")
+            await self._retire(entry)
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self._evict_idle()
+            except Exception as e:
+                logger.warning(f"Adapter pool sweep failed: {e}")
+
+
+adapter_pool = AdapterPool()
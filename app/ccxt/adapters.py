@@ -11,6 +11,6 @@ ADAPTERS = {
     "gateio": GateioAdapter,
 }
 
-async def get_adapter(exchange, credentials) -> BaseAdapter:
+async def get_adapter(exchange, credentials, include_info: bool = False) -> BaseAdapter:
     adapter_cls = ADAPTERS.get(exchange, BaseAdapter)
-    return adapter_cls(exchange, credentials)
+    return adapter_cls(exchange, credentials, include_info)
@@ -1,17 +1,89 @@
 import asyncio
-from typing import Dict, Any, List, Optional
+import json
+import time
+from contextvars import ContextVar
+from functools import partial
+from typing import Awaitable, Callable, Dict, Any, List, Optional, Tuple
+from ccxt.base.errors import DDoSProtection
 from ccxt.base.exchange import Exchange
-import ccxt.pro as ccxt
+from app.ccxt.connectors import connector_class
+from app.ccxt.market_cache import market_cache
+from app.ccxt.parsers import parse_balances, parse_funding_history, parse_positions
+from app.metrics import CCXT_ERRORS, CCXT_LATENCY
+from app.ccxt.rate_limiter import rate_limiter, RateLimit, PRIORITY_NORMAL, PRIORITY_LOW
+from app.records import BalanceRecord, EarnPositionRecord, FundingEventRecord, PositionRecord, Record
 from app.utils.logging import get_logger
 
 
 logger = get_logger("ccxt_adapter")
 
+# Fetch type -> adapter method returning its records
+FETCH_METHODS: Dict[str, str] = {
+    "balance": "fetch_balance",
+    "earn_balance": "fetch_earn_balance",
+    "positions": "fetch_positions",
+    "option_positions": "fetch_options_positions",
+    "funding_fees": "fetch_funding_fees",
+}
+
+# Funding events younger than this may not be listed yet
+FUNDING_SETTLE_MS = 60_000
+
+_current_plan: ContextVar[Optional["FetchPlan"]] = ContextVar("fetch_plan", default=None)
+
+
+class FetchPlan:
+    """
+    The fetch types of one task, run concurrently. Requests with the same connector, method
+    and arguments are sent once and their response is shared by every type that needs it.
+    """
+
+    def __init__(self, adapter: "BaseAdapter", fetch_types: List[str], arguments: Optional[Dict[str, dict]] = None):
+        self.adapter = adapter
+        self.fetch_types = [fetch_type for fetch_type in fetch_types if fetch_type in adapter.fetch_plan]
+        # fetch type -> keyword arguments of its adapter method
+        self.arguments = arguments or {}
+        self._requests: Dict[Tuple, asyncio.Future] = {}
+
+    def steps(self) -> Dict[str, Callable[[], Awaitable[Optional[List[Record]]]]]:
+        return {
+            fetch_type: partial(self._run, self._method(fetch_type))
+            for fetch_type in self.fetch_types
+        }
+
+    def _method(self, fetch_type: str) -> Callable[[], Awaitable[Optional[List[Record]]]]:
+        method = getattr(self.adapter, self.adapter.fetch_plan[fetch_type])
+        return partial(method, **self.arguments.get(fetch_type, {}))
+
+    async def _run(self, method):
+        token = _current_plan.set(self)
+        try:
+            return await method()
+        finally:
+            _current_plan.reset(token)
+
+    def shared(self, key: Tuple, send: Callable[[], Awaitable[Any]]) -> Awaitable[Any]:
+        request = self._requests.get(key)
+        if request is None:
+            request = self._requests[key] = asyncio.ensure_future(send())
+        # One fetch type being cancelled must not cancel the request for the others
+        return asyncio.shield(request)
+
+    def close(self):
+        for request in self._requests.values():
+            if not request.done():
+                request.cancel()
+            elif not request.cancelled():
+                request.exception()
+        self._requests.clear()
+
 
 class BaseAdapter:
-    def __init__(self, exchange_id: str, credentials: Optional[dict[str, str]] = None):
+    def __init__(self, exchange_id: str, credentials: Optional[dict[str, str]] = None, include_info: bool = False):
         self.exchange_id = exchange_id.lower()
         self.credentials = credentials or {}
+        # Keep the raw exchange payload on returned records
+        self.include_info = include_info
         self.exchanges: Dict[str, Exchange] = {}
         self.connectors = {
             "default": {
@@ -21,7 +93,36 @@ class BaseAdapter:
         }
         self.demo = False
         self.testnet = True
-        self.verbose = True
+        # ccxt logs every HTTP request and response when verbose
+        self.verbose = False
+
+        # Rate-limit budgets shared by all accounts of this exchange: weight class -> (capacity, seconds).
+        # A request's weight class defaults to the ccxt connector name it is sent through.
+        self.rate_limits: Dict[str, RateLimit] = {"default": (1200, 60)}
+        # Budget of a single API key, None when the exchange only limits by IP
+        self.api_key_rate_limit: Optional[RateLimit] = None
+        # "<connector>.<method>" or "<method>" -> (weight class, weight)
+        self.request_weights: Dict[str, Tuple[str, float]] = {}
+        # lower-cased response header -> (scope, kind), see RateLimitGovernor.observe()
+        self.rate_limit_headers: Dict[str, Tuple[str, str]] = {}
+        self.rate_limit_retries = 2
+        self.rate_limit_backoff = 30.0
+        # Funding history is fetched from the watermarks on in pages of `funding_page_size`, at most
+        # `funding_max_pages` per fetch; the rest follows on the next one. Exchanges that list
+        # the newest events first are paged backwards with `until`, and those that only serve a
+        # bounded time range per request are walked in windows of `funding_window` ms.
+        self.funding_page_size = 100
+        self.funding_max_pages = 10
+        self.funding_newest_first = False
+        self.funding_window: Optional[int] = None
+        # End of the last exhausted window of the latest fetch, where the next one may start
+        self.funding_cursor: Optional[int] = None
+        # Fetch types this adapter serves -> method producing them. Adapters drop the types their
+        # exchange has no API for, and serve several types from one request where the API allows.
+        self.fetch_plan: Dict[str, str] = dict(FETCH_METHODS)
+
+    def plan(self, fetch_types: List[str], arguments: Optional[Dict[str, dict]] = None) -> FetchPlan:
+        return FetchPlan(self, fetch_types, arguments)
 
     async def __aenter__(self):
         await self._init_exchanges()
@@ -31,6 +132,7 @@ class BaseAdapter:
         await self._close()
 
     async def _init_exchanges(self):
+        rate_limiter.configure(self.exchange_id, self.rate_limits, self.api_key_rate_limit)
         self.exchanges = await self.create_instances(self.credentials)
         logger.info(f"Initialized {self.exchange_id} with {list(self.exchanges.keys())}")
 
@@ -44,11 +146,11 @@ class BaseAdapter:
         for key, profile in self.connectors.items():
             name = profile.get("name")
             options = profile.get("options") or {}
-            connector_class = getattr(ccxt, name, None)
+            connector = connector_class(name)
 
-            if connector_class:
+            if connector:
                 try:
-                    ex_instance: Exchange = connector_class(params)
+                    ex_instance: Exchange = connector(params)
                     for option, value in options.items():
                         ex_instance.options[option] = value
 
@@ -61,6 +163,10 @@ class BaseAdapter:
                         ex_instance.enable_demo_trading(True)
 
                     ex_instance.verbose = self.verbose
+                    # watch_* return the full cached state instead of only the latest updates
+                    ex_instance.newUpdates = False
+
+                    await market_cache.attach(ex_instance, name, sandbox=self.testnet, demo=self.demo)
                 except Exception as e:
                     logger.error(f"Failed to initialize connector [{name}]. Error: {e}")
 
@@ -74,41 +180,94 @@ class BaseAdapter:
                 pass
         self.exchanges.clear()
 
-    async def fetch_balance(self, params={}) -> Dict[str, Any]:
+    def _request_weight(self, exchange: Exchange, method_name: str) -> Tuple[str, float]:
+        return (
+            self.request_weights.get(f"{exchange.id}.{method_name}")
+            or self.request_weights.get(method_name)
+            or (exchange.id, 1)
+        )
+
+    def _observe_call(self, method_name: str, started: float, error: Optional[Exception] = None):
+        CCXT_LATENCY.labels(self.exchange_id, method_name).observe(time.perf_counter() - started)
+        if error is not None:
+            CCXT_ERRORS.labels(self.exchange_id, method_name, type(error).__name__).inc()
+
+    async def _request(self, exchange: Exchange, method_name: str, *args, priority: int = PRIORITY_NORMAL, **kwargs):
+        """
+        Call a ccxt method once the shared rate-limit governor has budget for it. Within a
+        fetch plan, identical calls of the plan's fetch types share one request.
+        """
+        plan = _current_plan.get()
+        if plan is None:
+            return await self._send(exchange, method_name, *args, priority=priority, **kwargs)
+
+        key = (id(exchange), method_name, json.dumps([args, kwargs], sort_keys=True, default=str))
+        return await plan.shared(key, partial(self._send, exchange, method_name, *args, priority=priority, **kwargs))
+
+    async def _send(self, exchange: Exchange, method_name: str, *args, priority: int = PRIORITY_NORMAL, **kwargs):
+        method = getattr(exchange, method_name)
+        weight_class, weight = self._request_weight(exchange, method_name)
+        api_key = self.credentials.get("apiKey") or ""
+
+        attempt = 0
+        while True:
+            await rate_limiter.acquire(self.exchange_id, weight_class, api_key, weight, priority)
+            started = time.perf_counter()
+            try:
+                result = await method(*args, **kwargs)
+            except DDoSProtection as e:
+                self._observe_call(method_name, started, e)
+
+                # 418/429: stop everyone using this budget, then retry instead of failing the fetch
+                headers = exchange.last_response_headers or {}
+                retry_after = next((v for k, v in headers.items() if k.lower() == "retry-after"), None)
+                try:
+                    retry_after = float(retry_after)
+                except (TypeError, ValueError):
+                    retry_after = self.rate_limit_backoff
+
+                rate_limiter.penalize(self.exchange_id, weight_class, retry_after)
+                attempt += 1
+                if attempt > self.rate_limit_retries:
+                    raise
+                logger.warning("%s() rate limited on %s, retrying: %s", method_name, exchange.id, e)
+                continue
+            except Exception as e:
+                self._observe_call(method_name, started, e)
+                raise
+
+            self._observe_call(method_name, started)
+            rate_limiter.observe(self.exchange_id, weight_class, api_key, exchange.last_response_headers, self.rate_limit_headers)
+            return result
+
+    async def fetch_balance(self, params={}) -> Optional[List[BalanceRecord]]:
         exchange = self.exchanges.get("balance") or self.exchanges.get("default")
-        fetch_method = getattr(exchange, "fetch_balance")
+        fetch_method = getattr(exchange, "fetch_balance", None)
         if not fetch_method:
             logger.info(f"Exchange {self.exchange_id} does not have fetch_balance() method")
-            return []
+            return None
         
         try:
-            balances = await fetch_method(params=params)
-            if not balances:
-                return []
-
-            non_empty_balances = {
-                symbol: balance
-                for symbol, balance in balances.items()
-                if isinstance(balance, dict) and balance.get('total', 0) > 0
-            }
-
-            return non_empty_balances
+            balances = await self._request(exchange, "fetch_balance", params=params)
+            return parse_balances(balances, self.include_info)
 
         except Exception as e:
             logger.error(f"fetch_balance() error: {e}")
-            return []
+            return None
 
-    async def fetch_positions(self, params={}) -> List[Dict[str, Any]]:
+    async def fetch_positions(self, params={}) -> Optional[List[PositionRecord]]:
         positions = []
+        fetched = False
 
         # linear (default)
         exchange = self.exchanges.get("positions") or self.exchanges.get("default")
-        fetch_method = getattr(exchange, "fetch_positions")
+        fetch_method = getattr(exchange, "fetch_positions", None)
         if fetch_method:
             try:
-                logger.info("Fetching positions (linear)")
-                linear = await fetch_method(params=params)
-                positions.append(linear)
+                logger.debug("Fetching positions (linear)")
+                linear = await self._request(exchange, "fetch_positions", params=params)
+                positions.extend(parse_positions(linear, "linear", self.include_info))
+                fetched = True
             except Exception as e:
                 logger.error(f"fetch_positions() error: {e}")
         else:
@@ -117,74 +276,149 @@ class BaseAdapter:
         # inverse
         exchange = self.exchanges.get("positions-inverse")
         if exchange:
-            fetch_method = getattr(exchange, "fetch_positions")
+            fetch_method = getattr(exchange, "fetch_positions", None)
             if fetch_method:
                 try:
-                    logger.info("Fetching positions (inverse)")
-                    inverse = await fetch_method(params=params)
-                    positions.append(inverse)
+                    logger.debug("Fetching positions (inverse)")
+                    inverse = await self._request(exchange, "fetch_positions", params=params)
+                    positions.extend(parse_positions(inverse, "inverse", self.include_info))
+                    fetched = True
                 except Exception as e:
                     logger.error(f"fetch_positions() error: {e}")
 
             else:
                 logger.info(f"Exchange {exchange} does not have fetch_positions() method")
     
-        return positions
+        return positions if fetched else None
 
-    async def fetch_options_positions(self, params={}) -> List[Dict[str, Any]]:
+    async def fetch_options_positions(self, params={}) -> Optional[List[PositionRecord]]:
         exchange = self.exchanges.get("options") or self.exchanges.get("default")
-        fetch_method = getattr(exchange, "fetch_option_positions")
+        fetch_method = getattr(exchange, "fetch_option_positions", None)
         if not fetch_method:
             logger.info(f"Exchange {self.exchange_id} does not have fetch_option_positions() method")
-            return []
+            return None
         
         try:
-            return [await fetch_method(params=params)]
+            positions = await self._request(exchange, "fetch_option_positions", params=params)
+            return parse_positions(positions, "option", self.include_info)
         except Exception as e:
             logger.error(f"fetch_options_balance() error: {e}")
-            return []
+            return None
 
-    async def fetch_earn_balance(self) -> List[Dict[str, Any]]:
+    async def fetch_earn_balance(self) -> Optional[List[EarnPositionRecord]]:
         logger.error("fetch_earn_balance() not implemented")
-        return []
+        return None
 
-    async def fetch_funding_fees(self) -> List[Dict[str, Any]]:
+    async def _fetch_funding_history(self, exchange: Exchange, since: Optional[Dict[str, int]], params: Optional[dict] = None) -> List[Dict[str, Any]]:
+        """
+        fetch_funding_history() from the newest watermark on. One call covers every currency,
+        so everything before the newest watermark has been fetched already; the per-currency
+        watermarks only drop the repeated events. With `funding_window` set, the time after
+        the watermark is walked in windows of that length, moving on when one is exhausted,
+        and `funding_cursor` is left at the end of the last exhausted window. Without
+        watermarks only the latest page is fetched.
+        """
+        params = params or {}
+        self.funding_cursor = None
+        if not since:
+            return await self._request(exchange, "fetch_funding_history", None, None, None, params=params, priority=PRIORITY_LOW)
+
+        start = max(since.values())
+        # Events of the last minute may not be listed yet, so windows are not closed past it
+        now = int(time.time() * 1000) - FUNDING_SETTLE_MS
+        entries: List[Dict[str, Any]] = []
+        budget = [self.funding_max_pages]
+        while budget[0] > 0:
+            end = min(start + self.funding_window, now) if self.funding_window and start < now else None
+            window, complete = await self._fetch_funding_window(exchange, start, end, params, budget)
+            if not complete and self.funding_newest_first:
+                # Pages of a newest-first window that stop short of its start leave a gap behind
+                # the events they return; only a window that exceeds the whole budget is kept
+                if entries:
+                    break
+                logger.warning(f"Funding history of {self.exchange_id} exceeds {self.funding_max_pages} pages per window, older events skipped")
+            entries.extend(window)
+            if not complete or end is None or end >= now:
+                break
+            self.funding_cursor = start = end
+        return entries
+
+    async def _fetch_funding_window(
+        self, exchange: Exchange, start: int, end: Optional[int], params: dict, budget: List[int]
+    ) -> Tuple[List[Dict[str, Any]], bool]:
+        """Pages of one window from `start` to `end` in the exchange's order; True when the window was exhausted."""
+        entries: List[Dict[str, Any]] = []
+        lower, upper = start, end
+        while budget[0] > 0:
+            budget[0] -= 1
+            window_params = {**params, "until": upper} if upper is not None else params
+            page = await self._request(
+                exchange, "fetch_funding_history", None, lower, self.funding_page_size, params=window_params, priority=PRIORITY_LOW
+            )
+            entries.extend(page)
+            if len(page) < self.funding_page_size:
+                return entries, True
+
+            # Bounds are inclusive: the events at the page's edge come again and are dropped by the watermarks
+            timestamps = [entry.get("timestamp") or 0 for entry in page]
+            if self.funding_newest_first:
+                oldest = min(timestamps)
+                if oldest <= lower or (upper is not None and oldest >= upper):
+                    return entries, True
+                upper = oldest
+            else:
+                newest = max(timestamps)
+                if newest <= lower:
+                    return entries, True
+                lower = newest
+        return entries, False
+
+    async def fetch_funding_fees(self, since: Optional[Dict[str, int]] = None) -> Optional[List[FundingEventRecord]]:
+        """Funding events from `since` (currency -> timestamp in ms) on."""
         exchange = self.exchanges.get("funding_fees") or self.exchanges.get("default")
-        fetch_method = getattr(exchange, "fetch_funding_history")
+        fetch_method = getattr(exchange, "fetch_funding_history", None)
 
         if not fetch_method:
             logger.info(f"Exchange {self.exchange_id} does not have fetch_funding_history() method")
-            return []
+            return None
         
         try:
-            return [await fetch_method()]
+            history = await self._fetch_funding_history(exchange, since)
+            return parse_funding_history(history, self.include_info)
         except Exception as e:
             logger.error(f"fetch_funding_fees() error: {e}")
-            return []
+            return None
 
-    async def watch_balance(self):
+    async def watch_balance(self) -> List[BalanceRecord]:
         exchange = self.exchanges.get("balance") or self.exchanges.get("default")
         watch_method = getattr(exchange, "watch_balance")
-        return await watch_method()
+        return parse_balances(await watch_method(), self.include_info)
     
-    async def watch_positions(self):
+    async def watch_positions(self) -> Optional[List[PositionRecord]]:
         exchange: Exchange = self.exchanges.get("positions") or self.exchanges.get("default")        
         exchange_inverse: Exchange = self.exchanges.get("positions-inverse")
         
-        if exchange_inverse and getattr(exchange_inverse, "watch_positions"):
-            done, pending = await asyncio.wait(
-                [
-                    asyncio.create_task(exchange.watch_positions()),
-                    asyncio.create_task(exchange_inverse.watch_positions())
-                ],
-                return_when=asyncio.FIRST_COMPLETED,
-            )
+        if exchange_inverse and getattr(exchange_inverse, "watch_positions", None):
+            tasks = {
+                asyncio.create_task(exchange.watch_positions()): ("linear", exchange),
+                asyncio.create_task(exchange_inverse.watch_positions()): ("inverse", exchange_inverse),
+            }
+            try:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
 
-            for result in done:
-                return await result
+            # Report both books: the connector that did not update contributes its cached positions
+            records = []
+            for task, (contract_type, connector) in tasks.items():
+                positions = task.result() if task in done else list(getattr(connector, "positions", None) or [])
+                records.extend(parse_positions(positions, contract_type, self.include_info))
+            return records
         else:
-            if not getattr(exchange, "watch_positions"):
+            if not getattr(exchange, "watch_positions", None):
                 logger.info(f"Exchange {self.exchange_id} does not have watch_positions() method")
                 return None
             
-            return await exchange.watch_positions()
+            return parse_positions(await exchange.watch_positions(), "linear", self.include_info)
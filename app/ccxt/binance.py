@@ -1,13 +1,17 @@
-from typing import Dict, Any, List, Optional
+import asyncio
+from typing import List, Optional
 import ccxt.async_support as ccxt
 from app.ccxt.base import BaseAdapter
+from app.ccxt.parsers import parse_binance_simple_earn
+from app.ccxt.rate_limiter import PRIORITY_LOW, SCOPE_CLASS, KIND_USED
+from app.records import EarnPositionRecord
 from app.utils.logging import get_logger
 
 logger = get_logger("ccxt_binance_adapter")
 
 class BinanceAdapter(BaseAdapter):
-    def __init__(self, exchange_id: str, credentials: Optional[dict[str, str]] = None):
-        super().__init__(exchange_id, credentials)
+    def __init__(self, exchange_id: str, credentials: Optional[dict[str, str]] = None, include_info: bool = False):
+        super().__init__(exchange_id, credentials, include_info)
         self.testnet = False
         self.demo = True
         self.connectors = {
@@ -40,13 +44,44 @@ class BinanceAdapter(BaseAdapter):
             }
         }
 
-    async def fetch_earn_balance(self) -> List[Dict[str, Any]]:
+        # IP weight budgets per API family
+        # https://developers.binance.com/docs/binance-spot-api-docs/rest-api/limits
+        self.rate_limits = {
+            "binance": (6000, 60),
+            "binanceusdm": (2400, 60),
+            "binancecoinm": (2400, 60),
+            "sapi": (12000, 60),
+        }
+        self.request_weights = {
+            "binance.fetch_balance": ("binance", 20),
+            "binanceusdm.fetch_balance": ("binanceusdm", 5),
+            "binanceusdm.fetch_positions": ("binanceusdm", 5),
+            "binancecoinm.fetch_positions": ("binancecoinm", 1),
+            "fetch_funding_history": ("binanceusdm", 30),
+            "sapi_get_simple_earn_flexible_position": ("sapi", 150),
+            "sapi_get_simple_earn_locked_position": ("sapi", 150),
+        }
+        self.rate_limit_headers = {
+            "x-mbx-used-weight-1m": (SCOPE_CLASS, KIND_USED),
+            "x-sapi-used-ip-weight-1m": (SCOPE_CLASS, KIND_USED),
+        }
+        # No options connector
+        del self.fetch_plan["option_positions"]
+        # /fapi/v1/income returns up to 1000 rows
+        self.funding_page_size = 1000
+
+    async def fetch_earn_balance(self) -> Optional[List[EarnPositionRecord]]:
         exchange: ccxt.binance = self.exchanges.get("default")
         try:
-            flexible = await exchange.sapi_get_simple_earn_flexible_position()
-            locked = await exchange.sapi_get_simple_earn_locked_position()
+            flexible, locked = await asyncio.gather(
+                self._request(exchange, "sapi_get_simple_earn_flexible_position", priority=PRIORITY_LOW),
+                self._request(exchange, "sapi_get_simple_earn_locked_position", priority=PRIORITY_LOW),
+            )
 
-            return [flexible, locked]
+            return (
+                parse_binance_simple_earn(flexible, "flexible", self.include_info)
+                + parse_binance_simple_earn(locked, "locked", self.include_info)
+            )
         except Exception as e:
             logger.error(f"fetch_earn_balance() error: {e}")
             return None
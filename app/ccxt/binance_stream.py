@@ -0,0 +1,493 @@
+import asyncio
+import itertools
+import json
+import time
+from contextlib import AsyncExitStack
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+import websockets
+from app.ccxt.adapter_pool import adapter_pool
+from app.ccxt.base import BaseAdapter
+from app.records import BalanceRecord, PositionRecord, to_float
+from app.stream_health import stream_health
+from app.utils.backoff import Backoff
+from app.utils.logging import get_logger
+from app.ws_sessions import HEALTH_TTL, STALE_AFTER, StreamSession, UpdateCallback
+
+logger = get_logger("binance_stream")
+
+# market -> (adapter connector, ccxt ws url key, create listenKey method, keepalive method, close method)
+USER_STREAMS = {
+    "spot": ("default", "spot", "public_post_userdatastream", "public_put_userdatastream", "public_delete_userdatastream"),
+    "usdm": ("positions", "future", "fapiprivate_post_listenkey", "fapiprivate_put_listenkey", "fapiprivate_delete_listenkey"),
+    "coinm": ("positions-inverse", "delivery", "dapiprivate_post_listenkey", "dapiprivate_put_listenkey", "dapiprivate_delete_listenkey"),
+}
+
+CONTRACT_TYPES = {"usdm": "linear", "coinm": "inverse"}
+
+# market -> stream type it feeds
+STREAM_TYPES = {"spot": "balance", "usdm": "positions", "coinm": "positions"}
+
+LISTEN_KEY_KEEPALIVE = 30 * 60
+
+# Binance allows 5 incoming messages per second per connection
+MESSAGE_INTERVAL = 0.25
+# listenKeys per SUBSCRIBE / UNSUBSCRIBE message
+SUBSCRIBE_BATCH = 100
+
+
+class CombinedStream:
+    """
+    One Binance combined-stream socket carrying the user data streams of many listenKeys.
+    Keys are added and removed with SUBSCRIBE/UNSUBSCRIBE on the live connection and are
+    re-subscribed after a reconnect, followed by `on_reconnect` so the owner can fill the gap.
+    Subscription changes are queued and sent in batches by a flusher that keeps to the
+    connection's message rate, so callers never wait on it.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        name: str,
+        on_message: Callable[[Dict[str, Any]], Awaitable[None]],
+        on_reconnect: Callable[[], Awaitable[None]],
+        on_state: Callable[[], None],
+    ):
+        self.url = url
+        self.name = name
+        self.on_message = on_message
+        self.on_reconnect = on_reconnect
+        self.on_state = on_state
+        self.reconnects = 0
+        self.listen_keys: Set[str] = set()
+        self._ws = None
+        self._ids = itertools.count(1)
+        # listenKey -> SUBSCRIBE / UNSUBSCRIBE not sent yet, the latest change wins
+        self._pending: Dict[str, str] = {}
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def connected(self) -> bool:
+        return self._ws is not None
+
+    def start(self):
+        if not self._task or self._task.done():
+            self._task = asyncio.create_task(self._run(), name=f"binance-stream-{self.name}")
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def subscribe(self, listen_key: str):
+        self.listen_keys.add(listen_key)
+        self._pending[listen_key] = "SUBSCRIBE"
+        self._wake.set()
+
+    def unsubscribe(self, listen_key: str):
+        self.listen_keys.discard(listen_key)
+        self._pending[listen_key] = "UNSUBSCRIBE"
+        self._wake.set()
+
+    async def _flush_loop(self, ws):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+
+            while self._pending:
+                pending, self._pending = self._pending, {}
+                for method in ("UNSUBSCRIBE", "SUBSCRIBE"):
+                    keys = [key for key, change in pending.items() if change == method]
+                    for i in range(0, len(keys), SUBSCRIBE_BATCH):
+                        await ws.send(json.dumps({"method": method, "params": keys[i:i + SUBSCRIBE_BATCH], "id": next(self._ids)}))
+                        await asyncio.sleep(MESSAGE_INTERVAL)
+
+    async def _run(self):
+        backoff = Backoff()
+        connected_before = False
+        resync: Optional[asyncio.Task] = None
+
+        try:
+            while True:
+                flusher: Optional[asyncio.Task] = None
+                try:
+                    async with websockets.connect(self.url, max_size=None) as ws:
+                        self._ws = ws
+                        logger.info(f"{self.name}: connected, subscribing {len(self.listen_keys)} listenKeys")
+
+                        # A new connection has no subscriptions: send all current keys
+                        self._pending = {key: "SUBSCRIBE" for key in self.listen_keys}
+                        self._wake.set()
+                        flusher = asyncio.create_task(self._flush_loop(ws), name=f"binance-stream-{self.name}-flush")
+
+                        if connected_before:
+                            self.reconnects += 1
+                            resync = asyncio.create_task(self.on_reconnect())
+                        connected_before = True
+                        backoff.reset()
+                        self.on_state()
+
+                        async for raw in ws:
+                            await self.on_message(json.loads(raw))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"{self.name}: connection error: {e}")
+                finally:
+                    if flusher:
+                        flusher.cancel()
+                        await asyncio.gather(flusher, return_exceptions=True)
+                    if self._ws is not None:
+                        self._ws = None
+                        self.on_state()
+
+                delay = await backoff.sleep()
+                logger.info(f"{self.name}: reconnecting after {delay:.1f}s")
+        finally:
+            if resync:
+                resync.cancel()
+
+
+class _BinanceAccount:
+    __slots__ = ("adapter", "stack", "listen_keys", "balances", "positions", "updated_at")
+
+    def __init__(self, adapter: BaseAdapter, stack: AsyncExitStack):
+        self.adapter = adapter
+        self.stack = stack
+        # market -> listenKey
+        self.listen_keys: Dict[str, str] = {}
+        # currency -> (free, locked)
+        self.balances: Dict[str, Tuple[float, float]] = {}
+        # (market, unified symbol, side) -> position
+        self.positions: Dict[Tuple[str, str, str], PositionRecord] = {}
+        # stream type -> monotonic time of the last event or REST refresh
+        self.updated_at: Dict[str, float] = {}
+
+
+class BinanceUserStreamSession(StreamSession):
+    """
+    Fans the user data streams of many Binance accounts into one combined-stream socket per
+    market (spot, USDⓈ-M, COIN-M). Events are routed back to their account by listenKey.
+    An account stream without events for `STALE_AFTER` seconds is re-read over REST, like
+    the per-account ccxt sessions do.
+    """
+
+    capacity = 200
+
+    def __init__(self, exchange: str, name: str, on_update: UpdateCallback):
+        super().__init__(exchange, name, on_update)
+        self._accounts: Dict[str, _BinanceAccount] = {}
+        self._streams: Dict[str, CombinedStream] = {}
+        # listenKey -> (account_id, market)
+        self._key_owners: Dict[str, Tuple[str, str]] = {}
+        self._keepalive: Optional[asyncio.Task] = None
+        self._stale_checker: Optional[asyncio.Task] = None
+        self._renewals: Set[asyncio.Task] = set()
+
+    async def add_account(self, account_id: str, credentials: dict):
+        stack = AsyncExitStack()
+        try:
+            adapter = await stack.enter_async_context(adapter_pool.lease(account_id, self.exchange, credentials))
+            account = _BinanceAccount(adapter, stack)
+
+            markets = [
+                (market, connector, ws_key, create_method)
+                for market, (connector_key, ws_key, create_method, _, _) in USER_STREAMS.items()
+                if (connector := adapter.exchanges.get(connector_key))
+            ]
+            responses = await asyncio.gather(*(adapter._request(connector, create_method) for _, connector, _, create_method in markets))
+
+            for (market, connector, ws_key, _), response in zip(markets, responses):
+                listen_key = response["listenKey"]
+                account.listen_keys[market] = listen_key
+                self._key_owners[listen_key] = (account_id, market)
+                self._stream(market, connector.urls["api"]["ws"][ws_key]).subscribe(listen_key)
+        except BaseException:
+            for listen_key, (owner, market) in list(self._key_owners.items()):
+                if owner == account_id:
+                    del self._key_owners[listen_key]
+                    if market in self._streams:
+                        self._streams[market].unsubscribe(listen_key)
+            await stack.aclose()
+            raise
+
+        self.accounts[account_id] = credentials
+        self._accounts[account_id] = account
+
+        if not self._keepalive or self._keepalive.done():
+            self._keepalive = asyncio.create_task(self._keepalive_loop(), name=f"{self.name}-keepalive")
+        if not self._stale_checker or self._stale_checker.done():
+            self._stale_checker = asyncio.create_task(self._stale_loop(), name=f"{self.name}-stale-check")
+
+        await self._seed(account_id, account)
+        self._account_health(account_id, account)
+
+    async def remove_account(self, account_id: str):
+        self.accounts.pop(account_id, None)
+        account = self._accounts.pop(account_id, None)
+        if not account:
+            return
+
+        stream_health.forget(account_id)
+
+        for market, listen_key in account.listen_keys.items():
+            self._key_owners.pop(listen_key, None)
+            stream = self._streams.get(market)
+            if stream:
+                stream.unsubscribe(listen_key)
+
+            connector_key, _, _, _, close_method = USER_STREAMS[market]
+            try:
+                await account.adapter._request(account.adapter.exchanges[connector_key], close_method, params={"listenKey": listen_key})
+            except Exception as e:
+                logger.debug(f"Failed to close listenKey for account[{account_id}]: {e}")
+
+        await account.stack.aclose()
+
+    async def close(self):
+        await super().close()
+
+        for task in (self._keepalive, self._stale_checker):
+            if task:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+        for renewal in list(self._renewals):
+            renewal.cancel()
+        await asyncio.gather(*self._renewals, return_exceptions=True)
+
+        for stream in self._streams.values():
+            await stream.close()
+        self._streams.clear()
+
+    def _stream(self, market: str, ws_url: str) -> CombinedStream:
+        stream = self._streams.get(market)
+        if not stream:
+            url = ws_url[:-len("/ws")] + "/stream" if ws_url.endswith("/ws") else ws_url
+            stream = CombinedStream(
+                url,
+                f"{self.name}-{market}",
+                lambda msg, market=market: self._on_message(market, msg),
+                lambda market=market: self._resync(market),
+                lambda market=market: self._update_health(market),
+            )
+            self._streams[market] = stream
+            stream.start()
+        return stream
+
+    async def _seed(self, account_id: str, account: _BinanceAccount):
+        """User data streams only carry changes, so start from a REST snapshot."""
+        balances = await account.adapter.fetch_balance()
+        if balances is not None:
+            account.balances = {record.currency: (record.free, record.used) for record in balances}
+            await self._emit_balances(account_id, account)
+
+        positions = await account.adapter.fetch_positions()
+        if positions is not None:
+            account.positions = {
+                ("usdm" if record.contract_type == "linear" else "coinm", record.symbol, record.side or ""): record
+                for record in positions
+            }
+            await self._emit_positions(account_id, account)
+
+        now = time.monotonic()
+        for stream_type in STREAM_TYPES.values():
+            account.updated_at[stream_type] = now
+
+    def _account_health(self, account_id: str, account: _BinanceAccount):
+        """A stream type is healthy while every socket feeding it for this account is connected."""
+        for stream_type in set(STREAM_TYPES[market] for market in account.listen_keys):
+            markets = [market for market in account.listen_keys if STREAM_TYPES[market] == stream_type]
+            if self._connected(markets):
+                stream_health.mark_up(account_id, stream_type, HEALTH_TTL)
+            else:
+                stream_health.mark_down(account_id, stream_type)
+
+    def _connected(self, markets: List[str]) -> bool:
+        return all(market in self._streams and self._streams[market].connected for market in markets)
+
+    def _update_health(self, market: str):
+        for account_id, account in list(self._accounts.items()):
+            if market in account.listen_keys:
+                self._account_health(account_id, account)
+
+    async def _resync(self, market: str):
+        """Events sent while the socket was down are lost; re-read the affected state over REST."""
+        for account_id, account in list(self._accounts.items()):
+            if market in account.listen_keys:
+                await self._gap_fill(account_id, account, STREAM_TYPES[market], [market])
+
+    async def _gap_fill(self, account_id: str, account: _BinanceAccount, stream_type: str, markets: List[str]):
+        """One-off REST fetch of a stream type, replacing the state of `markets`."""
+        try:
+            if stream_type == "balance":
+                balances = await account.adapter.fetch_balance()
+                if balances is None or account_id not in self._accounts:
+                    return
+                account.balances = {record.currency: (record.free, record.used) for record in balances}
+            else:
+                positions = await account.adapter.fetch_positions()
+                if positions is None or account_id not in self._accounts:
+                    return
+                account.positions = {key: record for key, record in account.positions.items() if key[0] not in markets}
+                account.positions.update({
+                    (market, record.symbol, record.side or ""): record
+                    for market in markets
+                    for record in positions
+                    if record.contract_type == CONTRACT_TYPES[market]
+                })
+        except Exception as e:
+            logger.error(f"Gap fill ({stream_type}) failed for {self.exchange}:{account_id}: {e}")
+            return
+
+        account.updated_at[stream_type] = time.monotonic()
+        self.gap_fills += 1
+        if stream_type == "balance":
+            await self._emit_balances(account_id, account)
+        else:
+            await self._emit_positions(account_id, account)
+
+    async def _refresh_stale(self, account_id: str, account: _BinanceAccount, stream_type: str, markets: List[str]):
+        logger.warning(f"No {stream_type} updates for {self.exchange}:{account_id} in {STALE_AFTER:.0f}s, refreshing over REST")
+        self.stale += 1
+        # Checked again after another STALE_AFTER, also when the refresh fails
+        account.updated_at[stream_type] = time.monotonic()
+        # The sockets are connected, so the silence is a quiet account rather than a dead stream
+        stream_health.mark_up(account_id, stream_type, HEALTH_TTL)
+        await self._gap_fill(account_id, account, stream_type, markets)
+
+    async def _stale_loop(self):
+        while True:
+            await asyncio.sleep(STALE_AFTER / 4)
+
+            now = time.monotonic()
+            refreshes = []
+            for account_id, account in list(self._accounts.items()):
+                for stream_type in set(STREAM_TYPES[market] for market in account.listen_keys):
+                    markets = [market for market in account.listen_keys if STREAM_TYPES[market] == stream_type]
+                    # Disconnected sockets resync on their own after reconnecting
+                    if now - account.updated_at.get(stream_type, now) < STALE_AFTER or not self._connected(markets):
+                        continue
+                    refreshes.append(self._refresh_stale(account_id, account, stream_type, markets))
+
+            if refreshes:
+                await asyncio.gather(*refreshes, return_exceptions=True)
+
+    async def _emit_balances(self, account_id: str, account: _BinanceAccount):
+        records = [
+            BalanceRecord(currency, free, locked, free + locked)
+            for currency, (free, locked) in account.balances.items()
+            if free + locked > 0
+        ]
+        await self.on_update(account_id, self.exchange, "balance", records)
+
+    async def _emit_positions(self, account_id: str, account: _BinanceAccount):
+        await self.on_update(account_id, self.exchange, "positions", list(account.positions.values()))
+
+    async def _on_message(self, market: str, message: Dict[str, Any]):
+        owner = self._key_owners.get(message.get("stream"))
+        data = message.get("data")
+        if not owner or not isinstance(data, dict):
+            return
+
+        account_id, _ = owner
+        account = self._accounts.get(account_id)
+        if not account:
+            return
+
+        event = data.get("e")
+        try:
+            if event == "outboundAccountPosition":
+                for balance in data.get("B") or []:
+                    account.balances[balance["a"]] = (to_float(balance.get("f")), to_float(balance.get("l")))
+                self._touch(account_id, account, "balance")
+                await self._emit_balances(account_id, account)
+
+            elif event == "ACCOUNT_UPDATE":
+                self._apply_positions(market, account, (data.get("a") or {}).get("P") or [])
+                self._touch(account_id, account, "positions")
+                await self._emit_positions(account_id, account)
+
+            elif event == "listenKeyExpired":
+                logger.warning(f"listenKey expired for account[{account_id}] ({market}), renewing")
+                renewal = asyncio.create_task(self._renew_listen_key(account_id, market))
+                self._renewals.add(renewal)
+                renewal.add_done_callback(self._renewals.discard)
+        except Exception as e:
+            logger.error(f"Failed to handle {event} for account[{account_id}]: {e}")
+
+    def _touch(self, account_id: str, account: _BinanceAccount, stream_type: str):
+        account.updated_at[stream_type] = time.monotonic()
+        if self._connected([market for market in account.listen_keys if STREAM_TYPES[market] == stream_type]):
+            stream_health.mark_up(account_id, stream_type, HEALTH_TTL)
+
+    def _apply_positions(self, market: str, account: _BinanceAccount, updates: list):
+        connector = account.adapter.exchanges.get(USER_STREAMS[market][0])
+        for update in updates:
+            market_id = update.get("s")
+            position_side = update.get("ps") or "BOTH"
+            amount = to_float(update.get("pa"))
+            symbol = connector.safe_symbol(market_id) if connector else market_id
+
+            if position_side == "BOTH":
+                # one-way mode: the side follows the sign of the amount and may flip
+                account.positions.pop((market, symbol, "long"), None)
+                account.positions.pop((market, symbol, "short"), None)
+                side = "long" if amount > 0 else "short"
+            else:
+                side = position_side.lower()
+                account.positions.pop((market, symbol, side), None)
+
+            if not amount:
+                continue
+
+            account.positions[(market, symbol, side)] = PositionRecord(
+                symbol,
+                side,
+                CONTRACT_TYPES[market],
+                abs(amount),
+                entry_price=to_float(update.get("ep"), None),
+                unrealized_pnl=to_float(update.get("up"), None),
+                margin_mode=update.get("mt"),
+            )
+
+    async def _renew_listen_key(self, account_id: str, market: str):
+        account = self._accounts.get(account_id)
+        if not account:
+            return
+
+        connector_key, _, create_method, _, _ = USER_STREAMS[market]
+        stream = self._streams.get(market)
+        old_key = account.listen_keys.get(market)
+        try:
+            response = await account.adapter._request(account.adapter.exchanges[connector_key], create_method)
+        except Exception as e:
+            logger.error(f"Failed to renew listenKey for account[{account_id}] ({market}): {e}")
+            return
+
+        new_key = response["listenKey"]
+        if new_key == old_key:
+            return
+
+        account.listen_keys[market] = new_key
+        self._key_owners.pop(old_key, None)
+        self._key_owners[new_key] = (account_id, market)
+        if stream:
+            stream.unsubscribe(old_key)
+            stream.subscribe(new_key)
+
+    async def _keepalive_loop(self):
+        while True:
+            await asyncio.sleep(LISTEN_KEY_KEEPALIVE)
+
+            for account_id, account in list(self._accounts.items()):
+                for market, listen_key in list(account.listen_keys.items()):
+                    connector_key, _, _, keepalive_method, _ = USER_STREAMS[market]
+                    try:
+                        await account.adapter._request(
+                            account.adapter.exchanges[connector_key], keepalive_method, params={"listenKey": listen_key}
+                        )
+                    except Exception as e:
+                        logger.warning(f"listenKey keepalive failed for account[{account_id}] ({market}): {e}")
+                        await self._renew_listen_key(account_id, market)
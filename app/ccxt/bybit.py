@@ -1,7 +1,10 @@
-from typing import Dict, Any, List, Optional
+from typing import List, Optional
 import asyncio
 import ccxt.pro as ccxt
 from app.ccxt.base import BaseAdapter
+from app.ccxt.parsers import parse_bybit_earn, parse_positions
+from app.ccxt.rate_limiter import PRIORITY_LOW, SCOPE_KEY, KIND_REMAINING
+from app.records import EarnPositionRecord, PositionRecord
 from app.utils.logging import get_logger
 
 
@@ -9,36 +12,42 @@ logger = get_logger("ccxt_bybit_adapter")
 
 
 class BybitAdapter(BaseAdapter):
-    def __init__(self, exchange_id: str, credentials: Optional[dict[str, str]] = None):
-        super().__init__(exchange_id, credentials)
-    
-    async def fetch_earn_balance(self) -> List[Dict[str, Any]]:
-        exchange: ccxt.bybit = self.exchanges.get("default")
-        try:
-            responses = await asyncio.gather(
-                exchange.private_get_v5_earn_position(params={"category": "FlexibleSaving"}),
-                exchange.private_get_v5_earn_position(params={"category": "OnChain"}),
-                return_exceptions=True
-            )
-
-            earn_positions: List[Dict[str, Any]] = []
-            for response in responses:
-                result = response["result"]
-                if not result:
-                    logger.info("No result")
-                    continue
-                
-                positions = result["list"]
-                if not isinstance(positions, list):
-                    logger.info("No list")
-                    continue
-
-                if len(positions) == 0:
-                    logger.info("Empty list")
-                    continue
-                
-                earn_positions.extend(list)
+    def __init__(self, exchange_id: str, credentials: Optional[dict[str, str]] = None, include_info: bool = False):
+        super().__init__(exchange_id, credentials, include_info)
+        # https://bybit-exchange.github.io/docs/v5/rate-limit
+        self.rate_limits = {"default": (600, 5)}
+        self.api_key_rate_limit = (10, 1)
+        self.rate_limit_headers = {
+            "x-bapi-limit-status": (SCOPE_KEY, KIND_REMAINING),
+        }
+        # /v5/execution/list lists the newest first and serves at most 7 days per request
+        self.funding_newest_first = True
+        self.funding_window = 7 * 24 * 3600 * 1000
 
+    async def fetch_options_positions(self, params={}) -> Optional[List[PositionRecord]]:
+        # ccxt has no fetch_option_positions() for Bybit, options are a fetch_positions() category
+        exchange: ccxt.bybit = self.exchanges.get("options") or self.exchanges.get("default")
+        try:
+            positions = await self._request(exchange, "fetch_positions", params={**params, "type": "option"})
+            return parse_positions(positions, "option", self.include_info)
         except Exception as e:
-            logger.error(f"fetch_earn_balance() error: {e}")
-            return []
+            logger.error(f"fetch_options_positions() error: {e}")
+            return None
+
+    async def fetch_earn_balance(self) -> Optional[List[EarnPositionRecord]]:
+        exchange: ccxt.bybit = self.exchanges.get("default")
+        responses = await asyncio.gather(
+            self._request(exchange, "private_get_v5_earn_position", params={"category": "FlexibleSaving"}, priority=PRIORITY_LOW),
+            self._request(exchange, "private_get_v5_earn_position", params={"category": "OnChain"}, priority=PRIORITY_LOW),
+            return_exceptions=True
+        )
+
+        earn_positions: List[EarnPositionRecord] = []
+        for response in responses:
+            if isinstance(response, Exception):
+                logger.error(f"fetch_earn_balance() error: {response}")
+                return None
+
+            earn_positions.extend(parse_bybit_earn(response, self.include_info))
+
+        return earn_positions
@@ -0,0 +1,23 @@
+"""
+Resolution of ccxt connector classes by name. Benchmarks and tests install a factory
+here to run the adapters against simulated exchanges instead of the real ones.
+"""
+from typing import Callable, Optional
+import ccxt.pro as ccxt
+
+# Connector name ("binance", "binanceusdm", ...) -> connector class, or None when unknown
+ConnectorFactory = Callable[[str], Optional[type]]
+
+_factory: Optional[ConnectorFactory] = None
+
+
+def set_connector_factory(factory: Optional[ConnectorFactory]):
+    """Replace the ccxt connector classes for every adapter and market load; None restores them."""
+    global _factory
+    _factory = factory
+
+
+def connector_class(name: str) -> Optional[type]:
+    if _factory:
+        return _factory(name)
+    return getattr(ccxt, name, None)
@@ -1,6 +1,10 @@
-from typing import Dict, Any, List, Optional
+import asyncio
+from typing import Dict, List, Optional
 import ccxt.pro as ccxt
 from app.ccxt.base import BaseAdapter
+from app.ccxt.parsers import parse_deribit_settlements, parse_positions
+from app.ccxt.rate_limiter import PRIORITY_LOW
+from app.records import FundingEventRecord, PositionRecord
 from app.utils.logging import get_logger
 
 
@@ -8,22 +12,74 @@ logger = get_logger("ccxt_deribit_adapter")
 
 
 class DeribitAdapter(BaseAdapter):
-    def __init__(self, exchange_id: str, credentials: Optional[dict[str, str]] = None):
-        super().__init__(exchange_id, credentials)
-
-    async def fetch_options_positions(self) -> List[Dict[str, Any]]:
-        positions = await super().fetch_positions(params={
-            "kind": "option"
-        })
-        return [positions]
-    
-    async def fetch_funding_fees(self) -> List[Dict[str, Any]]:
-        exchange: ccxt.deribit = self.exchanges.get("funding_fees") or self.exchanges.get("default")
-        
+    def __init__(self, exchange_id: str, credentials: Optional[dict[str, str]] = None, include_info: bool = False):
+        super().__init__(exchange_id, credentials, include_info)
+        # Deribit limits non-matching-engine requests per sub-account with a credit pool
+        # https://docs.deribit.com/#rate-limits
+        self.rate_limits = {"default": (1000, 10)}
+        self.api_key_rate_limit = (50, 1)
+        # No earn products. Futures and option positions come from one get_positions request.
+        del self.fetch_plan["earn_balance"]
+        # Settlement and funding history is queried per currency
+        self.settlement_currencies = ["BTC", "ETH", "USDC", "USDT"]
+
+    async def _fetch_all_positions(self, params: dict) -> List[PositionRecord]:
+        exchange: ccxt.deribit = self.exchanges.get("positions") or self.exchanges.get("default")
+        positions = await self._request(exchange, "fetch_positions", params=params)
+        return parse_positions(positions, "linear", self.include_info)
+
+    async def fetch_positions(self, params={}) -> Optional[List[PositionRecord]]:
+        try:
+            positions = await self._fetch_all_positions(params)
+            return [position for position in positions if position.contract_type != "option"]
+        except Exception as e:
+            logger.error(f"fetch_positions() error: {e}")
+            return None
+
+    async def fetch_options_positions(self, params={}) -> Optional[List[PositionRecord]]:
         try:
-            response = await exchange.private_get_get_settlement_history_by_currency(params={"currency": "BTC"})
-            result = response["result"]
-            return result["settlements"]
+            positions = await self._fetch_all_positions(params)
+            return [position for position in positions if position.contract_type == "option"]
         except Exception as e:
-            logger.error(f"fetch_funding_fees() error: {e}")
-            return []
+            logger.error(f"fetch_options_positions() error: {e}")
+            return None
+    
+    async def _fetch_settlements(self, exchange: ccxt.deribit, currency: str, since: Optional[int]) -> List[FundingEventRecord]:
+        """
+        Settlements come newest first; continuation pages are followed back to the watermark.
+        Without a watermark only the latest page is fetched.
+        """
+        params = {"currency": currency, "count": self.funding_page_size}
+        records = []
+        for _ in range(self.funding_max_pages):
+            response = await self._request(
+                exchange, "private_get_get_settlement_history_by_currency", params=params, priority=PRIORITY_LOW
+            )
+            page = parse_deribit_settlements(response, currency, self.include_info)
+            records.extend(page)
+
+            continuation = ((response or {}).get("result") or {}).get("continuation")
+            if since is None or not continuation or continuation == "none" or any((record.timestamp or 0) <= since for record in page):
+                break
+            params = {**params, "continuation": continuation}
+        return records
+
+    async def fetch_funding_fees(self, since: Optional[Dict[str, int]] = None) -> Optional[List[FundingEventRecord]]:
+        exchange: ccxt.deribit = self.exchanges.get("funding_fees") or self.exchanges.get("default")
+        since = since or {}
+
+        results = await asyncio.gather(
+            *(self._fetch_settlements(exchange, currency, since.get(currency)) for currency in self.settlement_currencies),
+            return_exceptions=True,
+        )
+
+        records: List[FundingEventRecord] = []
+        failed = 0
+        for currency, result in zip(self.settlement_currencies, results):
+            if isinstance(result, Exception):
+                logger.error(f"fetch_funding_fees() error for {currency}: {result}")
+                failed += 1
+                continue
+            records.extend(result)
+
+        return records if failed < len(results) else None
@@ -1,6 +1,9 @@
-from typing import Dict, Any, List, Optional
+from typing import Dict, List, Optional
 import ccxt.pro as ccxt
 from app.ccxt.base import BaseAdapter
+from app.ccxt.parsers import parse_funding_history, parse_gateio_uni_lends
+from app.ccxt.rate_limiter import PRIORITY_LOW, SCOPE_KEY, KIND_REMAINING
+from app.records import EarnPositionRecord, FundingEventRecord
 from app.utils.logging import get_logger
 
 
@@ -8,29 +11,40 @@ logger = get_logger("ccxt_gateio_adapter")
 
 
 class GateioAdapter(BaseAdapter):
-    def __init__(self, exchange_id: str, credentials: Optional[dict[str, str]] = None):
-        super().__init__(exchange_id, credentials)
+    def __init__(self, exchange_id: str, credentials: Optional[dict[str, str]] = None, include_info: bool = False):
+        super().__init__(exchange_id, credentials, include_info)
+        # https://www.gate.io/docs/developers/apiv4/#frequency-limit-rule
+        self.rate_limits = {"default": (200, 10)}
+        self.api_key_rate_limit = (100, 10)
+        self.rate_limit_headers = {
+            "x-gate-ratelimit-requests-remain": (SCOPE_KEY, KIND_REMAINING),
+        }
+        # account_book lists the newest first and serves at most 30 days per request
+        self.funding_newest_first = True
+        self.funding_window = 30 * 24 * 3600 * 1000
+        # No option positions through ccxt
+        del self.fetch_plan["option_positions"]
     
-    async def fetch_earn_balance(self) -> List[Dict[str, Any]]:
+    async def fetch_earn_balance(self) -> Optional[List[EarnPositionRecord]]:
         exchange: ccxt.gateio = self.exchanges.get("default")
         try:
-            return await exchange.private_earn_get_uni_lends()
+            lends = await self._request(exchange, "private_earn_get_uni_lends", priority=PRIORITY_LOW)
+            return parse_gateio_uni_lends(lends, self.include_info)
         except Exception as e:
             logger.error(f"fetch_earn_balance() error: {e}")
-            return []
+            return None
 
-    async def fetch_funding_fees(self) -> List[Dict[str, Any]]:
+    async def fetch_funding_fees(self, since: Optional[Dict[str, int]] = None) -> Optional[List[FundingEventRecord]]:
         exchange: ccxt.gateio = self.exchanges.get("funding_fees") or self.exchanges.get("default")
-        fetch_method = getattr(exchange, "fetch_funding_history")
+        fetch_method = getattr(exchange, "fetch_funding_history", None)
 
         if not fetch_method:
             logger.info(f"Exchange {self.exchange_id} does not have fetch_funding_history() method")
-            return []
+            return None
         
         try:
-            return [await fetch_method(
-                params={"type": "future"}
-            )]
+            history = await self._fetch_funding_history(exchange, since, params={"type": "future"})
+            return parse_funding_history(history, self.include_info)
         except Exception as e:
             logger.error(f"fetch_funding_fees() error: {e}")
-            return []
+            return None
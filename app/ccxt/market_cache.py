@@ -0,0 +1,243 @@
+import asyncio
+import json
+import os
+import time
+import weakref
+from typing import Any, Dict, Optional, Tuple
+from ccxt.base.exchange import Exchange
+from app.ccxt.connectors import connector_class
+from app.utils.logging import get_logger
+
+logger = get_logger("market_cache")
+
+# Exchange attributes populated by load_markets() that are shared between instances
+MARKET_ATTRIBUTES = (
+    "markets",
+    "markets_by_id",
+    "symbols",
+    "ids",
+    "currencies",
+    "currencies_by_id",
+    "codes",
+    "base_currencies",
+    "quote_currencies",
+)
+
+MarketKey = Tuple[str, bool, bool]
+
+
+def _mode(sandbox: bool, demo: bool) -> str:
+    if demo:
+        return "demo"
+    return "sandbox" if sandbox else "live"
+
+
+class MarketTables:
+    __slots__ = ("attributes", "loaded_at")
+
+    def __init__(self, attributes: Dict[str, Any], loaded_at: float):
+        self.attributes = attributes
+        self.loaded_at = loaded_at
+
+    def inject(self, instance: Exchange):
+        for name, value in self.attributes.items():
+            setattr(instance, name, value)
+
+
+class MarketCache:
+    """
+    Process-wide market/currency tables keyed by connector name and sandbox/demo mode.
+    Tables are loaded once, shared by reference with every ccxt instance created by the
+    adapters, refreshed in the background after `ttl` seconds and optionally persisted
+    to `snapshot_dir` so a restart can skip the download.
+    """
+
+    def __init__(self, ttl: float = 3600.0, refresh_interval: float = 60.0, snapshot_dir: Optional[str] = None):
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.snapshot_dir = snapshot_dir
+
+        self._tables: Dict[MarketKey, MarketTables] = {}
+        self._locks: Dict[MarketKey, asyncio.Lock] = {}
+        self._instances: Dict[MarketKey, "weakref.WeakSet[Exchange]"] = {}
+        self._refresher: Optional[asyncio.Task] = None
+
+        self._loads = 0
+        self._snapshot_loads = 0
+        self._injections = 0
+
+    async def start(self):
+        if self._refresher and not self._refresher.done():
+            return
+        self._refresher = asyncio.create_task(self._refresh_loop(), name="market-cache-refresher")
+        logger.info(f"Market cache started (ttl={self.ttl}s, snapshot_dir={self.snapshot_dir})")
+
+    async def stop(self):
+        if self._refresher:
+            self._refresher.cancel()
+            await asyncio.gather(self._refresher, return_exceptions=True)
+            self._refresher = None
+
+    async def attach(self, instance: Exchange, name: str, sandbox: bool = False, demo: bool = False):
+        """Inject the shared tables into `instance` so it never loads markets on its own."""
+        key = (name, sandbox, demo)
+        try:
+            tables = await self.get(name, sandbox, demo)
+        except Exception as e:
+            logger.warning(f"Shared markets unavailable for {name} ({_mode(sandbox, demo)}), instance will load its own: {e}")
+            return
+
+        tables.inject(instance)
+        self._instances.setdefault(key, weakref.WeakSet()).add(instance)
+        self._injections += 1
+
+    async def get(self, name: str, sandbox: bool = False, demo: bool = False) -> MarketTables:
+        key = (name, sandbox, demo)
+        tables = self._tables.get(key)
+        if tables:
+            return tables
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            tables = self._tables.get(key)
+            if tables:
+                return tables
+
+            tables = await self._load_snapshot(key)
+            if not tables:
+                tables = await self._load(key)
+                await self._save_snapshot(key, tables)
+
+            self._tables[key] = tables
+            return tables
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            "loads": self._loads,
+            "snapshot_loads": self._snapshot_loads,
+            "injections": self._injections,
+            "tables": {
+                f"{name}:{_mode(sandbox, demo)}": {
+                    "markets": len(tables.attributes.get("markets") or {}),
+                    "age_s": round(now - tables.loaded_at, 1),
+                    "instances": len(self._instances.get((name, sandbox, demo), ())),
+                }
+                for (name, sandbox, demo), tables in self._tables.items()
+            },
+        }
+
+    def _create_loader(self, key: MarketKey) -> Exchange:
+        name, sandbox, demo = key
+        loader: Exchange = connector_class(name)({"enableRateLimit": True})
+        if sandbox:
+            loader.set_sandbox_mode(True)
+        if demo:
+            loader.enable_demo_trading(True)
+        return loader
+
+    @staticmethod
+    def _capture(loader: Exchange, loaded_at: float) -> MarketTables:
+        attributes = {
+            name: getattr(loader, name)
+            for name in MARKET_ATTRIBUTES
+            if getattr(loader, name, None) is not None
+        }
+        return MarketTables(attributes, loaded_at)
+
+    async def _load(self, key: MarketKey) -> MarketTables:
+        name, sandbox, demo = key
+        loader = self._create_loader(key)
+        started = time.perf_counter()
+        try:
+            await loader.load_markets()
+            tables = self._capture(loader, time.time())
+        finally:
+            await loader.close()
+
+        self._loads += 1
+        logger.info(
+            f"Loaded {len(tables.attributes.get('markets') or {})} markets for {name} "
+            f"({_mode(sandbox, demo)}) in {(time.perf_counter() - started) * 1000:.0f}ms"
+        )
+        return tables
+
+    def _snapshot_path(self, key: MarketKey) -> Optional[str]:
+        if not self.snapshot_dir:
+            return None
+        name, sandbox, demo = key
+        return os.path.join(self.snapshot_dir, f"{name}-{_mode(sandbox, demo)}.json")
+
+    async def _load_snapshot(self, key: MarketKey) -> Optional[MarketTables]:
+        path = self._snapshot_path(key)
+        if not path or not os.path.exists(path):
+            return None
+
+        try:
+            snapshot = await asyncio.to_thread(self._read_json, path)
+            loader = self._create_loader(key)
+            try:
+                loader.set_markets(snapshot["markets"], snapshot.get("currencies"))
+                tables = self._capture(loader, snapshot["loaded_at"])
+            finally:
+                await loader.close()
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable market snapshot {path}: {e}")
+            return None
+
+        self._snapshot_loads += 1
+        logger.info(f"Loaded market snapshot {path}")
+        return tables
+
+    async def _save_snapshot(self, key: MarketKey, tables: MarketTables):
+        path = self._snapshot_path(key)
+        if not path:
+            return
+
+        snapshot = {
+            "loaded_at": tables.loaded_at,
+            "markets": tables.attributes.get("markets"),
+            "currencies": tables.attributes.get("currencies"),
+        }
+        try:
+            await asyncio.to_thread(self._write_json, path, snapshot)
+        except Exception as e:
+            logger.warning(f"Failed to write market snapshot {path}: {e}")
+
+    @staticmethod
+    def _read_json(path: str) -> dict:
+        with open(path, "r") as f:
+            return json.load(f)
+
+    @staticmethod
+    def _write_json(path: str, data: dict):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    async def _refresh(self, key: MarketKey):
+        tables = await self._load(key)
+        self._tables[key] = tables
+
+        for instance in list(self._instances.get(key, ())):
+            tables.inject(instance)
+
+        await self._save_snapshot(key, tables)
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+
+            expired_before = time.time() - self.ttl
+            for key, tables in list(self._tables.items()):
+                if tables.loaded_at > expired_before:
+                    continue
+                try:
+                    await self._refresh(key)
+                except Exception as e:
+                    logger.warning(f"Failed to refresh markets for {key[0]} ({_mode(key[1], key[2])}): {e}")
+
+
+market_cache = MarketCache(snapshot_dir=os.getenv("MARKET_CACHE_DIR"))
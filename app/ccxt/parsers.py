@@ -0,0 +1,169 @@
+"""
+Conversion of ccxt and raw exchange responses into normalized records. Kept free of ccxt
+imports so the same code can be exercised against recorded responses.
+"""
+from typing import Any, Dict, Iterable, List, Optional
+from app.records import BalanceRecord, EarnPositionRecord, FundingEventRecord, PositionRecord, to_float
+
+# Top-level keys of a ccxt balance structure that are not per-currency entries
+BALANCE_AGGREGATE_KEYS = {"info", "free", "used", "total", "debt", "timestamp", "datetime"}
+
+
+def parse_balances(balances: Optional[Dict[str, Any]], include_info: bool = False) -> List[BalanceRecord]:
+    """Non-empty currencies of a ccxt balance structure."""
+    records = []
+    for currency, balance in (balances or {}).items():
+        if currency in BALANCE_AGGREGATE_KEYS or not isinstance(balance, dict):
+            continue
+
+        total = to_float(balance.get("total"))
+        if total <= 0:
+            continue
+
+        records.append(BalanceRecord(
+            currency,
+            to_float(balance.get("free")),
+            to_float(balance.get("used")),
+            total,
+            info=balances.get("info") if include_info else None,
+        ))
+    return records
+
+
+def contract_type_of(symbol: Optional[str], default: str) -> str:
+    """linear / inverse / option from a ccxt unified symbol such as BTC/USD:BTC-240329-60000-C"""
+    if not symbol or ":" not in symbol:
+        return default
+
+    market, _, settle = symbol.partition(":")
+    parts = settle.split("-")
+    if len(parts) == 4 and parts[3] in ("C", "P"):
+        return "option"
+    return "inverse" if parts[0] == market.split("/")[0] else "linear"
+
+
+def parse_positions(positions: Optional[Iterable[Dict[str, Any]]], contract_type: str, include_info: bool = False) -> List[PositionRecord]:
+    """Open positions from ccxt fetch_positions() / watch_positions() output."""
+    records = []
+    for position in positions or []:
+        contracts = to_float(position.get("contracts"))
+        if not contracts:
+            continue
+
+        symbol = position.get("symbol")
+        records.append(PositionRecord(
+            symbol,
+            position.get("side"),
+            contract_type_of(symbol, contract_type),
+            contracts,
+            contract_size=to_float(position.get("contractSize"), None),
+            notional=to_float(position.get("notional"), None),
+            entry_price=to_float(position.get("entryPrice"), None),
+            mark_price=to_float(position.get("markPrice"), None),
+            unrealized_pnl=to_float(position.get("unrealizedPnl"), None),
+            leverage=to_float(position.get("leverage"), None),
+            margin_mode=position.get("marginMode"),
+            info=position.get("info") if include_info else None,
+        ))
+    return records
+
+
+def parse_funding_history(entries: Optional[Iterable[Dict[str, Any]]], include_info: bool = False) -> List[FundingEventRecord]:
+    """ccxt fetch_funding_history() output."""
+    records = []
+    for entry in entries or []:
+        timestamp = entry.get("timestamp")
+        records.append(FundingEventRecord(
+            str(entry.get("id") or f"{entry.get('symbol')}:{timestamp}"),
+            entry.get("symbol"),
+            entry.get("code"),
+            to_float(entry.get("amount")),
+            timestamp,
+            info=entry.get("info") if include_info else None,
+        ))
+    return records
+
+
+def parse_binance_simple_earn(response: Optional[Dict[str, Any]], product: str, include_info: bool = False) -> List[EarnPositionRecord]:
+    """/sapi/v1/simple-earn/{flexible,locked}/position"""
+    records = []
+    for row in (response or {}).get("rows") or []:
+        amount = to_float(row.get("totalAmount") or row.get("amount"))
+        if amount <= 0:
+            continue
+
+        apr = row.get("latestAnnualPercentageRate") or row.get("APY") or row.get("apy")
+        records.append(EarnPositionRecord(
+            row.get("asset"),
+            f"{product}:{row.get('productId') or row.get('projectId') or row.get('positionId')}",
+            amount,
+            apr=to_float(apr, None),
+            rewards=to_float(row.get("cumulativeTotalRewards") or row.get("rewardAmt"), None),
+            info=row if include_info else None,
+        ))
+    return records
+
+
+def parse_bybit_earn(response: Optional[Dict[str, Any]], include_info: bool = False) -> List[EarnPositionRecord]:
+    """/v5/earn/position"""
+    result = (response or {}).get("result") or {}
+    positions = result.get("list")
+    if not isinstance(positions, list):
+        return []
+
+    records = []
+    for position in positions:
+        amount = to_float(position.get("amount"))
+        if amount <= 0:
+            continue
+
+        records.append(EarnPositionRecord(
+            position.get("coin"),
+            f"{position.get('category') or 'earn'}:{position.get('productId')}",
+            amount,
+            rewards=to_float(position.get("totalPnl"), None),
+            info=position if include_info else None,
+        ))
+    return records
+
+
+def parse_gateio_uni_lends(response: Optional[List[Dict[str, Any]]], include_info: bool = False) -> List[EarnPositionRecord]:
+    """/earn/uni/lends"""
+    records = []
+    for lend in response or []:
+        amount = to_float(lend.get("current_amount") or lend.get("amount"))
+        if amount <= 0:
+            continue
+
+        records.append(EarnPositionRecord(
+            lend.get("currency"),
+            "uni_lend",
+            amount,
+            apr=to_float(lend.get("min_rate"), None),
+            info=lend if include_info else None,
+        ))
+    return records
+
+
+def parse_deribit_settlements(response: Optional[Dict[str, Any]], currency: str, include_info: bool = False) -> List[FundingEventRecord]:
+    """private/get_settlement_history_by_currency"""
+    result = (response or {}).get("result") or {}
+    records = []
+    for settlement in result.get("settlements") or []:
+        timestamp = settlement.get("timestamp")
+        instrument = settlement.get("instrument_name")
+        event_type = settlement.get("type") or "settlement"
+        amount = settlement.get("funding")
+        if amount is None:
+            amount = settlement.get("session_profit_loss")
+
+        records.append(FundingEventRecord(
+            f"{instrument}:{timestamp}:{event_type}",
+            instrument,
+            currency,
+            to_float(amount),
+            timestamp,
+            event_type=event_type,
+            info=settlement if include_info else None,
+        ))
+    return records
@@ -0,0 +1,235 @@
+import asyncio
+import bisect
+import itertools
+import time
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+from app.utils.logging import get_logger
+
+logger = get_logger("rate_limiter")
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# (capacity, interval in seconds)
+RateLimit = Tuple[float, float]
+
+DEFAULT_RATE_LIMIT: RateLimit = (1200, 60)
+
+# Header scopes/kinds understood by RateLimitGovernor.observe()
+SCOPE_CLASS = "class"
+SCOPE_KEY = "key"
+KIND_USED = "used"
+KIND_REMAINING = "remaining"
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, interval: float):
+        self.capacity = capacity
+        self.rate = capacity / interval
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, weight: float) -> float:
+        """Seconds until `weight` tokens are available (0 when they already are)."""
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+
+        weight = min(weight, self.capacity)
+        if self.tokens >= weight:
+            return 0.0
+        return (weight - self.tokens) / self.rate
+
+    def consume(self, weight: float):
+        self.tokens -= min(weight, self.capacity)
+
+    def sync(self, remaining: float):
+        # The exchange's view of our budget wins when it is tighter than ours
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, max(remaining, 0.0))
+
+    def pause(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "api_key", "weight", "future")
+
+    def __init__(self, priority: int, seq: int, api_key: str, weight: float, future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.api_key = api_key
+        self.weight = weight
+        self.future = future
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _Lane:
+    """Requests competing for one (exchange, weight class) budget."""
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.waiters: List[_Waiter] = []
+        self.dispatcher: Optional[asyncio.Task] = None
+
+
+class RateLimitGovernor:
+    """
+    Token buckets shared by every adapter in the process. Each request draws its weight
+    from the (exchange, weight class) bucket, which models the exchange's IP limits, and
+    from the (exchange, API key) bucket, which models account limits. Requests that do not
+    fit are queued by priority; a waiter whose API key is exhausted does not block waiters
+    of other keys. Buckets are corrected from the usage headers the exchange returns.
+    """
+
+    def __init__(self, share: float = 1.0):
+        # Fraction of the exchange's IP limits this process may use, when several worker
+        # processes share one IP address
+        self.share = share
+        self._limits: Dict[str, Dict[str, RateLimit]] = {}
+        self._key_limits: Dict[str, RateLimit] = {}
+        self._lanes: Dict[Tuple[str, str], _Lane] = {}
+        self._key_buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._seq = itertools.count()
+
+        self._granted = 0
+        self._delayed = 0
+        self._penalties = 0
+
+    def configure(self, exchange: str, limits: Mapping[str, RateLimit], api_key_limit: Optional[RateLimit] = None):
+        if exchange in self._limits:
+            return
+        self._limits[exchange] = dict(limits)
+        if api_key_limit:
+            self._key_limits[exchange] = api_key_limit
+
+    def _lane(self, exchange: str, weight_class: str) -> _Lane:
+        lane = self._lanes.get((exchange, weight_class))
+        if not lane:
+            limits = self._limits.get(exchange, {})
+            capacity, interval = limits.get(weight_class) or limits.get("default") or DEFAULT_RATE_LIMIT
+            lane = self._lanes[(exchange, weight_class)] = _Lane(TokenBucket(capacity * self.share, interval))
+        return lane
+
+    def _key_bucket(self, exchange: str, api_key: str) -> Optional[TokenBucket]:
+        limit = self._key_limits.get(exchange)
+        if not limit or not api_key:
+            return None
+
+        bucket = self._key_buckets.get((exchange, api_key))
+        if not bucket:
+            bucket = self._key_buckets[(exchange, api_key)] = TokenBucket(*limit)
+        return bucket
+
+    async def acquire(self, exchange: str, weight_class: str, api_key: str, weight: float = 1, priority: int = PRIORITY_NORMAL):
+        lane = self._lane(exchange, weight_class)
+        key_bucket = self._key_bucket(exchange, api_key)
+
+        # Fast path: nothing queued ahead of us and both budgets have room
+        if not lane.waiters and lane.bucket.delay(weight) == 0 and (not key_bucket or key_bucket.delay(weight) == 0):
+            self._grant(lane, key_bucket, weight)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        bisect.insort(lane.waiters, _Waiter(priority, next(self._seq), api_key, weight, future))
+        self._delayed += 1
+
+        if not lane.dispatcher or lane.dispatcher.done():
+            lane.dispatcher = asyncio.create_task(self._dispatch(exchange, lane))
+
+        await future
+
+    def _grant(self, lane: _Lane, key_bucket: Optional[TokenBucket], weight: float):
+        lane.bucket.consume(weight)
+        if key_bucket:
+            key_bucket.consume(weight)
+        self._granted += 1
+
+    async def _dispatch(self, exchange: str, lane: _Lane):
+        while lane.waiters:
+            lane.waiters = [waiter for waiter in lane.waiters if not waiter.future.done()]
+            if not lane.waiters:
+                break
+
+            lane_delay = lane.bucket.delay(lane.waiters[0].weight)
+            if lane_delay > 0:
+                await asyncio.sleep(lane_delay)
+                continue
+
+            granted = False
+            key_delay = float("inf")
+            for waiter in lane.waiters:
+                key_bucket = self._key_bucket(exchange, waiter.api_key)
+                delay = key_bucket.delay(waiter.weight) if key_bucket else 0.0
+                if delay > 0:
+                    key_delay = min(key_delay, delay)
+                    continue
+
+                lane.waiters.remove(waiter)
+                self._grant(lane, key_bucket, waiter.weight)
+                waiter.future.set_result(None)
+                granted = True
+                break
+
+            if not granted and lane.waiters:
+                await asyncio.sleep(key_delay if key_delay != float("inf") else 0)
+
+    def observe(self, exchange: str, weight_class: str, api_key: str, headers: Optional[Mapping[str, Any]], header_spec: Mapping[str, Tuple[str, str]]):
+        """
+        Align buckets with rate-limit headers. `header_spec` maps a lower-cased header name to
+        (scope, kind): scope is SCOPE_CLASS or SCOPE_KEY, kind is KIND_USED or KIND_REMAINING.
+        """
+        if not headers or not header_spec:
+            return
+
+        for name, value in headers.items():
+            spec = header_spec.get(name.lower())
+            if not spec:
+                continue
+
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+
+            scope, kind = spec
+            bucket = self._lane(exchange, weight_class).bucket if scope == SCOPE_CLASS else self._key_bucket(exchange, api_key)
+            if not bucket:
+                continue
+
+            # IP usage headers count every process behind the address; this one owns `share` of it
+            scale = self.share if scope == SCOPE_CLASS else 1.0
+            bucket.sync(bucket.capacity - value * scale if kind == KIND_USED else value * scale)
+
+    def penalize(self, exchange: str, weight_class: str, retry_after: float):
+        self._penalties += 1
+        self._lane(exchange, weight_class).bucket.pause(retry_after)
+        logger.warning(f"Rate limited by {exchange} ({weight_class}), pausing for {retry_after:.1f}s")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "granted": self._granted,
+            "delayed": self._delayed,
+            "penalties": self._penalties,
+            "lanes": {
+                f"{exchange}:{weight_class}": {
+                    "tokens": round(lane.bucket.tokens, 1),
+                    "capacity": lane.bucket.capacity,
+                    "waiting": len(lane.waiters),
+                }
+                for (exchange, weight_class), lane in self._lanes.items()
+            },
+        }
+
+
+rate_limiter = RateLimitGovernor()
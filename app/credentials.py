@@ -1,4 +1,15 @@
-from typing import Dict, Optional
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from app.utils.logging import get_logger
+
+logger = get_logger("credentials")
+
+# {"exchange": ..., "credentials": {...}}
+CredentialsInfo = Dict[str, Any]
+# Called with the account id when its credentials changed
+RotationCallback = Callable[[str], Awaitable[None]]
 
 # Hard-coded for demo. Replace with actual credentials service
 credentials = {
@@ -41,5 +52,221 @@ credentials = {
 }
 
 
-async def get_credentials_for_account(account_id: str) -> Optional[Dict[str, str]]:
-    return credentials.get(account_id)
+
+class CredentialsBackend:
+    """Source of account credentials, resolving many accounts per call."""
+
+    async def fetch_many(self, account_ids: List[str]) -> Dict[str, Optional[CredentialsInfo]]:
+        raise NotImplementedError
+
+
+class StaticCredentialsBackend(CredentialsBackend):
+    """Local stand-in serving credentials from a dict."""
+
+    def __init__(self, accounts: Dict[str, CredentialsInfo]):
+        self.accounts = accounts
+        self.calls = 0
+
+    async def fetch_many(self, account_ids: List[str]) -> Dict[str, Optional[CredentialsInfo]]:
+        self.calls += 1
+        return {account_id: self.accounts.get(account_id) for account_id in account_ids}
+
+
+class _Entry:
+    __slots__ = ("info", "resolved_at", "expires_at", "last_used")
+
+    def __init__(self, info: Optional[CredentialsInfo], resolved_at: float, ttl: float):
+        self.info = info
+        self.resolved_at = resolved_at
+        self.expires_at = resolved_at + ttl
+        self.last_used = resolved_at
+
+
+class CredentialsCache:
+    """
+    Caches credentials for `ttl` seconds (`negative_ttl` for unknown accounts), keeping at
+    most `max_size` accounts and evicting the least recently used. Misses arriving within
+    `batch_window` seconds are resolved in one backend call of up to `max_batch` accounts,
+    and concurrent misses of one account share that call. Entries used since their last
+    resolve are refreshed in the background `refresh_ahead` seconds before they expire;
+    when a refresh returns different credentials, `on_rotate` is called for the account.
+    """
+
+    def __init__(
+        self,
+        backend: CredentialsBackend,
+        ttl: float = 300.0,
+        negative_ttl: float = 30.0,
+        refresh_ahead: float = 60.0,
+        max_size: int = 50_000,
+        batch_window: float = 0.005,
+        max_batch: int = 500,
+    ):
+        self.backend = backend
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_ahead = refresh_ahead
+        self.max_size = max_size
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.on_rotate: Optional[RotationCallback] = None
+
+        # account_id -> entry, ordered from least to most recently used
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._refresher: Optional[asyncio.Task] = None
+        self._loads: Set[asyncio.Task] = set()
+
+        self._hits = 0
+        self._misses = 0
+        self._backend_calls = 0
+        self._refreshed = 0
+        self._rotations = 0
+        self._evictions = 0
+
+    async def get(self, account_id: str) -> Optional[CredentialsInfo]:
+        entry = self._entries.get(account_id)
+        if entry and entry.expires_at > time.monotonic():
+            self._hits += 1
+            entry.last_used = time.monotonic()
+            self._entries.move_to_end(account_id)
+            return entry.info
+
+        self._misses += 1
+        # Shielded: the future is shared by every caller waiting for the account, and one of
+        # them being cancelled must not cancel it for the others
+        return await asyncio.shield(self._resolve(account_id))
+
+    async def get_many(self, account_ids: Iterable[str]) -> Dict[str, Optional[CredentialsInfo]]:
+        account_ids = list(dict.fromkeys(account_ids))
+        results = await asyncio.gather(*[self.get(account_id) for account_id in account_ids])
+        return dict(zip(account_ids, results))
+
+    def invalidate(self, account_id: str):
+        self._entries.pop(account_id, None)
+
+    def _resolve(self, account_id: str) -> asyncio.Future:
+        future = self._pending.get(account_id)
+        if future is not None:
+            return future
+
+        loop = asyncio.get_running_loop()
+        future = self._pending[account_id] = loop.create_future()
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif not self._flush_handle:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush)
+        return future
+
+    def _flush(self):
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        pending, self._pending = self._pending, {}
+        if pending:
+            load = asyncio.create_task(self._load(pending))
+            self._loads.add(load)
+            load.add_done_callback(self._loads.discard)
+
+    async def _load(self, pending: Dict[str, asyncio.Future]):
+        try:
+            resolved, rotated = await self._fetch(list(pending))
+        except Exception as e:
+            logger.error(f"Failed to resolve credentials for {len(pending)} accounts: {e}")
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for account_id, future in pending.items():
+            if not future.done():
+                future.set_result(resolved.get(account_id))
+
+        # Only after the waiters have their credentials: rotation handling can be slow
+        await self._rotated(rotated)
+
+    async def _fetch(self, account_ids: List[str]) -> Tuple[Dict[str, Optional[CredentialsInfo]], List[str]]:
+        """Resolve accounts in one backend call and store them; returns the results and the rotated accounts."""
+        self._backend_calls += 1
+        resolved = await self.backend.fetch_many(account_ids)
+
+        now = time.monotonic()
+        rotated = []
+        for account_id in account_ids:
+            info = resolved.get(account_id)
+            previous = self._entries.pop(account_id, None)
+            if previous and previous.info is not None and previous.info != info:
+                rotated.append(account_id)
+
+            entry = self._entries[account_id] = _Entry(info, now, self.ttl if info is not None else self.negative_ttl)
+            if previous:
+                entry.last_used = previous.last_used
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+        return resolved, rotated
+
+    async def _rotated(self, account_ids: List[str]):
+        for account_id in account_ids:
+            self._rotations += 1
+            logger.info(f"Credentials rotated for account[{account_id}]")
+            if self.on_rotate:
+                try:
+                    await self.on_rotate(account_id)
+                except Exception as e:
+                    logger.warning(f"Rotation handling failed for account[{account_id}]: {e}")
+
+    async def _refresh(self):
+        now = time.monotonic()
+        due = [
+            account_id
+            for account_id, entry in self._entries.items()
+            # Entries unused since their last resolve are left to expire
+            if entry.expires_at - now <= self.refresh_ahead and entry.last_used >= entry.resolved_at
+        ]
+
+        for start in range(0, len(due), self.max_batch):
+            _, rotated = await self._fetch(due[start:start + self.max_batch])
+            await self._rotated(rotated)
+        self._refreshed += len(due)
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(max(1.0, self.refresh_ahead / 4))
+            try:
+                await self._refresh()
+            except Exception as e:
+                logger.warning(f"Credentials refresh failed: {e}")
+
+    def start(self):
+        if not self._refresher:
+            self._refresher = asyncio.create_task(self._refresh_loop(), name="credentials-refresher")
+
+    async def stop(self):
+        if self._refresher:
+            self._refresher.cancel()
+            await asyncio.gather(self._refresher, return_exceptions=True)
+            self._refresher = None
+
+        if self._loads:
+            await asyncio.gather(*self._loads, return_exceptions=True)
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self._hits + self._misses
+        return {
+            "size": len(self._entries),
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_rate": self._hits / lookups if lookups else 0.0,
+            "backend_calls": self._backend_calls,
+            "refreshed": self._refreshed,
+            "rotations": self._rotations,
+            "evictions": self._evictions,
+        }
+
+
+credentials_cache = CredentialsCache(StaticCredentialsBackend(credentials))
@@ -0,0 +1,194 @@
+import json
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from app.nats_publisher import NatsPublisher, nats_publisher
+from app.records import Record
+from app.utils.logging import get_logger
+
+logger = get_logger("delta_publisher")
+
+SNAPSHOT_REQUEST_SUBJECT = "snapshot.request"
+
+
+def index_items(records: Iterable[Record]) -> Dict[str, Record]:
+    """Key a fetch result by currency / position / event so two results can be diffed."""
+    return {record.key: record for record in records or []}
+
+
+def serialize_items(items: Dict[str, Record]) -> Dict[str, Dict[str, Any]]:
+    return {key: record.to_dict() for key, record in items.items()}
+
+
+class _StreamState:
+    __slots__ = ("items", "seq", "last_snapshot")
+
+    def __init__(self):
+        self.items: Dict[str, Record] = {}
+        self.seq = 0
+        self.last_snapshot = 0.0
+
+
+class DeltaPublisher:
+    """
+    Keeps the last published state per (account, stream) and publishes only what changed.
+
+    Messages on `{stream}.{exchange}.{account_id}` are full snapshots, sent for the first
+    result, every `snapshot_interval` seconds and when a consumer asks for one on
+    `snapshot.request`. Messages on `{stream}_delta.{exchange}.{account_id}` carry the
+    changed and removed items only. Both share one sequence number per stream so
+    consumers can detect gaps and request a new snapshot.
+    """
+
+    def __init__(self, publisher: NatsPublisher, snapshot_interval: float = 300.0):
+        self.publisher = publisher
+        self.snapshot_interval = snapshot_interval
+
+        # account_id -> (stream, exchange) -> state
+        self._states: Dict[str, Dict[Tuple[str, str], _StreamState]] = {}
+
+        # When set, every published state is journaled for warm restarts
+        self.journal = None
+        # When set, snapshot requests are also passed on to where the account's state lives,
+        # e.g. a worker process; awaits to the number of snapshots published there
+        self.forward: Optional[Callable[[str, Optional[str]], Awaitable[int]]] = None
+
+        self._snapshots = 0
+        self._deltas = 0
+        self._unchanged = 0
+
+    async def start(self):
+        await self.publisher.subscribe(SNAPSHOT_REQUEST_SUBJECT, self._on_snapshot_request)
+
+    def _state(self, account_id: str, stream: str, exchange: str) -> _StreamState:
+        streams = self._states.setdefault(account_id, {})
+        state = streams.get((stream, exchange))
+        if state is None:
+            state = streams[(stream, exchange)] = _StreamState()
+        return state
+
+    def _envelope(self, kind: str, stream: str, exchange: str, account_id: str, state: _StreamState) -> Dict[str, Any]:
+        state.seq += 1
+        return {
+            "kind": kind,
+            "seq": state.seq,
+            "stream": stream,
+            "exchange": exchange,
+            "account_id": account_id,
+            "timestamp": int(time.time() * 1000),
+        }
+
+    async def _publish_snapshot(self, stream: str, exchange: str, account_id: str, state: _StreamState):
+        message = self._envelope("snapshot", stream, exchange, account_id, state)
+        message["items"] = serialize_items(state.items)
+        state.last_snapshot = time.time()
+        self._snapshots += 1
+        await self.publisher.publish(f"{stream}.{exchange}.{account_id}", message)
+
+    async def publish(self, stream: str, exchange: str, account_id: str, records: List[Record]) -> bool:
+        """Publish `records` as a delta (or snapshot when due), returns whether anything changed."""
+        state = self._state(account_id, stream, exchange)
+        items = index_items(records)
+
+        first = state.seq == 0
+        changed = {key: item for key, item in items.items() if state.items.get(key) != item}
+        removed = [key for key in state.items if key not in items]
+        state.items = items
+
+        if first or time.time() - state.last_snapshot >= self.snapshot_interval:
+            await self._publish_snapshot(stream, exchange, account_id, state)
+        elif changed or removed:
+            message = self._envelope("delta", stream, exchange, account_id, state)
+            message["changed"] = serialize_items(changed)
+            message["removed"] = removed
+            self._deltas += 1
+            await self.publisher.publish(f"{stream}_delta.{exchange}.{account_id}", message)
+        else:
+            self._unchanged += 1
+            return False
+
+        if self.journal:
+            self.journal.record_stream(account_id, stream, exchange, state.seq, records)
+        return first or bool(changed or removed)
+
+    async def append(self, stream: str, exchange: str, account_id: str, records: List[Record], keep: int = 500) -> bool:
+        """
+        Publish new events of an append-only stream (funding fees) as a delta of added items.
+        Snapshots carry the latest `keep` events; older ones are dropped without being
+        reported as removed.
+        """
+        state = self._state(account_id, stream, exchange)
+        first = state.seq == 0
+        added = index_items(records)
+        state.items.update(added)
+        if len(state.items) > keep:
+            latest = sorted(state.items.values(), key=lambda record: record.timestamp or 0)[-keep:]
+            state.items = index_items(latest)
+
+        if first or time.time() - state.last_snapshot >= self.snapshot_interval:
+            await self._publish_snapshot(stream, exchange, account_id, state)
+        elif added:
+            message = self._envelope("delta", stream, exchange, account_id, state)
+            message["changed"] = serialize_items(added)
+            message["removed"] = []
+            self._deltas += 1
+            await self.publisher.publish(f"{stream}_delta.{exchange}.{account_id}", message)
+        else:
+            self._unchanged += 1
+            return False
+
+        if self.journal:
+            self.journal.record_stream(account_id, stream, exchange, state.seq, state.items.values())
+        return first or bool(added)
+
+    def items(self, account_id: str, stream: str, exchange: str) -> List[Record]:
+        state = self._states.get(account_id, {}).get((stream, exchange))
+        return list(state.items.values()) if state else []
+
+    def restore(self, stream: str, exchange: str, account_id: str, records: List[Record], seq: int):
+        """Resume a stream from journaled state: the next result is published as a delta with seq + 1."""
+        state = self._state(account_id, stream, exchange)
+        if state.seq:
+            # Already published since startup, which is newer than the journal
+            return
+
+        state.items = index_items(records)
+        state.seq = seq
+        state.last_snapshot = time.time()
+
+    async def request_snapshot(self, account_id: str, stream: Optional[str] = None) -> int:
+        published = 0
+        for (state_stream, exchange), state in list(self._states.get(account_id, {}).items()):
+            if stream and stream != state_stream:
+                continue
+            await self._publish_snapshot(state_stream, exchange, account_id, state)
+            published += 1
+        return published
+
+    async def _on_snapshot_request(self, msg):
+        try:
+            request = json.loads(msg.data or b"{}")
+            published = await self.request_snapshot(request["account_id"], request.get("stream"))
+            if self.forward:
+                published += await self.forward(request["account_id"], request.get("stream"))
+        except Exception as e:
+            logger.warning(f"Invalid snapshot request: {e}")
+            published = 0
+
+        if msg.reply:
+            await self.publisher.publish(msg.reply, {"snapshots": published})
+
+    def forget(self, account_id: str):
+        self._states.pop(account_id, None)
+        if self.journal:
+            self.journal.forget_account(account_id)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "streams": sum(len(streams) for streams in self._states.values()),
+            "snapshots": self._snapshots,
+            "deltas": self._deltas,
+            "unchanged": self._unchanged,
+        }
+
+
+delta_publisher = DeltaPublisher(nats_publisher)
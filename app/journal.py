@@ -0,0 +1,224 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from app.records import Record, from_values
+from app.watermarks import WatermarkRow
+from app.utils.logging import get_logger
+
+logger = get_logger("journal")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS registrations (
+    registry TEXT NOT NULL,
+    account_id TEXT NOT NULL,
+    entry TEXT NOT NULL,
+    PRIMARY KEY (registry, account_id)
+);
+CREATE TABLE IF NOT EXISTS streams (
+    account_id TEXT NOT NULL,
+    stream TEXT NOT NULL,
+    exchange TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    records TEXT NOT NULL,
+    PRIMARY KEY (account_id, stream, exchange)
+);
+CREATE TABLE IF NOT EXISTS watermarks (
+    account_id TEXT NOT NULL,
+    exchange TEXT NOT NULL,
+    currency TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    ids TEXT NOT NULL,
+    PRIMARY KEY (account_id, exchange, currency)
+);
+"""
+
+# (account_id, stream, exchange, seq, updated_at, records)
+StreamRow = Tuple[str, str, str, int, float, List[Record]]
+
+
+def encode_records(records: Iterable[Record]) -> str:
+    return json.dumps([[record.kind, record.values()] for record in records])
+
+
+def decode_records(payload: str) -> List[Record]:
+    return [from_values(kind, tuple(values)) for kind, values in json.loads(payload)]
+
+
+class Journal:
+    """
+    Local SQLite journal (WAL mode) of account registrations, of the last published state
+    of every stream and of the funding watermarks, so a restarted instance resumes without
+    re-registration, without a cold burst of full snapshots and without re-publishing
+    funding events. Writes are coalesced in memory per key and
+    flushed in one transaction every `flush_interval` seconds off the event loop; the WAL
+    is checkpointed and truncated every `compact_interval` seconds.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0, compact_interval: float = 600.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+
+        # Pending writes, last one per key wins. None deletes.
+        self._registrations: Dict[Tuple[str, str], Optional[str]] = {}
+        self._streams: Dict[Tuple[str, str, str], Optional[Tuple[int, float, str]]] = {}
+        self._watermarks: Dict[Tuple[str, str, str], Tuple[int, str]] = {}
+        self._forgotten: List[str] = []
+
+        # One database call runs at a time; a call outlives a cancelled caller and the next waits for it
+        self._db_lock = asyncio.Lock()
+        self._db_call: Optional[asyncio.Future] = None
+
+        self._flusher: Optional[asyncio.Task] = None
+        self._last_compaction = time.monotonic()
+        self._flushes = 0
+        self._written = 0
+
+    def record_registration(self, registry: str, account_id: str, entry: Optional[dict]):
+        self._registrations[(registry, account_id)] = json.dumps(entry) if entry is not None else None
+
+    def record_stream(self, account_id: str, stream: str, exchange: str, seq: int, records: Iterable[Record]):
+        self._streams[(account_id, stream, exchange)] = (seq, time.time(), encode_records(records))
+
+    def record_watermark(self, account_id: str, exchange: str, currency: str, timestamp: int, ids: List[str]):
+        self._watermarks[(account_id, exchange, currency)] = (timestamp, json.dumps(ids))
+
+    def forget_account(self, account_id: str):
+        for key in [key for key in self._streams if key[0] == account_id]:
+            del self._streams[key]
+        for key in [key for key in self._watermarks if key[0] == account_id]:
+            del self._watermarks[key]
+        self._forgotten.append(account_id)
+
+    def load_registrations(self) -> Dict[str, Dict[str, dict]]:
+        registrations: Dict[str, Dict[str, dict]] = {}
+        for registry, account_id, entry in self._db.execute("SELECT registry, account_id, entry FROM registrations"):
+            registrations.setdefault(registry, {})[account_id] = json.loads(entry)
+        return registrations
+
+    def iter_streams(self, batch_size: int = 5000) -> Iterable[List[StreamRow]]:
+        cursor = self._db.execute("SELECT account_id, stream, exchange, seq, updated_at, records FROM streams")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield [(account_id, stream, exchange, seq, updated_at, decode_records(records)) for account_id, stream, exchange, seq, updated_at, records in rows]
+
+    def load_watermarks(self) -> Dict[str, List[WatermarkRow]]:
+        watermarks: Dict[str, List[WatermarkRow]] = {}
+        for account_id, exchange, currency, timestamp, ids in self._db.execute(
+            "SELECT account_id, exchange, currency, timestamp, ids FROM watermarks"
+        ):
+            watermarks.setdefault(account_id, []).append((exchange, currency, timestamp, json.loads(ids)))
+        return watermarks
+
+    def _write(self, registrations, streams, watermarks, forgotten):
+        with self._db:
+            self._db.execute("BEGIN")
+            for account_id in forgotten:
+                self._db.execute("DELETE FROM streams WHERE account_id = ?", (account_id,))
+                self._db.execute("DELETE FROM watermarks WHERE account_id = ?", (account_id,))
+
+            self._db.executemany(
+                "INSERT OR REPLACE INTO registrations (registry, account_id, entry) VALUES (?, ?, ?)",
+                [(registry, account_id, entry) for (registry, account_id), entry in registrations.items() if entry is not None],
+            )
+            self._db.executemany(
+                "DELETE FROM registrations WHERE registry = ? AND account_id = ?",
+                [key for key, entry in registrations.items() if entry is None],
+            )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO streams (account_id, stream, exchange, seq, updated_at, records) VALUES (?, ?, ?, ?, ?, ?)",
+                [(*key, *row) for key, row in streams.items() if row is not None],
+            )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO watermarks (account_id, exchange, currency, timestamp, ids) VALUES (?, ?, ?, ?, ?)",
+                [(*key, *row) for key, row in watermarks.items()],
+            )
+
+    def _compact(self):
+        self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    async def _in_thread(self, func, *args, on_done=None):
+        """Runs a database call off the event loop, after the previous one has finished."""
+        async with self._db_lock:
+            if self._db_call and not self._db_call.done():
+                await asyncio.wait({self._db_call})
+
+            call = self._db_call = asyncio.ensure_future(asyncio.to_thread(func, *args))
+            if on_done:
+                call.add_done_callback(on_done)
+            return await asyncio.shield(call)
+
+    def _restore(self, registrations, streams, watermarks, forgotten):
+        """Puts back the writes of a failed flush under those recorded since; accounts forgotten since stay forgotten."""
+        later = set(self._forgotten)
+        self._registrations = {**registrations, **self._registrations}
+        self._streams = {**{key: row for key, row in streams.items() if key[0] not in later}, **self._streams}
+        self._watermarks = {**{key: row for key, row in watermarks.items() if key[0] not in later}, **self._watermarks}
+        self._forgotten = forgotten + self._forgotten
+
+    async def flush(self):
+        if not (self._registrations or self._streams or self._watermarks or self._forgotten):
+            return
+
+        registrations, self._registrations = self._registrations, {}
+        streams, self._streams = self._streams, {}
+        watermarks, self._watermarks = self._watermarks, {}
+        forgotten, self._forgotten = self._forgotten, []
+
+        def written(call: asyncio.Future):
+            if call.exception() is not None:
+                self._restore(registrations, streams, watermarks, forgotten)
+                return
+            self._flushes += 1
+            self._written += len(registrations) + len(streams) + len(watermarks) + len(forgotten)
+
+        await self._in_thread(self._write, registrations, streams, watermarks, forgotten, on_done=written)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+
+                if time.monotonic() - self._last_compaction >= self.compact_interval:
+                    await self._in_thread(self._compact)
+                    self._last_compaction = time.monotonic()
+            except Exception as e:
+                logger.error(f"Journal flush failed: {e}")
+
+    def start(self):
+        if not self._flusher:
+            self._flusher = asyncio.create_task(self._flush_loop(), name="journal-flusher")
+
+    async def stop(self):
+        if self._flusher:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+
+        # Waits for a write still running from the cancelled flusher before the last flush
+        await self.flush()
+        await self._in_thread(self._compact)
+        self._db.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._registrations) + len(self._streams) + len(self._watermarks) + len(self._forgotten),
+            "flushes": self._flushes,
+            "written": self._written,
+        }
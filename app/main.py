@@ -1,51 +1,315 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+import os
+import socket
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Union
+from fastapi import FastAPI, HTTPException, Response
 from contextlib import asynccontextmanager
 from app.nats_publisher import nats_publisher
-from app.utils.queue import TaskQueue
+from app.delta_publisher import delta_publisher
+from app.snapshot_store import snapshot_store
+from app.stream_health import stream_health
+from app.activity_tracker import activity_tracker
+from app.ccxt.adapter_pool import adapter_pool
+from app.ccxt.market_cache import market_cache
+from app.ccxt.rate_limiter import rate_limiter
+from app.credentials import credentials_cache
+from app import metrics
+from app.utils.queue import TaskQueue, OVERFLOW_DROP_OLDEST
 from app.task_scheduler import TaskScheduler
 from app.worker_pool import WorkerPool
-from app.task_handler import FetchTaskHandler
-from app.type_defs import ListenRequest
+from app.process_pool import ProcessWorkerPool
+from app.task_handler import FetchTaskHandler, exchange_of
+from app.type_defs import BulkListenRequest, BulkStopRequest, ListenRequest, SnapshotBatchRequest
 from app.ws_handler import WebsocketHandler
+from app.registry_sync import RegistrySync
+from app.journal import Journal
+from app.watermarks import watermarks
+from app.sharding import FileMembership, MemoryMembership, MembershipBackend, NatsKVMembership, ShardCoordinator
 from app.account_registry import POLLING_ACCOUNTS, STREAMING_ACCOUNTS
+from app.utils.ramp import ramp
 from app.utils.logging import get_logger
 
 logger = get_logger("balance_listener_service")
 
-# Shared async queue for the scheduler and worker instances
-TASK_QUEUE = TaskQueue()
+# Shared async queue for the scheduler and worker instances. Holds at most one pending
+# task per account; when full, the oldest task is dropped and picked up on its next interval
+TASK_QUEUE = TaskQueue(maxsize=100_000, overflow=OVERFLOW_DROP_OLDEST)
+
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+# Fetch tasks run in this many worker processes; 0 keeps them on the main event loop
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "0"))
+
+# "memory" runs a single instance; "file" or "nats" share accounts between instances
+SHARD_BACKEND = os.getenv("SHARD_BACKEND", "memory")
+
+# Registrations and last published states survive restarts here; empty disables the journal
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "data/journal.sqlite3")
+
+# Window over which first fetches and stream connects of bulk registrations and of a restart are spread
+RAMP_SECONDS = float(os.getenv("RAMP_SECONDS", "60"))
 
 scheduler: TaskScheduler = None
-worker_pool: WorkerPool = None
+worker_pool: Union[WorkerPool, ProcessWorkerPool] = None
 ws_handler: WebsocketHandler = None
+registry_sync: RegistrySync = None
+journal: Optional[Journal] = None
+# Background ramps of bulk registrations still in progress
+ramps: Set[asyncio.Task] = set()
+
+
+def _membership_backend() -> MembershipBackend:
+    if SHARD_BACKEND == "file":
+        return FileMembership(os.getenv("SHARD_MEMBERS_FILE", "/tmp/balance-listener-members.json"))
+    if SHARD_BACKEND == "nats":
+        return NatsKVMembership(nats_publisher)
+    return MemoryMembership()
+
+
+def _release_if_unused(account_id: str):
+    if (account_id not in POLLING_ACCOUNTS and account_id not in STREAMING_ACCOUNTS) or not shard.owns(account_id):
+        delta_publisher.forget(account_id)
+        if isinstance(worker_pool, ProcessWorkerPool):
+            # Polled accounts' stream state lives in the worker processes
+            worker_pool.forget(account_id)
+        snapshot_store.remove(account_id)
+        watermarks.forget(account_id)
+        metrics.forget_account(account_id)
+
+
+async def _on_shard_change():
+    if scheduler:
+        scheduler.rebalance()
+    if ws_handler:
+        await ws_handler.rebalance()
+
+    for account_id in set(POLLING_ACCOUNTS) | set(STREAMING_ACCOUNTS):
+        _release_if_unused(account_id)
+
+
+async def _on_credentials_rotated(account_id: str):
+    # Pooled adapters and open streams still sign with the old key
+    await adapter_pool.invalidate(account_id)
+    if ws_handler:
+        await ws_handler.reconnect(account_id)
+
+
+async def _apply_registration(registry: str, account_id: str, entry: Optional[dict], connect: bool = True):
+    """
+    Start or stop local work for a registry change made here or on another instance.
+    With `connect` off, new streams are left for the caller to connect.
+    """
+    if journal:
+        journal.record_registration(registry, account_id, entry)
+
+    if not scheduler or not ws_handler:
+        # Still starting up; start() picks up everything in the registries
+        return
+
+    if registry == "poll":
+        if entry is not None:
+            scheduler.schedule_account(account_id)
+        else:
+            scheduler.unschedule_account(account_id)
+    else:
+        if entry is not None:
+            if connect:
+                await ws_handler.watch_account(account_id)
+        elif account_id in ws_handler.connections:
+            await ws_handler.unwatch_account(account_id)
+
+    _release_if_unused(account_id)
+
+
+async def _register(registry: str, account_id: str, entry: Optional[dict]):
+    accounts = POLLING_ACCOUNTS if registry == "poll" else STREAMING_ACCOUNTS
+    if entry is None:
+        accounts.pop(account_id, None)
+    else:
+        accounts[account_id] = entry
+
+    await _apply_registration(registry, account_id, entry)
+    if registry_sync:
+        await registry_sync.announce(registry, account_id, entry)
+
+
+def _start_ramp(name: str, account_ids: List[str], action: Callable[[str], Awaitable[None]], window: float):
+    if not account_ids:
+        return
+
+    task = asyncio.create_task(ramp(account_ids, action, window), name=name)
+    ramps.add(task)
+    task.add_done_callback(ramps.discard)
+
+
+async def _initial_fetch(account_id: str):
+    # Ramps run late; skip accounts deregistered in the meantime
+    if account_id in POLLING_ACCOUNTS:
+        await scheduler.enqueue_account(account_id, scheduler.account_types(account_id))
+
+
+async def _connect(account_id: str):
+    if account_id in STREAMING_ACCOUNTS:
+        await ws_handler.watch_account(account_id)
+
+
+async def _apply_batch(registry: str, entries: Dict[str, Optional[dict]], ramp_seconds: float):
+    """Apply many registry changes; first fetches or stream connects are spread over `ramp_seconds`."""
+    for account_id, entry in entries.items():
+        await _apply_registration(registry, account_id, entry, connect=False)
+
+    if not scheduler or not ws_handler:
+        return
+
+    added = [account_id for account_id, entry in entries.items() if entry is not None]
+    if registry == "poll":
+        _start_ramp("poll-ramp", added, _initial_fetch, ramp_seconds)
+    else:
+        _start_ramp("stream-ramp", added, _connect, ramp_seconds)
+
+
+async def _register_batch(registry: str, entries: Dict[str, Optional[dict]], ramp_seconds: float):
+    # The registry changes in one step, before anything awaits, so no request or peer sees half a batch
+    accounts = POLLING_ACCOUNTS if registry == "poll" else STREAMING_ACCOUNTS
+    for account_id, entry in entries.items():
+        if entry is None:
+            accounts.pop(account_id, None)
+        else:
+            accounts[account_id] = entry
+
+    await _apply_batch(registry, entries, ramp_seconds)
+    if registry_sync:
+        await registry_sync.announce_batch(registry, entries, ramp_seconds)
+
+
+shard = ShardCoordinator(INSTANCE_ID, _membership_backend(), on_change=_on_shard_change)
+
+
+def _restore_registrations():
+    for registry, accounts in journal.load_registrations().items():
+        target = POLLING_ACCOUNTS if registry == "poll" else STREAMING_ACCOUNTS
+        for account_id, entry in accounts.items():
+            target.setdefault(account_id, entry)
+
+    for account_id, rows in journal.load_watermarks().items():
+        watermarks.restore(account_id, rows)
+
+
+async def _restore_streams():
+    """Reload last published states in batches, yielding to the loop between them."""
+    started = time.monotonic()
+    restored = 0
+    in_processes = isinstance(worker_pool, ProcessWorkerPool)
+    for rows in journal.iter_streams():
+        handoff = []
+        for account_id, stream, exchange, seq, updated_at, records in rows:
+            if not shard.owns(account_id):
+                continue
+
+            if in_processes and not stream.endswith("_ws"):
+                # Polled streams are published by the worker processes
+                handoff.append((account_id, stream, exchange, seq, records))
+            else:
+                delta_publisher.restore(stream, exchange, account_id, records, seq)
+            fetch_type, source = (stream[:-len("_ws")], "ws") if stream.endswith("_ws") else (stream, "rest")
+            snapshot_store.restore(account_id, exchange, fetch_type, records, source, updated_at)
+            restored += 1
+
+        if handoff:
+            worker_pool.restore(handoff)
+        await asyncio.sleep(0)
+
+    logger.info(f"Restored {restored} stream states from the journal in {time.monotonic() - started:.2f}s")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global scheduler, worker_pool, ws_handler
+    global scheduler, worker_pool, ws_handler, registry_sync, journal
 
     logger.info("Starting Balance Aggregator app")
 
-    scheduler = TaskScheduler(POLLING_ACCOUNTS, TASK_QUEUE)
-    await scheduler.start()
+    if JOURNAL_PATH:
+        journal = Journal(JOURNAL_PATH)
+        _restore_registrations()
+        delta_publisher.journal = journal
+        watermarks.journal = journal
+        journal.start()
+        logger.info(f"Restored {len(POLLING_ACCOUNTS)} polling and {len(STREAMING_ACCOUNTS)} streaming accounts")
 
-    task_handler = FetchTaskHandler()
-    worker_pool = WorkerPool(TASK_QUEUE, task_handler, worker_count=4)
-    await worker_pool.start()
+    await market_cache.start()
+    await adapter_pool.start()
+    credentials_cache.on_rotate = _on_credentials_rotated
+    credentials_cache.start()
 
     await nats_publisher.connect()
+    await delta_publisher.start()
+
+    await shard.start()
+    if SHARD_BACKEND != "memory":
+        registry_sync = RegistrySync(nats_publisher, INSTANCE_ID, _apply_registration, _apply_batch)
+        await registry_sync.start()
+
+    if WORKER_PROCESSES > 0:
+        worker_pool = ProcessWorkerPool(
+            TASK_QUEUE,
+            processes=WORKER_PROCESSES,
+            max_inflight=int(os.getenv("WORKER_PROCESS_INFLIGHT", "64")),
+        )
+    else:
+        max_workers = int(os.getenv("MAX_WORKERS", "256"))
+        worker_pool = WorkerPool(
+            TASK_QUEUE,
+            FetchTaskHandler(),
+            min_workers=int(os.getenv("MIN_WORKERS", "4")),
+            max_workers=max_workers,
+            exchange_of=exchange_of,
+            # No single exchange may hold more than half of the workers
+            default_exchange_concurrency=max(1, max_workers // 2),
+        )
+    if isinstance(worker_pool, ProcessWorkerPool):
+        worker_pool.journal = journal
+        delta_publisher.forward = worker_pool.request_snapshot
+    await worker_pool.start()
+
+    # The worker processes take the restored states of polled streams, so they start first
+    restore_task = asyncio.create_task(_restore_streams()) if journal else None
+
+    scheduler = TaskScheduler(
+        POLLING_ACCOUNTS,
+        TASK_QUEUE,
+        activity=activity_tracker,
+        max_tasks_per_second=500,
+        stream_health=stream_health,
+        shard=shard,
+    )
+    await scheduler.start()
 
-    ws_handler = WebsocketHandler()
-    await ws_handler.start()
+    ws_handler = WebsocketHandler(shard=shard)
+    # Restored streams reconnect gradually instead of all at once
+    await ws_handler.start(ramp_seconds=RAMP_SECONDS if journal else 0.0)
 
     yield
 
     logger.info("Shutting down Balance Aggregator app")
-    
+
+    # Leave the ring first so peers take over this shard
+    await shard.stop()
+    for task in list(ramps):
+        task.cancel()
+    await asyncio.gather(*ramps, return_exceptions=True)
     await scheduler.stop()
     await worker_pool.stop()
-    await nats_publisher.disconnect()
     await ws_handler.stop()
+    if restore_task:
+        restore_task.cancel()
+        await asyncio.gather(restore_task, return_exceptions=True)
+    if journal:
+        await journal.stop()
+    await nats_publisher.disconnect()
+    await credentials_cache.stop()
+    await adapter_pool.stop()
+    await market_cache.stop()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -53,20 +317,20 @@ app = FastAPI(lifespan=lifespan)
 
 @app.post("/poll/start")
 async def start_polling(req: ListenRequest):
-    global scheduler
-
     key = req.account_id
     if key in POLLING_ACCOUNTS:
         logger.warning(f"Already listening for account[{req.account_id}]")
 
-    POLLING_ACCOUNTS[key] = req.model_dump()
+    await _register("poll", key, req.model_dump())
+
+    # Hybrid accounts also stream; polling then only covers what the stream does not
+    if req.mode == "hybrid" and key not in STREAMING_ACCOUNTS:
+        await _register("stream", key, req.model_dump())
 
     logger.info(f"Monitoring balance of account[{req.account_id}]")
-    await scheduler.enqueue_account(
-        req.account_id, ["balance", "earn_balance", "positions", "option_positions", "funding_fees"]
-    )
+    await _initial_fetch(req.account_id)
 
-    return {"status": "ok", "listening_key": key}
+    return {"status": "ok", "listening_key": key, "instance": shard.ring.owner(key)}
 
 
 @app.post("/poll/stop")
@@ -76,37 +340,133 @@ async def stop_polling(req: ListenRequest):
         raise HTTPException(status_code=404, detail="Not found")
 
     logger.info(f"Stopping to monitor balance of account[{req.account_id}]")
-    del POLLING_ACCOUNTS[key]
+
+    # Streams started by hybrid mode end with it
+    if (STREAMING_ACCOUNTS.get(key) or {}).get("mode") == "hybrid":
+        await _register("stream", key, None)
+
+    await _register("poll", key, None)
     return {"status": "stopped", "listening_key": key}
 
 
+@app.post("/poll/start/batch")
+async def start_polling_batch(req: BulkListenRequest):
+    entries = {account.account_id: account.model_dump() for account in req.accounts}
+    window = RAMP_SECONDS if req.ramp_seconds is None else req.ramp_seconds
+
+    # Hybrid accounts also stream; existing streams are kept as they are
+    streams = {key: entry for key, entry in entries.items() if entry["mode"] == "hybrid" and key not in STREAMING_ACCOUNTS}
+
+    logger.info(f"Monitoring balance of {len(entries)} accounts, ramping over {window}s")
+    await _register_batch("poll", entries, window)
+    await _register_batch("stream", streams, window)
+
+    return {"status": "ok", "accounts": len(entries), "streams": len(streams), "ramp_seconds": window}
+
+
+@app.post("/poll/stop/batch")
+async def stop_polling_batch(req: BulkStopRequest):
+    keys = [key for key in req.account_ids if key in POLLING_ACCOUNTS]
+    streams = [key for key in keys if (STREAMING_ACCOUNTS.get(key) or {}).get("mode") == "hybrid"]
+
+    logger.info(f"Stopping to monitor balance of {len(keys)} accounts")
+    await _register_batch("stream", dict.fromkeys(streams), 0.0)
+    await _register_batch("poll", dict.fromkeys(keys), 0.0)
+
+    found = set(keys)
+    return {"status": "stopped", "accounts": len(keys), "not_found": [key for key in req.account_ids if key not in found]}
+
+
 @app.post("/stream/start")
 async def start_streaming(req: ListenRequest):
-    global ws_handler
-
     key = req.account_id
     if key in STREAMING_ACCOUNTS:
         logger.warning(f"Already streaming for account[{req.account_id}]")
 
-    STREAMING_ACCOUNTS[key] = req.model_dump()
-
     logger.info(f"Streaming balance of account[{req.account_id}]")
-    await ws_handler.watch_account(req.account_id)
+    await _register("stream", key, req.model_dump())
 
-    return {"status": "ok", "listening_key": req.account_id}
+    return {"status": "ok", "listening_key": req.account_id, "instance": shard.ring.owner(key)}
 
 
 @app.post("/stream/stop")
 async def stop_streaming(req: ListenRequest):
-    global ws_handler
-
     key = req.account_id
     if key not in STREAMING_ACCOUNTS:
         raise HTTPException(status_code=404, detail="Not found")
 
     logger.info(f"Stopping to stream balance of account[{req.account_id}]")
-    await ws_handler.unwatch_account(req.account_id)
+    await _register("stream", key, None)
 
-    del STREAMING_ACCOUNTS[key]
-    
     return {"status": "stopped", "listening_key": req.account_id}
+
+
+@app.post("/stream/start/batch")
+async def start_streaming_batch(req: BulkListenRequest):
+    entries = {account.account_id: account.model_dump() for account in req.accounts}
+    window = RAMP_SECONDS if req.ramp_seconds is None else req.ramp_seconds
+
+    logger.info(f"Streaming balance of {len(entries)} accounts, ramping over {window}s")
+    await _register_batch("stream", entries, window)
+
+    return {"status": "ok", "accounts": len(entries), "ramp_seconds": window}
+
+
+@app.post("/stream/stop/batch")
+async def stop_streaming_batch(req: BulkStopRequest):
+    keys = [key for key in req.account_ids if key in STREAMING_ACCOUNTS]
+
+    logger.info(f"Stopping to stream balance of {len(keys)} accounts")
+    await _register_batch("stream", dict.fromkeys(keys), 0.0)
+
+    found = set(keys)
+    return {"status": "stopped", "accounts": len(keys), "not_found": [key for key in req.account_ids if key not in found]}
+
+
+@app.get("/stats")
+async def get_stats():
+    return {
+        "adapter_pool": adapter_pool.stats(),
+        "credentials": credentials_cache.stats(),
+        "market_cache": market_cache.stats(),
+        "rate_limiter": rate_limiter.stats(),
+        "scheduler": scheduler.stats(),
+        "activity": activity_tracker.stats(),
+        "delta_publisher": delta_publisher.stats(),
+        "nats_publisher": nats_publisher.stats(),
+        "journal": journal.stats() if journal else None,
+        "watermarks": watermarks.stats(),
+        "shard": shard.stats(),
+        "snapshot_store": snapshot_store.stats(),
+        "stream_health": stream_health.stats(),
+        "task_queue": TASK_QUEUE.stats(),
+        "workers": worker_pool.stats(),
+        "websockets": ws_handler.stats(),
+    }
+
+
+@app.get("/metrics")
+async def get_metrics():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/snapshots/{account_id}")
+async def get_snapshot(account_id: str):
+    snapshot = snapshot_store.get(account_id)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    return snapshot
+
+
+@app.post("/snapshots/batch")
+async def get_snapshots(req: SnapshotBatchRequest):
+    return snapshot_store.get_many(req.account_ids)
+
+
+@app.get("/totals/{fetch_type}")
+async def get_totals(fetch_type: str):
+    totals = snapshot_store.totals(fetch_type)
+    if totals is None:
+        raise HTTPException(status_code=404, detail=f"No totals for {fetch_type}")
+    return {"fetch_type": fetch_type, "totals": totals}
@@ -0,0 +1,83 @@
+import os
+import time
+from typing import Dict, Set, Tuple
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+# Per-account series multiply with the number of accounts, so they are opt-in
+PER_ACCOUNT = os.getenv("METRICS_PER_ACCOUNT", "").lower() in ("1", "true", "yes")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+BYTES_BUCKETS = (128, 512, 2048, 8192, 32768, 131072, 524288)
+
+QUEUE_DEPTH = Gauge("task_queue_depth", "Fetch tasks waiting in the queue", multiprocess_mode="livesum")
+QUEUE_WAIT = Histogram("task_queue_wait_seconds", "Time from enqueue to pickup of a fetch task", buckets=WAIT_BUCKETS)
+QUEUE_DROPS = Counter("task_queue_drops_total", "Fetch tasks dropped because the queue was full")
+
+TASK_LATENCY = Histogram(
+    "fetch_task_seconds", "Fetch and publish time per exchange and fetch type", ["exchange", "fetch_type"], buckets=LATENCY_BUCKETS
+)
+TASK_ERRORS = Counter("fetch_task_errors_total", "Failed fetches per exchange and fetch type", ["exchange", "fetch_type"])
+
+CCXT_LATENCY = Histogram("ccxt_call_seconds", "ccxt call latency per exchange and method", ["exchange", "method"], buckets=LATENCY_BUCKETS)
+CCXT_ERRORS = Counter("ccxt_call_errors_total", "Failed ccxt calls per exchange, method and error class", ["exchange", "method", "error"])
+
+NATS_PUBLISH_LATENCY = Histogram("nats_publish_seconds", "Encode and publish time per message", ["stream"], buckets=LATENCY_BUCKETS)
+NATS_PUBLISH_BYTES = Histogram("nats_publish_bytes", "Payload size per published message", ["stream"], buckets=BYTES_BUCKETS)
+
+WS_MESSAGES = Counter("ws_updates_total", "Websocket updates per exchange and stream type", ["exchange", "stream"])
+WS_UPDATE_GAP = Histogram(
+    "ws_update_gap_seconds", "Time between consecutive updates of one account stream", ["exchange", "stream"], buckets=WAIT_BUCKETS
+)
+
+SCHEDULER_LAG = Gauge("scheduler_lag_seconds", "Delay of the last time wheel tick", multiprocess_mode="max")
+
+ACCOUNT_LAST_FETCH = Gauge(
+    "account_last_fetch_timestamp_seconds", "Last successful fetch per account (METRICS_PER_ACCOUNT)",
+    ["account_id", "fetch_type"], multiprocess_mode="max",
+)
+ACCOUNT_LAST_WS_UPDATE = Gauge(
+    "account_last_ws_update_timestamp_seconds", "Last websocket update per account (METRICS_PER_ACCOUNT)",
+    ["account_id", "stream"], multiprocess_mode="max",
+)
+
+# account_id -> label sets of its per-account series, removed when the account goes away
+_account_series: Dict[str, Set[Tuple[Gauge, Tuple[str, ...]]]] = {}
+
+
+def _set_account(gauge: Gauge, account_id: str, label: str):
+    gauge.labels(account_id, label).set(time.time())
+    _account_series.setdefault(account_id, set()).add((gauge, (account_id, label)))
+
+
+def record_fetch(account_id: str, fetch_type: str):
+    if PER_ACCOUNT:
+        _set_account(ACCOUNT_LAST_FETCH, account_id, fetch_type)
+
+
+def record_ws_update(account_id: str, stream: str):
+    if PER_ACCOUNT:
+        _set_account(ACCOUNT_LAST_WS_UPDATE, account_id, stream)
+
+
+def forget_account(account_id: str):
+    for gauge, labels in _account_series.pop(account_id, ()):
+        try:
+            gauge.remove(*labels)
+        except KeyError:
+            pass
+
+
+def process_exited(pid: int):
+    """Drop the live gauges of a stopped worker process from the multiprocess aggregation."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
+
+
+def render() -> Tuple[bytes, str]:
+    """Exposition of all metrics; with PROMETHEUS_MULTIPROC_DIR set, aggregated over worker processes."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
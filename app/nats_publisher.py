@@ -1,40 +1,226 @@
 import json
+import os
 import asyncio
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Tuple
 from nats.aio.client import Client as NATS
+from app.metrics import NATS_PUBLISH_BYTES, NATS_PUBLISH_LATENCY
 from app.utils.logging import get_logger
 
 logger = get_logger("nats_publisher")
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional dependency
+    msgpack = None
+
+
+def _json_dumps(data: Any) -> bytes:
+    return json.dumps(data).encode()
+
+
+def _orjson_dumps(data: Any) -> bytes:
+    return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+
+def _msgpack_dumps(data: Any) -> bytes:
+    return msgpack.packb(data, use_bin_type=True, default=str)
+
+
+def _json_loads(payload: bytes) -> Any:
+    return json.loads(payload)
+
+
+def _msgpack_loads(payload: bytes) -> Any:
+    return msgpack.unpackb(payload, raw=False)
+
+
+# encoding -> (Content-Type header, encoder)
+ENCODINGS: Dict[str, Tuple[str, Callable[[Any], bytes]]] = {
+    "json": ("application/json", _json_dumps),
+    "orjson": ("application/json", _orjson_dumps),
+    "msgpack": ("application/msgpack", _msgpack_dumps),
+}
+
+# Content-Type header -> decoder
+DECODERS: Dict[str, Callable[[bytes], Any]] = {
+    "application/json": _json_loads,
+    "application/msgpack": _msgpack_loads,
+}
+
+
 class NatsPublisher:
-    def __init__(self, nats_url="nats://0.0.0.0:4222"):
+    """
+    Publishes dict payloads to NATS. In buffered mode `publish()` only appends to a bounded
+    outbox and returns; a background flusher encodes and writes the messages in batches,
+    either once `flush_batch` messages are waiting or every `flush_interval` seconds. While
+    the connection is reconnecting messages stay in the outbox, and when it is full the
+    oldest messages are dropped so publishers never block.
+    """
+
+    def __init__(
+        self,
+        nats_url="nats://0.0.0.0:4222",
+        encoding: str = "json",
+        buffered: bool = False,
+        outbox_size: int = 100_000,
+        flush_batch: int = 500,
+        flush_interval: float = 0.05,
+    ):
         self.nats_url = nats_url
         self.nc = NATS()
         self.connected = False
         self._connect_lock = asyncio.Lock()
 
+        if (encoding == "orjson" and orjson is None) or (encoding == "msgpack" and msgpack is None):
+            logger.warning(f"{encoding} is not installed, falling back to json encoding")
+            encoding = "json"
+        self.encoding = encoding
+        self.content_type, self._encode = ENCODINGS[encoding]
+
+        self.buffered = buffered
+        self.flush_batch = flush_batch
+        self.flush_interval = flush_interval
+        self._outbox: Deque[Tuple[str, Any]] = deque(maxlen=outbox_size)
+        self._outbox_ready = asyncio.Event()
+        self._flusher: asyncio.Task = None
+
+        self._published = 0
+        self._bytes = 0
+        self._dropped = 0
+        self._failed = 0
+
     async def connect(self):
         async with self._connect_lock:
             if not self.connected:
-                await self.nc.connect(self.nats_url)
+                await self.nc.connect(self.nats_url, max_reconnect_attempts=-1)
                 self.connected = True
-                logger.info(f"Connected to {self.nats_url}")
+                logger.info(f"Connected to {self.nats_url} ({self.encoding} encoding)")
+
+            if self.buffered and (not self._flusher or self._flusher.done()):
+                self._flusher = asyncio.create_task(self._flush_loop(), name="nats-outbox-flusher")
 
     async def disconnect(self):
+        if self._flusher:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+
         if self.connected:
+            await self._flush_outbox()
             await self.nc.drain()
             self.connected = False
             logger.info("Disconnected")
 
+    async def subscribe(self, subject: str, cb):
+        if not self.connected:
+            await self.connect()
+
+        subscription = await self.nc.subscribe(subject, cb=cb)
+        logger.info(f"Subscribed to subject: {subject}")
+        return subscription
+
+    def decode(self, msg) -> Any:
+        """Payload of a message published by another instance, by its Content-Type header."""
+        content_type = (msg.headers or {}).get("Content-Type", "application/json")
+        return DECODERS.get(content_type, _json_loads)(msg.data or b"null")
+
+    async def request(self, subject: str, data: dict, timeout: float = 2.0) -> Any:
+        if not self.connected:
+            await self.connect()
+
+        payload = self._encode(data)
+        msg = await self.nc.request(subject, payload, timeout=timeout, headers={"Content-Type": self.content_type})
+        return self.decode(msg)
+
+    async def publish_direct(self, subject: str, data: Any, reply: str = ""):
+        """Publishes past the outbox, for control messages that must not be dropped; raises on failure."""
+        if not self.connected:
+            await self.connect()
+
+        payload = self._encode(data)
+        await self.nc.publish(subject, payload, reply=reply, headers={"Content-Type": self.content_type})
+        self._published += 1
+        self._bytes += len(payload)
+
     async def publish(self, subject: str, data: dict):
+        if self.buffered:
+            if len(self._outbox) == self._outbox.maxlen:
+                self._dropped += 1
+            self._outbox.append((subject, data))
+            if len(self._outbox) >= self.flush_batch:
+                self._outbox_ready.set()
+            return
+
         try:
             if not self.connected:
                 await self.connect()
 
-            payload = json.dumps(data).encode()
-            await self.nc.publish(subject, payload)
-            logger.info(f"Published message to subject: {subject}")
+            await self._send(subject, data)
+            logger.debug("Published message to subject: %s", subject)
 
         except Exception as e:
-            logger.warning(f"Failed to publish to {subject}: {e}")
+            self._failed += 1
+            logger.warning("Failed to publish to %s: %s", subject, e)
+
+    async def _send(self, subject: str, data: Any):
+        started = time.perf_counter()
+        payload = self._encode(data)
+        await self.nc.publish(subject, payload, headers={"Content-Type": self.content_type})
+        self._published += 1
+        self._bytes += len(payload)
+
+        stream = subject.split(".", 1)[0]
+        NATS_PUBLISH_LATENCY.labels(stream).observe(time.perf_counter() - started)
+        NATS_PUBLISH_BYTES.labels(stream).observe(len(payload))
+
+    async def _flush_outbox(self):
+        while self._outbox and self.nc.is_connected:
+            for _ in range(min(self.flush_batch, len(self._outbox))):
+                subject, data = self._outbox.popleft()
+                try:
+                    await self._send(subject, data)
+                except Exception as e:
+                    self._failed += 1
+                    logger.warning("Failed to publish to %s: %s", subject, e)
+
+            # Let workers and websocket loops run between batches
+            await asyncio.sleep(0)
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._outbox_ready.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._outbox_ready.clear()
+
+            if not self.nc.is_connected:
+                # Keep buffering until the client has reconnected
+                continue
+
+            await self._flush_outbox()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "encoding": self.encoding,
+            "buffered": self.buffered,
+            "outbox_depth": len(self._outbox),
+            "published": self._published,
+            "bytes": self._bytes,
+            "dropped": self._dropped,
+            "failed": self._failed,
+        }
+
 
-nats_publisher = NatsPublisher()
+nats_publisher = NatsPublisher(
+    os.getenv("NATS_URL", "nats://0.0.0.0:4222"),
+    encoding=os.getenv("NATS_ENCODING", "json"),
+    buffered=True,
+)
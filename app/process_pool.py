@@ -0,0 +1,404 @@
+import asyncio
+import itertools
+import multiprocessing
+import queue
+import time
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from app.activity_tracker import activity_tracker
+from app.metrics import process_exited
+from app.records import Record, from_values
+from app.snapshot_store import snapshot_store
+from app.utils.queue import TaskQueue, OVERFLOW_DROP_OLDEST
+from app.utils.logging import get_logger
+from app.watermarks import watermarks
+
+logger = get_logger("process_pool")
+
+# (exchange, fetch type, record kind, record values)
+CompactResult = Tuple[str, str, str, List[Tuple[Any, ...]]]
+# (stream, exchange, seq, record kind, record values)
+CompactState = Tuple[str, str, int, str, List[Tuple[Any, ...]]]
+# (account_id, stream, exchange, seq, records), as read from the journal
+StreamState = Tuple[str, str, str, int, List[Record]]
+
+# Seconds the main process waits for a worker process to answer a snapshot request
+SNAPSHOT_TIMEOUT = 5.0
+
+
+def _compact(records: Iterable[Record]) -> Tuple[str, List[Tuple[Any, ...]]]:
+    records = list(records)
+    return (records[0].kind if records else ""), [record.values() for record in records]
+
+
+class _JournalRelay:
+    """
+    Stands in for the journal inside a worker process: published stream states are sent back
+    with the task's results and journaled by the main process.
+    """
+
+    def __init__(self):
+        # account_id -> states published since its last result
+        self._states: Dict[str, List[CompactState]] = {}
+
+    def record_stream(self, account_id: str, stream: str, exchange: str, seq: int, records: Iterable[Record]):
+        kind, values = _compact(records)
+        self._states.setdefault(account_id, []).append((stream, exchange, seq, kind, values))
+
+    def forget_account(self, account_id: str):
+        self._states.pop(account_id, None)
+
+    def take(self, account_id: str) -> List[CompactState]:
+        return self._states.pop(account_id, [])
+
+
+def _child_main(index: int, generation: int, processes: int, concurrency: int, tasks, results):
+    """Entry point of a worker process: its own event loop, adapter pool and NATS connection."""
+    asyncio.run(_child_loop(index, generation, processes, concurrency, tasks, results))
+
+
+async def _child_loop(index: int, generation: int, processes: int, concurrency: int, tasks, results):
+    # Imported here so the modules (and their singletons) are created inside the child
+    from app.ccxt.adapter_pool import adapter_pool
+    from app.ccxt.market_cache import market_cache
+    from app.ccxt.rate_limiter import rate_limiter
+    from app.credentials import credentials_cache
+    from app.delta_publisher import delta_publisher
+    from app.nats_publisher import nats_publisher
+    from app.task_handler import FetchTaskHandler
+
+    child_logger = get_logger(f"process_worker[{index}]")
+    rate_limiter.share = 1 / processes
+    credentials_cache.on_rotate = adapter_pool.invalidate
+    relay = delta_publisher.journal = _JournalRelay()
+
+    await market_cache.start()
+    await adapter_pool.start()
+    credentials_cache.start()
+    # No delta_publisher.start(): snapshot requests reach this process through the main one
+    await nats_publisher.connect()
+
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(concurrency)
+    running = set()
+
+    async def handle(task: Dict[str, Any]):
+        account_id = task.get("account_id")
+        collected: List[CompactResult] = []
+
+        async def collect(account_id: str, exchange: str, fetch_type: str, records: List[Record], changed: bool):
+            kind, values = _compact(records)
+            collected.append((exchange, fetch_type, kind, values))
+
+        try:
+            await FetchTaskHandler(on_result=collect).process(task)
+        except Exception as e:
+            child_logger.warning(f"Task for {account_id} failed: {e}")
+        finally:
+            # Watermarks and published states go back with the results, to be journaled by the main process
+            results.put(("result", generation, account_id, collected, watermarks.export(account_id), relay.take(account_id)))
+            slots.release()
+
+    async def command(message: Dict[str, Any]):
+        name = message["command"]
+        if name == "forget":
+            delta_publisher.forget(message["account_id"])
+            watermarks.forget(message["account_id"])
+        elif name == "restore":
+            for account_id, stream, exchange, seq, kind, values in message["streams"]:
+                delta_publisher.restore(stream, exchange, account_id, [from_values(kind, value) for value in values], seq)
+        elif name == "snapshot":
+            published = await delta_publisher.request_snapshot(message["account_id"], message.get("stream"))
+            results.put(("snapshots", generation, message["request_id"], published))
+
+    child_logger.info("Worker process started")
+    try:
+        while True:
+            task = await loop.run_in_executor(None, tasks.get)
+            if task is None:
+                break
+
+            if "command" in task:
+                try:
+                    await command(task)
+                except Exception as e:
+                    child_logger.warning(f"Command {task['command']} failed: {e}")
+                continue
+
+            await slots.acquire()
+            job = asyncio.create_task(handle(task))
+            running.add(job)
+            job.add_done_callback(running.discard)
+    finally:
+        await asyncio.gather(*running, return_exceptions=True)
+        await nats_publisher.disconnect()
+        await credentials_cache.stop()
+        await adapter_pool.stop()
+        await market_cache.stop()
+        child_logger.info("Worker process stopped")
+
+
+class ProcessWorkerPool:
+    """
+    Runs fetch tasks in `processes` worker processes, each with its own event loop, adapter
+    pool and NATS publisher, so parsing, diffing and encoding use all cores. Tasks are routed
+    by account hash, which keeps an account's adapter and delta state in one process. At most
+    `max_inflight` tasks are outstanding per process and each process runs up to
+    `concurrency` of them at once. Results come back as plain value tuples and are stored
+    in the main process, which also journals the states the processes published.
+
+    The dispatcher hands tasks to a bounded, merging queue per process without waiting, and
+    one feeder per process waits for that process's slots, so a saturated process never
+    holds up the others. A process that dies, or holds tasks without finishing any for
+    `hang_timeout` seconds, is replaced and its slots are freed. Every process has its own
+    task and result queues, so terminating one cannot corrupt the queues of the others.
+
+    Account state kept by a process is reached through it: `forget`, `restore` and
+    `request_snapshot` are sent to the owning process ahead of its queued tasks.
+    """
+
+    def __init__(
+        self,
+        queue: TaskQueue,
+        processes: int = 4,
+        max_inflight: int = 64,
+        concurrency: int = 16,
+        hang_timeout: float = 300.0,
+        check_interval: float = 1.0,
+    ):
+        self.queue = queue
+        self.processes = processes
+        self.max_inflight = max_inflight
+        self.concurrency = concurrency
+        self.hang_timeout = hang_timeout
+        self.check_interval = check_interval
+        # When set, the stream states published by the processes are journaled
+        self.journal = None
+
+        self._context = multiprocessing.get_context("spawn")
+        self._workers: List[Optional[multiprocessing.Process]] = []
+        self._generations: List[int] = []
+        self._task_queues: List[Any] = []
+        self._routes: List[TaskQueue] = []
+        self._inflight: List[asyncio.Semaphore] = []
+        self._depth: List[int] = []
+        # Last time each process finished a task or went idle
+        self._progress: List[float] = []
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._feeders: List[asyncio.Task] = []
+        self._collectors: List[asyncio.Task] = []
+        self._watchdog: Optional[asyncio.Task] = None
+        self._stopping = False
+
+        # request id -> future resolved with the number of snapshots a process published
+        self._snapshot_requests: Dict[int, asyncio.Future] = {}
+        self._request_ids = itertools.count(1)
+
+        self._completed = 0
+        self._restarts = 0
+
+    def _route(self, account_id: str) -> int:
+        return zlib.crc32(account_id.encode()) % self.processes
+
+    def _spawn(self, index: int):
+        self._generations[index] += 1
+        generation = self._generations[index]
+        tasks = self._context.Queue()
+        results = self._context.Queue()
+        process = self._context.Process(
+            target=_child_main,
+            args=(index, generation, self.processes, self.concurrency, tasks, results),
+            name=f"process-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        self._workers[index] = process
+        self._task_queues[index] = tasks
+        self._progress[index] = time.monotonic()
+        self._collectors.append(
+            asyncio.create_task(self._collect_loop(index, generation, results), name=f"process-pool-collector-{index}")
+        )
+
+    async def start(self):
+        for index in range(self.processes):
+            self._workers.append(None)
+            self._generations.append(0)
+            self._task_queues.append(None)
+            self._progress.append(time.monotonic())
+            self._routes.append(TaskQueue(maxsize=self.max_inflight, overflow=OVERFLOW_DROP_OLDEST, track_metrics=False))
+            self._inflight.append(asyncio.Semaphore(self.max_inflight))
+            self._depth.append(0)
+            self._spawn(index)
+
+        self._dispatcher = asyncio.create_task(self._dispatch_loop(), name="process-pool-dispatcher")
+        self._feeders = [
+            asyncio.create_task(self._feed_loop(index), name=f"process-pool-feeder-{index}")
+            for index in range(self.processes)
+        ]
+        self._watchdog = asyncio.create_task(self._watch_loop(), name="process-pool-watchdog")
+        logger.info(f"Started {self.processes} worker processes")
+
+    async def stop(self):
+        for task in [self._watchdog, self._dispatcher, *self._feeders]:
+            if task:
+                task.cancel()
+        await asyncio.gather(*[task for task in [self._watchdog, self._dispatcher, *self._feeders] if task], return_exceptions=True)
+        self._feeders.clear()
+
+        for tasks in self._task_queues:
+            tasks.put(None)
+
+        loop = asyncio.get_running_loop()
+        for process in self._workers:
+            await loop.run_in_executor(None, process.join, 10)
+            if process.is_alive():
+                process.terminate()
+            process_exited(process.pid)
+
+        # Collectors return once their queue is drained
+        self._stopping = True
+        await asyncio.gather(*self._collectors, return_exceptions=True)
+        self._collectors.clear()
+
+        self._workers.clear()
+        self._task_queues.clear()
+        logger.info("Worker processes stopped")
+
+    def _send(self, account_id: str, command: Dict[str, Any]):
+        """Control messages skip the route queue, which merges and drops tasks."""
+        self._task_queues[self._route(account_id)].put(command)
+
+    def forget(self, account_id: str):
+        self._send(account_id, {"command": "forget", "account_id": account_id})
+
+    def restore(self, states: Iterable[StreamState]):
+        """Journaled stream states, handed to the processes that own their accounts."""
+        by_process: Dict[int, List[Tuple[Any, ...]]] = {}
+        for account_id, stream, exchange, seq, records in states:
+            kind, values = _compact(records)
+            by_process.setdefault(self._route(account_id), []).append((account_id, stream, exchange, seq, kind, values))
+
+        for index, streams in by_process.items():
+            self._task_queues[index].put({"command": "restore", "streams": streams})
+
+    async def request_snapshot(self, account_id: str, stream: Optional[str] = None) -> int:
+        """Has the owning process publish snapshots of the account's streams; returns how many it published."""
+        request_id = next(self._request_ids)
+        answer = self._snapshot_requests[request_id] = asyncio.get_running_loop().create_future()
+        try:
+            self._send(account_id, {"command": "snapshot", "account_id": account_id, "stream": stream, "request_id": request_id})
+            return await asyncio.wait_for(answer, SNAPSHOT_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Worker process did not answer the snapshot request for {account_id}")
+            return 0
+        finally:
+            self._snapshot_requests.pop(request_id, None)
+
+    async def _dispatch_loop(self):
+        while True:
+            task = await self.queue.get()
+            if not task:
+                continue
+
+            try:
+                # Never blocks: a full route drops its oldest task, which the scheduler re-enqueues
+                await self._routes[self._route(task["account_id"])].put(task)
+            finally:
+                await self.queue.task_done()
+
+    async def _feed_loop(self, index: int):
+        route = self._routes[index]
+        while True:
+            task = await route.get()
+            marks = watermarks.export(task["account_id"])
+            if marks:
+                task = {**task, "watermarks": marks}
+
+            await self._inflight[index].acquire()
+            if not self._depth[index]:
+                self._progress[index] = time.monotonic()
+            self._depth[index] += 1
+            self._task_queues[index].put(task)
+
+    async def _watch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.check_interval)
+            for index, process in enumerate(self._workers):
+                if process.is_alive():
+                    if not self._depth[index] or time.monotonic() - self._progress[index] < self.hang_timeout:
+                        continue
+                    logger.error(f"Worker process {index} finished no task in {self.hang_timeout:.0f}s, restarting it")
+                    process.terminate()
+                    await loop.run_in_executor(None, process.join, 5)
+                else:
+                    logger.error(f"Worker process {index} exited with code {process.exitcode}, restarting it")
+
+                process_exited(process.pid)
+                self._restarts += 1
+
+                # Tasks sent to the old process are lost; the scheduler enqueues them again
+                for _ in range(self._depth[index]):
+                    self._inflight[index].release()
+                self._depth[index] = 0
+                self._collectors = [collector for collector in self._collectors if not collector.done()]
+                self._spawn(index)
+
+    @staticmethod
+    def _receive(results) -> Optional[tuple]:
+        try:
+            return results.get(timeout=1.0)
+        except queue.Empty:
+            return None
+
+    async def _collect_loop(self, index: int, generation: int, results):
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await loop.run_in_executor(None, self._receive, results)
+            if message is None:
+                # A replaced process sends nothing more, and its queue may be broken
+                if self._stopping or generation != self._generations[index]:
+                    return
+                continue
+
+            try:
+                self._handle(index, generation, message)
+            except Exception as e:
+                logger.error(f"Failed to store results of worker process {index}: {e}")
+
+    def _handle(self, index: int, generation: int, message: tuple):
+        if message[0] == "snapshots":
+            _, _, request_id, published = message
+            answer = self._snapshot_requests.get(request_id)
+            if answer and not answer.done():
+                answer.set_result(published)
+            return
+
+        _, _, account_id, results, marks, states = message
+        # Slots of a replaced process were already freed when it was replaced
+        if generation == self._generations[index]:
+            self._depth[index] -= 1
+            self._inflight[index].release()
+            self._progress[index] = time.monotonic()
+        self._completed += 1
+
+        watermarks.restore(account_id, marks, record=True)
+        if self.journal:
+            for stream, exchange, seq, kind, values in states:
+                self.journal.record_stream(account_id, stream, exchange, seq, [from_values(kind, value) for value in values])
+
+        for exchange, fetch_type, kind, values in results:
+            records = [from_values(kind, value) for value in values]
+            snapshot_store.update(account_id, exchange, fetch_type, records, source="rest")
+            activity_tracker.observe(account_id, fetch_type, records)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "processes": self.processes,
+            "alive": sum(1 for process in self._workers if process.is_alive()),
+            "queue_depth": list(self._depth),
+            "backlog": [route.qsize() for route in self._routes],
+            "dropped": sum(route.stats()["drops"] for route in self._routes),
+            "restarts": self._restarts,
+            "completed": self._completed,
+        }
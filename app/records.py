@@ -0,0 +1,164 @@
+from typing import Any, Dict, Optional, Tuple
+
+
+def to_float(value: Any, default: Optional[float] = 0.0) -> Optional[float]:
+    if value is None or value == "":
+        return default
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class Record:
+    """
+    Compact, normalized result of an adapter fetch. Subclasses declare their fields in
+    `__slots__`; the raw exchange payload is only kept in `info` when the adapter was
+    created with `include_info=True`.
+    """
+
+    __slots__ = ()
+    kind = "record"
+    # Fields that only move when the account does something, unlike prices and PnL that
+    # move with the market; they drive the adaptive polling interval
+    stable: Tuple[str, ...] = ()
+
+    @property
+    def key(self) -> str:
+        raise NotImplementedError()
+
+    def values(self) -> Tuple[Any, ...]:
+        return tuple(getattr(self, name) for name in self.__slots__ if name != "info")
+
+    def stable_values(self) -> Tuple[Any, ...]:
+        return tuple(getattr(self, name) for name in self.stable)
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {name: getattr(self, name) for name in self.__slots__ if name != "info"}
+        if getattr(self, "info", None) is not None:
+            data["info"] = self.info
+        return data
+
+    def __eq__(self, other: Any) -> bool:
+        return type(self) is type(other) and self.values() == other.values()
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__ if name != "info")
+        return f"{type(self).__name__}({fields})"
+
+
+class BalanceRecord(Record):
+    __slots__ = ("currency", "free", "used", "total", "info")
+    kind = "balance"
+    stable = ("currency", "total")
+
+    def __init__(self, currency: str, free: float, used: float, total: float, info: Any = None):
+        self.currency = currency
+        self.free = free
+        self.used = used
+        self.total = total
+        self.info = info
+
+    @property
+    def key(self) -> str:
+        return self.currency
+
+
+class EarnPositionRecord(Record):
+    __slots__ = ("currency", "product", "amount", "apr", "rewards", "info")
+    kind = "earn_balance"
+    stable = ("currency", "product", "amount")
+
+    def __init__(self, currency: str, product: str, amount: float, apr: Optional[float] = None, rewards: Optional[float] = None, info: Any = None):
+        self.currency = currency
+        self.product = product
+        self.amount = amount
+        self.apr = apr
+        self.rewards = rewards
+        self.info = info
+
+    @property
+    def key(self) -> str:
+        return f"{self.product}:{self.currency}"
+
+
+class PositionRecord(Record):
+    __slots__ = (
+        "symbol",
+        "side",
+        "contract_type",
+        "contracts",
+        "contract_size",
+        "notional",
+        "entry_price",
+        "mark_price",
+        "unrealized_pnl",
+        "leverage",
+        "margin_mode",
+        "info",
+    )
+    kind = "positions"
+    stable = ("symbol", "side", "contracts", "entry_price")
+
+    def __init__(
+        self,
+        symbol: str,
+        side: Optional[str],
+        contract_type: str,
+        contracts: float,
+        contract_size: Optional[float] = None,
+        notional: Optional[float] = None,
+        entry_price: Optional[float] = None,
+        mark_price: Optional[float] = None,
+        unrealized_pnl: Optional[float] = None,
+        leverage: Optional[float] = None,
+        margin_mode: Optional[str] = None,
+        info: Any = None,
+    ):
+        self.symbol = symbol
+        self.side = side
+        # linear / inverse / option
+        self.contract_type = contract_type
+        self.contracts = contracts
+        self.contract_size = contract_size
+        self.notional = notional
+        self.entry_price = entry_price
+        self.mark_price = mark_price
+        self.unrealized_pnl = unrealized_pnl
+        self.leverage = leverage
+        self.margin_mode = margin_mode
+        self.info = info
+
+    @property
+    def key(self) -> str:
+        return f"{self.symbol}:{self.side or ''}"
+
+
+class FundingEventRecord(Record):
+    __slots__ = ("id", "symbol", "currency", "amount", "timestamp", "event_type", "info")
+    kind = "funding_fees"
+    stable = ("id",)
+
+    def __init__(self, id: str, symbol: Optional[str], currency: Optional[str], amount: float, timestamp: Optional[int], event_type: str = "funding", info: Any = None):
+        self.id = id
+        self.symbol = symbol
+        self.currency = currency
+        self.amount = amount
+        self.timestamp = timestamp
+        # funding / settlement / delivery / bankruptcy
+        self.event_type = event_type
+        self.info = info
+
+    @property
+    def key(self) -> str:
+        return self.id
+
+
+# Record kind -> class, to rebuild records from `values()` after crossing a process boundary
+RECORD_TYPES = {cls.kind: cls for cls in (BalanceRecord, EarnPositionRecord, PositionRecord, FundingEventRecord)}
+
+
+def from_values(kind: str, values: Tuple[Any, ...]) -> Record:
+    return RECORD_TYPES[kind](*values)
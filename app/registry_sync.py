@@ -0,0 +1,172 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional
+from app.account_registry import POLLING_ACCOUNTS, STREAMING_ACCOUNTS
+from app.nats_publisher import NatsPublisher
+from app.utils.logging import get_logger
+
+logger = get_logger("registry_sync")
+
+REGISTRY_UPDATE_SUBJECT = "registry.update"
+REGISTRY_SYNC_SUBJECT = "registry.sync"
+
+# Accounts per batch announcement or sync reply, keeping messages well under the NATS payload limit
+BATCH_CHUNK = 1000
+
+# Seconds to wait for the first sync reply, and between the chunks of one peer's reply
+SYNC_TIMEOUT = 2.0
+SYNC_CHUNK_TIMEOUT = 10.0
+
+REGISTRIES: Dict[str, Dict[str, dict]] = {
+    "poll": POLLING_ACCOUNTS,
+    "stream": STREAMING_ACCOUNTS,
+}
+
+# (registry, account_id, entry or None when removed)
+ChangeCallback = Callable[[str, str, Optional[dict]], Awaitable[None]]
+# (registry, account_id -> entry or None, ramp window in seconds)
+BatchCallback = Callable[[str, Dict[str, Optional[dict]], float], Awaitable[None]]
+
+
+class RegistrySync:
+    """
+    Keeps the account registries identical on every instance: local registrations are
+    broadcast on `registry.update`, and a starting instance copies the registries of a
+    running peer over `registry.sync`, sent back in chunks of `BATCH_CHUNK` accounts and an
+    end marker. Each instance then acts only on the accounts of its own shard. These
+    control messages bypass the publisher's outbox, which drops messages when full.
+    """
+
+    def __init__(self, publisher: NatsPublisher, instance_id: str, on_change: ChangeCallback, on_batch: BatchCallback):
+        self.publisher = publisher
+        self.instance_id = instance_id
+        self.on_change = on_change
+        self.on_batch = on_batch
+        self._received = 0
+
+    async def start(self):
+        await self.publisher.subscribe(REGISTRY_UPDATE_SUBJECT, self._on_update)
+        await self.publisher.subscribe(REGISTRY_SYNC_SUBJECT, self._on_sync_request)
+
+        try:
+            await self._sync()
+        except Exception as e:
+            logger.warning(f"Registry sync failed, starting with the local registry: {e}")
+
+    async def _sync(self):
+        replies: "asyncio.Queue[Any]" = asyncio.Queue()
+
+        async def on_reply(msg):
+            try:
+                replies.put_nowait(self.publisher.decode(msg))
+            except Exception as e:
+                logger.warning(f"Invalid registry sync reply: {e}")
+
+        inbox = self.publisher.nc.new_inbox()
+        subscription = await self.publisher.subscribe(inbox, on_reply)
+        try:
+            await self.publisher.publish_direct(REGISTRY_SYNC_SUBJECT, {"origin": self.instance_id}, reply=inbox)
+            try:
+                first = await asyncio.wait_for(replies.get(), SYNC_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.info("No peers answered the registry sync, starting with the local registry")
+                return
+
+            # Several peers may answer; the first one is copied and the others ignored
+            peer = first.get("origin")
+            chunks = 0
+            reply = first
+            while True:
+                if reply.get("origin") == peer:
+                    if reply.get("done"):
+                        break
+                    accounts = REGISTRIES[reply["registry"]]
+                    for account_id, entry in reply["entries"].items():
+                        accounts.setdefault(account_id, entry)
+                    chunks += 1
+                reply = await asyncio.wait_for(replies.get(), SYNC_CHUNK_TIMEOUT)
+        finally:
+            await subscription.unsubscribe()
+
+        if chunks != reply.get("chunks"):
+            logger.warning(f"Registry sync from {peer} incomplete: {chunks} of {reply.get('chunks')} chunks")
+        logger.info(f"Synced {len(POLLING_ACCOUNTS)} polling and {len(STREAMING_ACCOUNTS)} streaming accounts from {peer}")
+
+    async def _send(self, subject: str, message: dict):
+        try:
+            await self.publisher.publish_direct(subject, message)
+        except Exception as e:
+            logger.error(f"Failed to send registry message on {subject}: {e}")
+
+    async def announce(self, registry: str, account_id: str, entry: Optional[dict]):
+        await self._send(REGISTRY_UPDATE_SUBJECT, {
+            "origin": self.instance_id,
+            "registry": registry,
+            "account_id": account_id,
+            "entry": entry,
+        })
+
+    async def announce_batch(self, registry: str, entries: Dict[str, Optional[dict]], ramp_seconds: float):
+        account_ids = list(entries)
+        for start in range(0, len(account_ids), BATCH_CHUNK):
+            await self._send(REGISTRY_UPDATE_SUBJECT, {
+                "origin": self.instance_id,
+                "registry": registry,
+                "entries": {account_id: entries[account_id] for account_id in account_ids[start:start + BATCH_CHUNK]},
+                "ramp_seconds": ramp_seconds,
+            })
+
+    async def _on_update(self, msg):
+        try:
+            update = self.publisher.decode(msg)
+            if update.get("origin") == self.instance_id:
+                return
+
+            if "entries" in update:
+                await self._apply_batch(update["registry"], update["entries"], update.get("ramp_seconds") or 0.0)
+                return
+
+            registry, account_id, entry = update["registry"], update["account_id"], update.get("entry")
+            if entry is None:
+                REGISTRIES[registry].pop(account_id, None)
+            else:
+                REGISTRIES[registry][account_id] = entry
+            self._received += 1
+
+            await self.on_change(registry, account_id, entry)
+        except Exception as e:
+            logger.warning(f"Invalid registry update: {e}")
+
+    async def _apply_batch(self, registry: str, entries: Dict[str, Optional[dict]], ramp_seconds: float):
+        accounts = REGISTRIES[registry]
+        for account_id, entry in entries.items():
+            if entry is None:
+                accounts.pop(account_id, None)
+            else:
+                accounts[account_id] = entry
+        self._received += len(entries)
+
+        await self.on_batch(registry, entries, ramp_seconds)
+
+    async def _on_sync_request(self, msg):
+        try:
+            request = self.publisher.decode(msg) or {}
+        except Exception:
+            request = {}
+
+        if request.get("origin") == self.instance_id or not msg.reply:
+            return
+
+        chunks = 0
+        for registry, accounts in REGISTRIES.items():
+            items = list(accounts.items())
+            for start in range(0, len(items), BATCH_CHUNK):
+                await self._send(msg.reply, {
+                    "origin": self.instance_id,
+                    "registry": registry,
+                    "entries": dict(items[start:start + BATCH_CHUNK]),
+                })
+                chunks += 1
+        await self._send(msg.reply, {"origin": self.instance_id, "done": True, "chunks": chunks})
+
+    def stats(self) -> Dict[str, int]:
+        return {"updates_received": self._received}
@@ -0,0 +1,241 @@
+import asyncio
+import bisect
+import fcntl
+import hashlib
+import json
+import os
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from nats.js.errors import BucketNotFoundError, NoKeysError
+from app.utils.logging import get_logger
+
+logger = get_logger("sharding")
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent hashing with virtual nodes. When an instance joins or leaves, only the
+    accounts on its arcs of the ring move (about 1/N of them).
+    """
+
+    def __init__(self, nodes: Iterable[str] = (), vnodes: int = 128):
+        self.vnodes = vnodes
+        self._points: List[Tuple[int, str]] = []
+        self._hashes: List[int] = []
+        self.nodes: List[str] = []
+        self.set_nodes(nodes)
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def set_nodes(self, nodes: Iterable[str]):
+        self.nodes = sorted(set(nodes))
+        self._points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(self.vnodes))
+        self._hashes = [point for point, _ in self._points]
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self._points:
+            return None
+
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._points)
+        return self._points[index][1]
+
+
+class MembershipBackend:
+    """Where instances announce themselves. Members that stop heartbeating expire after `ttl`."""
+
+    def __init__(self, ttl: float = 15.0):
+        self.ttl = ttl
+
+    async def start(self):
+        pass
+
+    async def heartbeat(self, instance_id: str):
+        raise NotImplementedError()
+
+    async def leave(self, instance_id: str):
+        raise NotImplementedError()
+
+    async def members(self) -> List[str]:
+        raise NotImplementedError()
+
+
+class MemoryMembership(MembershipBackend):
+    """In-process membership, for a single instance or several coordinators in one test."""
+
+    def __init__(self, ttl: float = 15.0):
+        super().__init__(ttl)
+        self._members: Dict[str, float] = {}
+
+    async def heartbeat(self, instance_id: str):
+        self._members[instance_id] = time.time()
+
+    async def leave(self, instance_id: str):
+        self._members.pop(instance_id, None)
+
+    async def members(self) -> List[str]:
+        cutoff = time.time() - self.ttl
+        return [member for member, seen in self._members.items() if seen >= cutoff]
+
+
+class FileMembership(MembershipBackend):
+    """Membership in a JSON file shared by instances on one host (or a shared volume)."""
+
+    def __init__(self, path: str, ttl: float = 15.0):
+        super().__init__(ttl)
+        self.path = path
+
+    def _update(self, instance_id: str, seen: Optional[float]) -> Dict[str, float]:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with open(f"{self.path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path) as f:
+                        members = json.load(f)
+                except (FileNotFoundError, ValueError):
+                    members = {}
+
+                cutoff = time.time() - self.ttl
+                members = {member: last for member, last in members.items() if last >= cutoff}
+                if seen is None:
+                    members.pop(instance_id, None)
+                else:
+                    members[instance_id] = seen
+
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(members, f)
+                os.replace(tmp_path, self.path)
+                return members
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    async def heartbeat(self, instance_id: str):
+        await asyncio.to_thread(self._update, instance_id, time.time())
+
+    async def leave(self, instance_id: str):
+        await asyncio.to_thread(self._update, instance_id, None)
+
+    async def members(self) -> List[str]:
+        def read() -> Dict[str, float]:
+            try:
+                with open(self.path) as f:
+                    return json.load(f)
+            except (FileNotFoundError, ValueError):
+                return {}
+
+        cutoff = time.time() - self.ttl
+        return [member for member, seen in (await asyncio.to_thread(read)).items() if seen >= cutoff]
+
+
+class NatsKVMembership(MembershipBackend):
+    """Membership in a NATS JetStream key-value bucket; the bucket TTL expires silent members."""
+
+    def __init__(self, publisher, bucket: str = "balance-listener-members", ttl: float = 15.0):
+        super().__init__(ttl)
+        self.publisher = publisher
+        self.bucket = bucket
+        self._kv = None
+
+    async def start(self):
+        if not self.publisher.connected:
+            await self.publisher.connect()
+
+        js = self.publisher.nc.jetstream()
+        try:
+            self._kv = await js.key_value(self.bucket)
+        except BucketNotFoundError:
+            self._kv = await js.create_key_value(bucket=self.bucket, ttl=self.ttl)
+
+    async def heartbeat(self, instance_id: str):
+        await self._kv.put(instance_id, str(time.time()).encode())
+
+    async def leave(self, instance_id: str):
+        await self._kv.delete(instance_id)
+
+    async def members(self) -> List[str]:
+        try:
+            return list(await self._kv.keys())
+        except NoKeysError:
+            return []
+
+
+class ShardCoordinator:
+    """
+    Heartbeats this instance into the membership backend and keeps a hash ring of the live
+    members. `owns()` tells whether an account belongs to this instance; `on_change` runs
+    whenever membership changes so schedules and streams can be handed over.
+    """
+
+    def __init__(
+        self,
+        instance_id: str,
+        backend: MembershipBackend,
+        vnodes: int = 128,
+        heartbeat_interval: float = 5.0,
+        on_change: Optional[Callable[[], Awaitable[None]]] = None,
+    ):
+        self.instance_id = instance_id
+        self.backend = backend
+        self.heartbeat_interval = heartbeat_interval
+        self.on_change = on_change
+        self.ring = HashRing([instance_id], vnodes)
+        self.rebalances = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def owns(self, account_id: str) -> bool:
+        return self.ring.owner(account_id) == self.instance_id
+
+    async def start(self):
+        await self.backend.start()
+        await self.refresh()
+        self._task = asyncio.create_task(self._heartbeat_loop(), name="shard-heartbeat")
+        logger.info(f"Instance {self.instance_id} joined with {len(self.ring)} member(s)")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+        try:
+            await self.backend.leave(self.instance_id)
+        except Exception as e:
+            logger.warning(f"Failed to leave membership: {e}")
+
+    async def refresh(self):
+        await self.backend.heartbeat(self.instance_id)
+        members = set(await self.backend.members())
+        members.add(self.instance_id)
+
+        if sorted(members) == self.ring.nodes:
+            return
+
+        logger.info(f"Membership changed: {self.ring.nodes} -> {sorted(members)}")
+        self.ring.set_nodes(members)
+        self.rebalances += 1
+        if self.on_change:
+            await self.on_change()
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Membership refresh failed: {e}")
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "instance_id": self.instance_id,
+            "members": list(self.ring.nodes),
+            "rebalances": self.rebalances,
+        }
@@ -0,0 +1,103 @@
+import time
+from typing import Any, Dict, Iterable, List, Optional
+from app.records import Record
+
+# fetch type -> record field summed per currency for the aggregated totals
+TOTAL_FIELDS = {
+    "balance": "total",
+    "earn_balance": "amount",
+}
+
+
+class SnapshotEntry:
+    __slots__ = ("records", "updated_at", "source")
+
+    def __init__(self, records: List[Record], updated_at: float, source: str):
+        self.records = records
+        self.updated_at = updated_at
+        self.source = source
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "updated_at": self.updated_at,
+            "source": self.source,
+            "records": [record.to_dict() for record in self.records],
+        }
+
+
+class SnapshotStore:
+    """
+    Latest normalized state per account and fetch type, written by the REST workers and
+    the websocket listeners. Per-currency totals across accounts are maintained on write,
+    so every read is a dictionary lookup.
+    """
+
+    def __init__(self):
+        # account_id -> fetch type -> entry
+        self._accounts: Dict[str, Dict[str, SnapshotEntry]] = {}
+        self._exchanges: Dict[str, str] = {}
+        # fetch type -> currency -> total across accounts
+        self._totals: Dict[str, Dict[str, float]] = {fetch_type: {} for fetch_type in TOTAL_FIELDS}
+
+    def _apply_totals(self, fetch_type: str, records: Iterable[Record], sign: int):
+        field = TOTAL_FIELDS.get(fetch_type)
+        if not field:
+            return
+
+        totals = self._totals[fetch_type]
+        for record in records:
+            currency = record.currency
+            value = totals.get(currency, 0.0) + sign * (getattr(record, field) or 0.0)
+            if abs(value) < 1e-12:
+                totals.pop(currency, None)
+            else:
+                totals[currency] = value
+
+    def update(self, account_id: str, exchange: str, fetch_type: str, records: List[Record], source: str = "rest", updated_at: Optional[float] = None):
+        entries = self._accounts.setdefault(account_id, {})
+        self._exchanges[account_id] = exchange
+
+        previous = entries.get(fetch_type)
+        if previous:
+            self._apply_totals(fetch_type, previous.records, -1)
+
+        entries[fetch_type] = SnapshotEntry(list(records), updated_at or time.time(), source)
+        self._apply_totals(fetch_type, records, 1)
+
+    def restore(self, account_id: str, exchange: str, fetch_type: str, records: List[Record], source: str, updated_at: float):
+        """Journaled state from before a restart; never overwrites a fresher result."""
+        if fetch_type not in self._accounts.get(account_id, {}):
+            self.update(account_id, exchange, fetch_type, records, source=source, updated_at=updated_at)
+
+    def remove(self, account_id: str):
+        entries = self._accounts.pop(account_id, None) or {}
+        self._exchanges.pop(account_id, None)
+        for fetch_type, entry in entries.items():
+            self._apply_totals(fetch_type, entry.records, -1)
+
+    def get(self, account_id: str) -> Optional[Dict[str, Any]]:
+        entries = self._accounts.get(account_id)
+        if entries is None:
+            return None
+
+        return {
+            "account_id": account_id,
+            "exchange": self._exchanges.get(account_id),
+            "snapshots": {fetch_type: entry.to_dict() for fetch_type, entry in entries.items()},
+        }
+
+    def get_many(self, account_ids: Iterable[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+        return {account_id: self.get(account_id) for account_id in account_ids}
+
+    def totals(self, fetch_type: str = "balance") -> Optional[Dict[str, float]]:
+        totals = self._totals.get(fetch_type)
+        return dict(totals) if totals is not None else None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "accounts": len(self._accounts),
+            "entries": sum(len(entries) for entries in self._accounts.values()),
+        }
+
+
+snapshot_store = SnapshotStore()
@@ -0,0 +1,47 @@
+import math
+import time
+from typing import Dict, Optional
+
+
+class StreamHealth:
+    """
+    Which (account, stream type) pairs are currently served by a live websocket. Sessions
+    mark a stream up when it delivers (optionally for a limited time) and down when it
+    fails; the scheduler skips REST polling of healthy types for hybrid accounts.
+    """
+
+    def __init__(self):
+        # account_id -> stream type -> healthy until (0 when down)
+        self._streams: Dict[str, Dict[str, float]] = {}
+
+    def mark_up(self, account_id: str, stream_type: str, ttl: Optional[float] = None):
+        expires_at = time.time() + ttl if ttl else math.inf
+        self._streams.setdefault(account_id, {})[stream_type] = expires_at
+
+    def mark_down(self, account_id: str, stream_type: str):
+        streams = self._streams.get(account_id)
+        if streams is not None and stream_type in streams:
+            streams[stream_type] = 0.0
+
+    def is_healthy(self, account_id: str, stream_type: str) -> bool:
+        return (self._streams.get(account_id) or {}).get(stream_type, 0.0) > time.time()
+
+    def forget(self, account_id: str, stream_type: Optional[str] = None):
+        if stream_type is None:
+            self._streams.pop(account_id, None)
+            return
+
+        streams = self._streams.get(account_id)
+        if streams is not None:
+            streams.pop(stream_type, None)
+            if not streams:
+                del self._streams[account_id]
+
+    def stats(self) -> Dict[str, int]:
+        now = time.time()
+        healthy = sum(1 for streams in self._streams.values() for expires_at in streams.values() if expires_at > now)
+        total = sum(len(streams) for streams in self._streams.values())
+        return {"healthy": healthy, "degraded": total - healthy}
+
+
+stream_health = StreamHealth()
@@ -1,15 +1,41 @@
 import asyncio
-from typing import Dict, List, Union
-from app.credentials import get_credentials_for_account
-from app.ccxt.adapters import get_adapter
+import time
+from typing import Awaitable, Callable, List, Optional
+from app.credentials import credentials_cache
+from app.ccxt.adapter_pool import adapter_pool
 from app.utils.logging import get_logger
 from app.type_defs import TaskProcessor
-from app.nats_publisher import nats_publisher
+from app.delta_publisher import delta_publisher
+from app.activity_tracker import activity_tracker
+from app.snapshot_store import snapshot_store
+from app.records import Record
+from app.metrics import TASK_ERRORS, TASK_LATENCY, record_fetch
+from app.watermarks import watermarks
 
 logger = get_logger("task_handler")
 
+# Fetch types returning events: fetched from the account's watermarks on, only new events are published
+EVENT_TYPES = {"funding_fees"}
+
+# (account_id, exchange, fetch type, records, changed)
+ResultCallback = Callable[[str, str, str, List[Record], bool], Awaitable[None]]
+
+
+async def store_result(account_id: str, exchange: str, fetch_type: str, records: List[Record], changed: bool):
+    snapshot_store.update(account_id, exchange, fetch_type, records, source="rest")
+    activity_tracker.observe(account_id, fetch_type, records)
+
+
+async def exchange_of(task: dict) -> Optional[str]:
+    creds_info = await credentials_cache.get(task.get("account_id"))
+    return creds_info.get("exchange") if creds_info else None
+
 
 class FetchTaskHandler(TaskProcessor):
+    def __init__(self, on_result: Optional[ResultCallback] = None):
+        # Worker processes hand results back to the main process instead of storing them
+        self.on_result = on_result or store_result
+
     async def process(self, task: dict):
         try:
             await self.process_fetch_task(task)
@@ -21,54 +47,57 @@ class FetchTaskHandler(TaskProcessor):
         account_id = task.get("account_id")
         fetch_types = task.get("types", ["balance"])
 
-        creds_info = await get_credentials_for_account(account_id)
+        creds_info = await credentials_cache.get(account_id)
         if not creds_info:
-            logger.warning(f"No credentials for {account_id}, skipping")
+            logger.warning("No credentials for %s, skipping", account_id)
             return
 
         exchange = creds_info.get("exchange")
         credentials = creds_info.get("credentials")
 
-        exchange_adapter = await get_adapter(exchange, credentials)
-        async with exchange_adapter as adapter:
-            fetch_map = {
-                "balance": adapter.fetch_balance,
-                "earn_balance": adapter.fetch_earn_balance,
-                "positions": adapter.fetch_positions,
-                "options": adapter.fetch_options_positions,
-                "funding_fees": adapter.fetch_funding_fees,
-            }
+        # Worker processes get the account's watermarks from the main process with the task
+        watermarks.restore(account_id, task.get("watermarks"))
+
+        async with adapter_pool.lease(account_id, exchange, credentials) as adapter:
+            plan = adapter.plan(fetch_types, {
+                fetch_type: {"since": watermarks.since(account_id, exchange)} for fetch_type in EVENT_TYPES
+            })
 
             async def fetch_and_publish(fetch_type: str, fetch_func):
+                started = time.perf_counter()
                 try:
-                    logger.info(f"Fetching {fetch_type} for {account_id}")
+                    logger.debug("Fetching %s for %s", fetch_type, account_id)
                     data = await fetch_func()
-                    if not data:
-                        logger.info(f"No {fetch_type} data fetched  for {account_id}")
+                    if data is None:
+                        logger.debug("No %s data fetched for %s", fetch_type, account_id)
                         return
-                    
-                    topic = f"{fetch_type}.{exchange}.{account_id}"
-                    logger.info(f"Publishing {fetch_type} data for {account_id}")
-                    await self._publish(topic, data)
+
+                    logger.debug("Publishing %s data for %s", fetch_type, account_id)
+                    if fetch_type in EVENT_TYPES:
+                        if adapter.funding_cursor is not None:
+                            watermarks.move_cursor(account_id, exchange, adapter.funding_cursor)
+                        events = watermarks.advance(account_id, exchange, data)
+                        changed = await delta_publisher.append(fetch_type, exchange, account_id, events)
+                        data = delta_publisher.items(account_id, fetch_type, exchange)
+                    else:
+                        changed = await delta_publisher.publish(fetch_type, exchange, account_id, data)
+                    await self.on_result(account_id, exchange, fetch_type, data, changed)
+                    TASK_LATENCY.labels(exchange, fetch_type).observe(time.perf_counter() - started)
+                    record_fetch(account_id, fetch_type)
                 except asyncio.CancelledError:
-                    logger.info(f"Cancelled fetch for {fetch_type}:{account_id}")
+                    logger.debug("Cancelled fetch for %s:%s", fetch_type, account_id)
                     raise
                 except Exception as e:
-                    logger.warning(f"Error fetching {fetch_type} for {account_id}: {e}")
+                    TASK_ERRORS.labels(exchange, fetch_type).inc()
+                    logger.warning("Error fetching %s for %s: %s", fetch_type, account_id, e)
 
-            # Fetch and publish in parallel
+            # Fetch and publish in parallel, sharing the requests common to several types
             tasks = [
                 asyncio.create_task(fetch_and_publish(fetch_type, fetch_func))
-                for fetch_type, fetch_func in fetch_map.items()
-                if fetch_type in fetch_types
+                for fetch_type, fetch_func in plan.steps().items()
             ]
 
-            # Wait for all to finish concurrently
-            await asyncio.gather(*tasks, return_exceptions=True)
-
-    async def _publish(self, topic: str, data: Union[List[Dict], Dict]):
-        payloads = data if isinstance(data, list) else [data]
-        await asyncio.gather(*[
-            nats_publisher.publish(topic, payload)
-            for payload in payloads
-        ])
+            try:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            finally:
+                plan.close()
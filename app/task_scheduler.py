@@ -1,6 +1,12 @@
-from typing import Dict, List
+import time
+import zlib
+from typing import Dict, Hashable, List, Optional, Tuple
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
+from app.activity_tracker import ActivityTracker
+from app.metrics import SCHEDULER_LAG
+from app.sharding import ShardCoordinator
+from app.stream_health import StreamHealth
 from app.utils.queue import TaskQueue
 from app.type_defs import FetchTask
 from app.utils.logging import get_logger
@@ -8,59 +14,246 @@ from app.utils.logging import get_logger
 logger = get_logger("task_scheduler")
 
 
+# Schedule group -> (fetch types, default interval in seconds)
+SCHEDULES: Dict[str, Tuple[List[str], int]] = {
+    "balance": (["balance", "earn_balance", "positions", "option_positions"], 30),
+    "funding_fees": (["funding_fees"], 60),
+}
+
+FETCH_TYPES: List[str] = [fetch_type for types, _ in SCHEDULES.values() for fetch_type in types]
+
+# Fetch types a healthy websocket stream replaces for accounts in hybrid mode
+STREAMED_TYPES = {"balance", "positions"}
+
+
+def phase_offset(account_id: str, interval_ticks: int) -> int:
+    """Stable slot of an account within its interval, identical across restarts and instances."""
+    return zlib.crc32(account_id.encode()) % interval_ticks
+
+
+class TimeWheel:
+    """Hashed timing wheel keyed by absolute tick number. Adding, removing and popping a slot are O(1)."""
+
+    def __init__(self):
+        # tick -> keys due at that tick (dict used as an insertion-ordered set)
+        self._slots: Dict[int, Dict[Hashable, None]] = {}
+        self._positions: Dict[Hashable, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._positions
+
+    def add(self, key: Hashable, tick: int):
+        self.remove(key)
+        self._slots.setdefault(tick, {})[key] = None
+        self._positions[key] = tick
+
+    def remove(self, key: Hashable):
+        tick = self._positions.pop(key, None)
+        if tick is None:
+            return
+
+        slot = self._slots.get(tick)
+        if slot is not None:
+            slot.pop(key, None)
+            if not slot:
+                del self._slots[tick]
+
+    def pop(self, tick: int) -> List[Hashable]:
+        slot = self._slots.pop(tick, None)
+        if not slot:
+            return []
+
+        for key in slot:
+            del self._positions[key]
+        return list(slot)
+
+
 class TaskScheduler:
-    def __init__(self, listening_accounts: Dict[str, dict], queue: TaskQueue):
+    def __init__(
+        self,
+        listening_accounts: Dict[str, dict],
+        queue: TaskQueue,
+        tick_seconds: float = 1.0,
+        activity: Optional[ActivityTracker] = None,
+        max_tasks_per_second: Optional[float] = None,
+        stream_health: Optional[StreamHealth] = None,
+        shard: Optional[ShardCoordinator] = None,
+    ):
         self.listening_accounts = listening_accounts
         self.queue = queue
+        self.tick_seconds = tick_seconds
         self.scheduler = AsyncIOScheduler()
 
+        # When set, intervals adapt to how often each account's results change, and are
+        # stretched proportionally whenever the total demand exceeds max_tasks_per_second
+        self.activity = activity
+        self.max_tasks_per_second = max_tasks_per_second
+        self._rates: Dict[Tuple[str, str], float] = {}
+        self._demand = 0.0
+
+        # When set, hybrid accounts are not polled for types their stream currently covers
+        self.stream_health = stream_health
+        self._suppressed = 0
+
+        # When set, only accounts of this instance's shard are scheduled
+        self.shard = shard
+
+        # (account_id, schedule group) entries spread over the wheel by their phase offset
+        self.wheel = TimeWheel()
+        self._last_tick: Optional[int] = None
+        self._lag = 0.0
+        self._enqueued = 0
+
+    def _now_tick(self) -> int:
+        return int(time.time() / self.tick_seconds)
+
+    def _desired_interval(self, account_id: str, group: str) -> float:
+        types, interval = SCHEDULES[group]
+        account = self.listening_accounts.get(account_id) or {}
+        interval = (account.get("intervals") or {}).get(group) or interval
+        if self.activity:
+            interval *= self.activity.interval_factor(account_id, types)
+        return interval
+
+    def _set_rate(self, key: Tuple[str, str], rate: float):
+        self._demand += rate - self._rates.pop(key, 0.0)
+        if rate:
+            self._rates[key] = rate
+
+    def _budget_scale(self) -> float:
+        if not self.max_tasks_per_second or self._demand <= self.max_tasks_per_second:
+            return 1.0
+        return self._demand / self.max_tasks_per_second
+
+    def _interval_ticks(self, account_id: str, group: str) -> int:
+        interval = self._desired_interval(account_id, group)
+        self._set_rate((account_id, group), 1 / interval)
+        return max(1, round(interval * self._budget_scale() / self.tick_seconds))
+
+    def _owns(self, account_id: str) -> bool:
+        return not self.shard or self.shard.owns(account_id)
+
+    def schedule_account(self, account_id: str):
+        if not self._owns(account_id):
+            return
+
+        now = self._now_tick()
+        for group in SCHEDULES:
+            interval_ticks = self._interval_ticks(account_id, group)
+            # Next tick on this account's phase, so enqueues are spread evenly over the interval
+            next_tick = now + 1 + (phase_offset(account_id, interval_ticks) - now - 1) % interval_ticks
+            self.wheel.add((account_id, group), next_tick)
+
+    def unschedule_account(self, account_id: str):
+        for group in SCHEDULES:
+            self.wheel.remove((account_id, group))
+            self._set_rate((account_id, group), 0.0)
+
+        if self.activity:
+            self.activity.forget(account_id)
+
+    def rebalance(self):
+        """After a membership change, schedule the accounts this instance gained and drop the ones it lost."""
+        for account_id in list(self.listening_accounts.keys()):
+            scheduled = any((account_id, group) in self.wheel for group in SCHEDULES)
+            owned = self._owns(account_id)
+            if owned and not scheduled:
+                self.schedule_account(account_id)
+            elif scheduled and not owned:
+                self.unschedule_account(account_id)
+
     async def enqueue_account(self, account_id: str, types: List[str]):
+        if not self._owns(account_id):
+            return
+
         try:
             task = FetchTask(account_id=account_id, types=types)
-            logger.info(f"Enqueueing {types} tasks for account {account_id}")
+            logger.debug("Enqueueing %s tasks for account %s", types, account_id)
             await self.queue.put(task.model_dump())
+            self._enqueued += 1
         except Exception as e:
             logger.error(f"Failed to enqueue account {account_id}: {e}")
 
     async def enqueue_all_accounts(self, types: List[str]):
         if not self.listening_accounts:
-            logger.debug(f"No accounts to enqueue")
+            logger.debug("No accounts to enqueue")
             return
 
         for account_id in list(self.listening_accounts.keys()):
             await self.enqueue_account(account_id, types)
 
-    async def _balance_check_job(self):
-        await self.enqueue_all_accounts(["balance", "earn_balance", "positions", "option_positions"])
+    def account_types(self, account_id: str) -> List[str]:
+        """Fetch types polled for an account: its own selection, or all of them."""
+        selected = (self.listening_accounts.get(account_id) or {}).get("types")
+        return [t for t in FETCH_TYPES if not selected or t in selected]
+
+    def _types_due(self, account_id: str, group: str) -> List[str]:
+        account = self.listening_accounts.get(account_id) or {}
+        selected = account.get("types")
+        types = [t for t in SCHEDULES[group][0] if not selected or t in selected]
+        if not types or not self.stream_health or account.get("mode") != "hybrid":
+            return types
 
-    async def _funding_fee_check_job(self):
-        await self.enqueue_all_accounts(["funding_fees"])
+        due = [t for t in types if t not in STREAMED_TYPES or not self.stream_health.is_healthy(account_id, t)]
+        self._suppressed += len(types) - len(due)
+        return due
+
+    async def _process_tick(self, tick: int):
+        for account_id, group in self.wheel.pop(tick):
+            if account_id not in self.listening_accounts or not self._owns(account_id):
+                self._set_rate((account_id, group), 0.0)
+                continue
+
+            types = self._types_due(account_id, group)
+            if types:
+                await self.enqueue_account(account_id, types)
+            self.wheel.add((account_id, group), tick + self._interval_ticks(account_id, group))
+
+    async def _tick_job(self):
+        now = self._now_tick()
+        if self._last_tick is None:
+            self._last_tick = now - 1
+
+        # Catch up on ticks missed while the loop was busy
+        for tick in range(self._last_tick + 1, now + 1):
+            await self._process_tick(tick)
+        self._last_tick = max(self._last_tick, now)
+
+        self._lag = max(0.0, time.time() - now * self.tick_seconds)
+        SCHEDULER_LAG.set(self._lag)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "scheduled": len(self.wheel),
+            "enqueued": self._enqueued,
+            "suppressed_by_stream": self._suppressed,
+            "lag_s": round(self._lag, 3),
+            "demand_tasks_per_s": round(self._demand, 2),
+            "budget_scale": round(self._budget_scale(), 3),
+        }
 
     async def start(self):
         if self.scheduler.running:
             logger.warning("Scheduler already running")
             return
 
-        # Schedule periodic jobs
-        self.scheduler.add_job(
-            self._balance_check_job,
-            IntervalTrigger(seconds=30),
-            id="balance_check_job",
-            coalesce=True,
-            max_instances=1,
-            misfire_grace_time=15,
-        )
+        for account_id in list(self.listening_accounts.keys()):
+            self.schedule_account(account_id)
+
         self.scheduler.add_job(
-            self._funding_fee_check_job,
-            IntervalTrigger(minutes=1),
-            id="funding_fee_check_job",
+            self._tick_job,
+            IntervalTrigger(seconds=self.tick_seconds),
+            id="time_wheel_tick",
             coalesce=True,
             max_instances=1,
-            misfire_grace_time=60,
+            misfire_grace_time=None,
         )
 
         self.scheduler.start()
-        logger.info("Scheduler started with 30s and 8h intervals")
+        logger.info(f"Scheduler started with {self.tick_seconds}s ticks for {len(self.listening_accounts)} accounts")
 
     async def stop(self):
         if self.scheduler.running:
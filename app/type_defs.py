@@ -1,14 +1,38 @@
-from pydantic import BaseModel
-from typing import Any, Dict, List, Protocol
+import time
+from pydantic import BaseModel, Field
+from typing import Any, Dict, List, Literal, Optional, Protocol
+
+FetchType = Literal["balance", "earn_balance", "positions", "option_positions", "funding_fees"]
 
 
 class ListenRequest(BaseModel):
     account_id: str
+    # Schedule group ("balance", "funding_fees") -> polling interval in seconds
+    intervals: Optional[Dict[str, int]] = None
+    # "poll" always polls over REST; "hybrid" also streams and polls only what the stream does not cover
+    mode: Literal["poll", "hybrid"] = "poll"
+    # Fetch types to poll; all of them when unset
+    types: Optional[List[FetchType]] = None
+
+
+class BulkListenRequest(BaseModel):
+    accounts: List[ListenRequest] = Field(max_length=50_000)
+    # First fetches and stream connects are spread over this many seconds; server default when unset
+    ramp_seconds: Optional[float] = Field(default=None, ge=0)
+
+
+class BulkStopRequest(BaseModel):
+    account_ids: List[str] = Field(max_length=50_000)
+
+
+class SnapshotBatchRequest(BaseModel):
+    account_ids: List[str]
 
 
 class FetchTask(BaseModel):
     account_id: str
     types: List[str]
+    enqueued_at: float = Field(default_factory=time.time)
 
 
 class TaskProcessor(Protocol):
@@ -0,0 +1,28 @@
+import asyncio
+import random
+
+
+class Backoff:
+    """
+    Jittered exponential backoff: the n-th delay is drawn from [d/2, d] with
+    d = min(cap, base * factor ** n), so reconnecting clients spread out.
+    """
+
+    def __init__(self, base: float = 1.0, cap: float = 60.0, factor: float = 2.0):
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.attempts = 0
+
+    def next_delay(self) -> float:
+        delay = min(self.cap, self.base * self.factor ** self.attempts)
+        self.attempts += 1
+        return random.uniform(delay / 2, delay)
+
+    def reset(self):
+        self.attempts = 0
+
+    async def sleep(self) -> float:
+        delay = self.next_delay()
+        await asyncio.sleep(delay)
+        return delay
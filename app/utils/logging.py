@@ -1,64 +1,183 @@
+import atexit
+import json
+import os
 import sys
 import logging
+import queue
+import threading
+import time
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Tuple
+
+# LOG_LEVEL: minimum level of every app logger (default INFO)
+# LOG_FORMAT: "text" (default) or "json", one object per line
+# LOG_RATE_LIMIT: messages per second allowed per call site, 0 disables (default 5)
+# LOG_RATE_BURST: messages per call site let through at once before rate limiting (default 20)
+LOG_LEVEL = logging.getLevelName(os.getenv("LOG_LEVEL", "INFO").upper())
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_RATE_LIMIT = float(os.getenv("LOG_RATE_LIMIT", "5"))
+LOG_RATE_BURST = float(os.getenv("LOG_RATE_BURST", "20"))
+
+# Attributes every LogRecord has; anything else was passed in `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "suppressed", "log_key"}
 
 
 class BaseLogger(ABC):
     @abstractmethod
-    def debug(self, msg):
+    def debug(self, msg, *args, **kwargs):
         pass
 
     @abstractmethod
-    def info(self, msg):
+    def info(self, msg, *args, **kwargs):
         pass
 
     @abstractmethod
-    def warning(self, msg):
+    def warning(self, msg, *args, **kwargs):
         pass
 
     @abstractmethod
-    def error(self, msg):
+    def error(self, msg, *args, **kwargs):
         pass
 
     @abstractmethod
-    def critical(self, msg):
+    def critical(self, msg, *args, **kwargs):
         pass
 
 
-logging_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(name)s - %(message)s")
-
-# Shared console handler (only created once)
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        return f"{line} (+{suppressed} similar suppressed)" if suppressed else line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES})
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket per call site (or per `key` passed to the logger): `rate` messages per second
+    with bursts of `burst`. Dropped messages are counted and reported on the next one let
+    through. At most `max_keys` buckets are kept, evicting the least recently used.
+    Critical messages always pass.
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 10000):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> (tokens, last refill, suppressed since last emit), least recently used first
+        self._buckets: "OrderedDict[Tuple[str, Any], Tuple[float, float, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.CRITICAL:
+            return True
+
+        # The call site stands for the message template, also for f-string messages
+        log_key = getattr(record, "log_key", None)
+        key = (record.name, log_key) if log_key is not None else (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            tokens, last, suppressed = self._buckets.get(key, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now, suppressed + 1)
+                self._buckets.move_to_end(key)
+                return False
+
+            self._buckets[key] = (tokens - 1, now, 0)
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+        record.suppressed = suppressed
+        return True
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """Queues records as they are; formatting happens on the writer thread."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+logging_formatter = JsonFormatter() if LOG_FORMAT == "json" else TextFormatter("%(asctime)s - %(levelname)s - %(name)s - %(message)s")
+
+# Shared console handler, written to by the background listener only
 console_handler = logging.StreamHandler(sys.stdout)
 console_handler.setLevel(logging.DEBUG)
 console_handler.setFormatter(logging_formatter)
 
+# Every app logger hands records to this queue; a listener thread formats and writes them
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+queue_handler = _DeferredQueueHandler(_log_queue)
+if LOG_RATE_LIMIT > 0:
+    queue_handler.addFilter(RateLimitFilter(LOG_RATE_LIMIT, LOG_RATE_BURST))
+
+_listener = QueueListener(_log_queue, console_handler, respect_handler_level=True)
+_listener.start()
+atexit.register(_listener.stop)
+
 
 class DefaultLogger(BaseLogger):
+    """
+    App logger with stdlib %-style arguments, formatted on the writer thread only when
+    the level is enabled: `logger.debug("Fetched %s for %s", fetch_type, account_id)`.
+    Messages are rate limited per call site; `key` shares one limit across several of them;
+    other keyword arguments (`exc_info`, `extra`) are passed through to `logging`.
+    """
+
     def __init__(self, name: str = "app"):
         self.logger = logging.getLogger(name)
 
         if not self.logger.handlers:
-            if console_handler not in self.logger.handlers:
-                self.logger.addHandler(console_handler)
-
-            self.logger.setLevel(logging.INFO)
+            self.logger.addHandler(queue_handler)
+            self.logger.setLevel(LOG_LEVEL)
 
         self.logger.propagate = False
 
-    def debug(self, msg):
-        self.logger.debug(msg)
+    def isEnabledFor(self, level: int) -> bool:
+        return self.logger.isEnabledFor(level)
+
+    def _log(self, level: int, msg, args, key, kwargs):
+        if not self.logger.isEnabledFor(level):
+            return
+        if key is not None:
+            kwargs["extra"] = {**kwargs.get("extra", {}), "log_key": key}
+        # stacklevel points funcName/lineno at the caller rather than this wrapper
+        self.logger.log(level, msg, *args, stacklevel=3, **kwargs)
+
+    def debug(self, msg, *args, key=None, **kwargs):
+        self._log(logging.DEBUG, msg, args, key, kwargs)
 
-    def info(self, msg):
-        self.logger.info(msg)
+    def info(self, msg, *args, key=None, **kwargs):
+        self._log(logging.INFO, msg, args, key, kwargs)
 
-    def warning(self, msg):
-        self.logger.warning(msg)
+    def warning(self, msg, *args, key=None, **kwargs):
+        self._log(logging.WARNING, msg, args, key, kwargs)
 
-    def error(self, msg):
-        self.logger.error(msg)
+    def error(self, msg, *args, key=None, **kwargs):
+        self._log(logging.ERROR, msg, args, key, kwargs)
 
-    def critical(self, msg):
-        self.logger.critical(msg)
+    def critical(self, msg, *args, key=None, **kwargs):
+        self._log(logging.CRITICAL, msg, args, key, kwargs)
 
 
 def get_logger(name: str):
@@ -1,5 +1,20 @@
-from typing import Any
+from collections import OrderedDict
+from typing import Any, Dict, Optional
 import asyncio
+import time
+from app.metrics import QUEUE_DEPTH, QUEUE_DROPS, QUEUE_WAIT
+
+# What TaskQueue.put() does when the queue is full
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+
+
+def merge_tasks(pending: dict, item: dict):
+    """Merge `item` into the pending task of the same account: union of `types`, earliest `enqueued_at`."""
+    types = pending.setdefault("types", [])
+    types.extend(t for t in item.get("types", []) if t not in types)
+    if "enqueued_at" in item:
+        pending["enqueued_at"] = min(pending.get("enqueued_at", item["enqueued_at"]), item["enqueued_at"])
 
 
 class BaseQueue:
@@ -15,14 +30,89 @@ class BaseQueue:
 
 # Temporary in-memory message queue. Replaceable with Redis/NATS in the future
 class TaskQueue(BaseQueue):
-    def __init__(self):
-        self._queue = asyncio.Queue()
+    """
+    Keyed FIFO of fetch tasks holding at most one pending task per account. A task put for
+    an account that is already queued is merged into it (union of `types`, earliest
+    `enqueued_at`) instead of being queued twice. With `maxsize` set, a full queue either
+    blocks the producer or drops the oldest pending task, depending on `overflow`.
+    """
+
+    def __init__(self, maxsize: int = 0, overflow: str = OVERFLOW_BLOCK, key: str = "account_id", track_metrics: bool = True):
+        if overflow not in (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST):
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.key = key
+        # Only the main task queue reports to the queue metrics
+        self.track_metrics = track_metrics
+        self._pending: "OrderedDict[Any, dict]" = OrderedDict()
+        self._changed = asyncio.Condition()
+
+        self._puts = 0
+        self._merges = 0
+        self._drops = 0
+
+    def qsize(self) -> int:
+        return len(self._pending)
 
-    async def put(self, item):
-        await self._queue.put(item)
+    def oldest_age(self) -> float:
+        if not self._pending:
+            return 0.0
+        oldest = next(iter(self._pending.values()))
+        return max(0.0, time.time() - oldest.get("enqueued_at", time.time()))
+
+    async def put(self, item: dict):
+        async with self._changed:
+            self._puts += 1
+            key = item[self.key]
+
+            pending = self._pending.get(key)
+            if pending is not None:
+                merge_tasks(pending, item)
+                self._merges += 1
+                return
+
+            while self.maxsize and len(self._pending) >= self.maxsize:
+                if self.overflow == OVERFLOW_DROP_OLDEST:
+                    self._pending.popitem(last=False)
+                    self._drops += 1
+                    if self.track_metrics:
+                        QUEUE_DROPS.inc()
+                else:
+                    await self._changed.wait()
+
+                    # The account may have been queued while we waited for room
+                    pending = self._pending.get(key)
+                    if pending is not None:
+                        merge_tasks(pending, item)
+                        self._merges += 1
+                        return
+
+            self._pending[key] = {**item, "types": list(item.get("types", []))}
+            if self.track_metrics:
+                QUEUE_DEPTH.set(len(self._pending))
+            self._changed.notify_all()
 
     async def get(self):
-        return await self._queue.get()
+        async with self._changed:
+            while not self._pending:
+                await self._changed.wait()
 
-    async def task_done(self):
-        self._queue.task_done()
+            _, item = self._pending.popitem(last=False)
+            if self.track_metrics:
+                QUEUE_DEPTH.set(len(self._pending))
+                if "enqueued_at" in item:
+                    QUEUE_WAIT.observe(max(0.0, time.time() - item["enqueued_at"]))
+            self._changed.notify_all()
+            return item
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        return {
+            "depth": len(self._pending),
+            "maxsize": self.maxsize,
+            "oldest_age_s": round(self.oldest_age(), 3),
+            "puts": self._puts,
+            "merges": self._merges,
+            "drops": self._drops,
+        }
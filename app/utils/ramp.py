@@ -0,0 +1,56 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Sequence, Set, TypeVar
+from app.utils.logging import get_logger
+
+logger = get_logger("ramp")
+
+T = TypeVar("T")
+
+
+async def ramp(items: Sequence[T], action: Callable[[T], Awaitable[None]], window: float, concurrency: int = 64) -> int:
+    """
+    Run `action` for every item, spread evenly over `window` seconds instead of all at once.
+    Each action starts at its slot as its own task, so slow actions do not hold back the
+    schedule; at most `concurrency` run at once, and later starts wait for one to finish.
+    """
+    if not items:
+        return 0
+
+    slots = asyncio.Semaphore(concurrency)
+    running: Set[asyncio.Task] = set()
+    done = 0
+
+    async def run(item: T):
+        nonlocal done
+        try:
+            await action(item)
+            done += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Ramped action failed for {item}: {e}")
+        finally:
+            slots.release()
+
+    started = time.monotonic()
+    step = window / len(items)
+    try:
+        for index, item in enumerate(items):
+            delay = started + index * step - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            await slots.acquire()
+            task = asyncio.create_task(run(item))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+        await asyncio.gather(*running)
+    except asyncio.CancelledError:
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        raise
+
+    return done
@@ -0,0 +1,115 @@
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from app.records import FundingEventRecord
+
+# (exchange, currency, timestamp, ids)
+WatermarkRow = Tuple[str, str, int, List[str]]
+
+# Pseudo currency of the fetch cursor: the end of the newest time window fetched without
+# events, so the next fetch does not walk the empty windows again
+CURSOR = "*"
+
+
+class Watermark:
+    __slots__ = ("timestamp", "ids")
+
+    def __init__(self, timestamp: int, ids: Iterable[str]):
+        # Newest event time in ms, and the events at exactly that time: `since` is inclusive
+        self.timestamp = timestamp
+        self.ids: Set[str] = set(ids)
+
+
+class WatermarkStore:
+    """
+    Newest funding / settlement event seen per (account, exchange, currency). Fetches ask the
+    exchange only for events from the watermark on, and events at or behind it are dropped
+    instead of being published again. Watermark moves are journaled when a journal is set.
+    """
+
+    def __init__(self):
+        # account_id -> (exchange, currency) -> watermark
+        self._marks: Dict[str, Dict[Tuple[str, str], Watermark]] = {}
+        self.journal = None
+
+    def since(self, account_id: str, exchange: str) -> Dict[str, int]:
+        """currency -> watermark timestamp, with the fetch cursor under `CURSOR`; empty before the first fetch."""
+        return {
+            currency: mark.timestamp
+            for (mark_exchange, currency), mark in self._marks.get(account_id, {}).items()
+            if mark_exchange == exchange
+        }
+
+    def advance(self, account_id: str, exchange: str, records: Iterable[FundingEventRecord]) -> List[FundingEventRecord]:
+        """The records past the watermarks, which move up to the newest of them."""
+        marks = self._marks.setdefault(account_id, {})
+        new = []
+        for record in records:
+            if record.timestamp is None:
+                continue
+
+            key = (exchange, record.currency or "")
+            mark = marks.get(key)
+            if mark and (record.timestamp < mark.timestamp or (record.timestamp == mark.timestamp and record.id in mark.ids)):
+                continue
+            new.append(record)
+
+        moved = set()
+        for record in new:
+            key = (exchange, record.currency or "")
+            mark = marks.get(key)
+            if mark is None or record.timestamp > mark.timestamp:
+                marks[key] = Watermark(record.timestamp, [record.id])
+            elif record.timestamp == mark.timestamp:
+                mark.ids.add(record.id)
+            moved.add(key)
+
+        if self.journal:
+            for key in moved:
+                mark = marks[key]
+                self.journal.record_watermark(account_id, *key, mark.timestamp, sorted(mark.ids))
+        return new
+
+    def move_cursor(self, account_id: str, exchange: str, timestamp: int):
+        marks = self._marks.setdefault(account_id, {})
+        mark = marks.get((exchange, CURSOR))
+        if mark is not None and mark.timestamp >= timestamp:
+            return
+
+        marks[(exchange, CURSOR)] = Watermark(timestamp, [])
+        if self.journal:
+            self.journal.record_watermark(account_id, exchange, CURSOR, timestamp, [])
+
+    def export(self, account_id: str) -> List[WatermarkRow]:
+        return [(exchange, currency, mark.timestamp, sorted(mark.ids)) for (exchange, currency), mark in self._marks.get(account_id, {}).items()]
+
+    def restore(self, account_id: str, rows: Optional[Iterable[WatermarkRow]], record: bool = False):
+        """
+        Watermarks from the journal or another process; never moves a known watermark back.
+        With `record`, the watermarks that moved are journaled.
+        """
+        if not rows:
+            return
+
+        marks = self._marks.setdefault(account_id, {})
+        for exchange, currency, timestamp, ids in rows:
+            mark = marks.get((exchange, currency))
+            if mark is None or timestamp > mark.timestamp:
+                mark = marks[(exchange, currency)] = Watermark(timestamp, ids)
+            elif timestamp == mark.timestamp and not mark.ids.issuperset(ids):
+                mark.ids.update(ids)
+            else:
+                continue
+
+            if record and self.journal:
+                self.journal.record_watermark(account_id, exchange, currency, mark.timestamp, sorted(mark.ids))
+
+    def forget(self, account_id: str):
+        self._marks.pop(account_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "accounts": len(self._marks),
+            "watermarks": sum(len(marks) for marks in self._marks.values()),
+        }
+
+
+watermarks = WatermarkStore()
@@ -1,60 +1,294 @@
 import asyncio
-from typing import List
+import itertools
+import math
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
 from app.type_defs import TaskProcessor
-from app.utils.queue import TaskQueue
+from app.utils.queue import TaskQueue, OVERFLOW_DROP_OLDEST, merge_tasks
 from app.utils.logging import get_logger
 
 
 logger = get_logger("worker_pool")
 
+# Resolves the exchange a task will hit, for per-exchange concurrency caps
+ExchangeResolver = Callable[[Dict[str, Any]], Awaitable[Optional[str]]]
+
+
+class _Worker:
+    __slots__ = ("task", "busy")
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.busy = False
+
 
 class WorkerPool:
-    def __init__(self, queue: TaskQueue, processor: TaskProcessor, worker_count: int = 4):
+    """
+    Coroutine workers draining the task queue. While tasks wait longer than `target_wait`
+    seconds or outnumber the idle workers, the pool grows (at most doubling per step,
+    up to `max_workers`) towards the number of workers that would drain the queue within
+    `target_wait` at the current p95 task latency. It shrinks back towards `min_workers`
+    after `idle_grace` seconds without backlog.
+
+    With `exchange_of` set, at most `exchange_concurrency[exchange]` tasks per exchange run
+    at once (`default_exchange_concurrency` otherwise); tasks over the cap are parked and
+    resumed as soon as a task of that exchange finishes. Parked tasks are merged per account
+    like queued ones, and at most `max_parked` are held per exchange; beyond that the
+    queue's overflow policy applies: the oldest parked task is dropped, or the worker waits
+    for room and the backlog stays in the queue.
+    """
+
+    def __init__(
+        self,
+        queue: TaskQueue,
+        processor: TaskProcessor,
+        min_workers: int = 4,
+        max_workers: int = 4,
+        target_wait: float = 2.0,
+        idle_grace: float = 30.0,
+        scale_interval: float = 1.0,
+        exchange_of: Optional[ExchangeResolver] = None,
+        exchange_concurrency: Optional[Dict[str, int]] = None,
+        default_exchange_concurrency: Optional[int] = None,
+        max_parked: int = 1000,
+    ):
         self.queue = queue
-        self.worker_count = worker_count
         self.processor = processor
-        self._workers: List[asyncio.Task] = []
+        self.min_workers = min_workers
+        self.max_workers = max(min_workers, max_workers)
+        self.target_wait = target_wait
+        self.idle_grace = idle_grace
+        self.scale_interval = scale_interval
+
+        self.exchange_of = exchange_of
+        self.exchange_concurrency = exchange_concurrency or {}
+        self.default_exchange_concurrency = default_exchange_concurrency
+        self.max_parked = max(1, max_parked)
+        self._running: Dict[str, int] = {}
+        # exchange -> account_id -> parked task, oldest first
+        self._parked: Dict[str, "OrderedDict[str, Dict[str, Any]]"] = {}
+        # Set whenever an exchange slot or a parking place frees up
+        self._room = asyncio.Event()
+        self._parked_drops = 0
+
+        self._workers: Dict[int, _Worker] = {}
+        self._ids = itertools.count()
+        self._scaler: Optional[asyncio.Task] = None
         self._stopped = asyncio.Event()
 
+        self._latencies: Deque[float] = deque(maxlen=512)
+        self._last_backlog = time.monotonic()
+        self._processed = 0
+        self._scale_ups = 0
+        self._scale_downs = 0
+        self._deaths = 0
+        self._unresolved = 0
+
     async def start(self):
         self._stopped.clear()
-        for i in range(self.worker_count):
-            worker = asyncio.create_task(self._worker_loop(i), name=f"worker-{i}")
-            self._workers.append(worker)
-            logger.info(f"Worker {worker.get_name()} started")
+        self._spawn(self.min_workers)
+        # Also runs at a fixed size, to replace workers that died
+        self._scaler = asyncio.create_task(self._scale_loop(), name="worker-scaler")
 
     async def stop(self):
         self._stopped.set()
         try:
-            for worker in self._workers:
-                logger.info(f"Stopping {worker.get_name()}")
-                worker.cancel()
+            if self._scaler:
+                self._scaler.cancel()
+                await asyncio.gather(self._scaler, return_exceptions=True)
+
+            tasks = [worker.task for worker in self._workers.values()]
+            for task in tasks:
+                logger.info(f"Stopping {task.get_name()}")
+                task.cancel()
 
-            await asyncio.gather(*self._workers, return_exceptions=True)
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._workers.clear()
             logger.info("Workers stopped")
         except Exception as e:
             logger.warning(f"Error while waiting for worker to end: {e}")
             pass
 
-    async def _worker_loop(self, worker_id: int):
+    def _spawn(self, count: int):
+        for _ in range(count):
+            worker_id = next(self._ids)
+            worker = self._workers[worker_id] = _Worker()
+            worker.task = asyncio.create_task(self._worker_loop(worker_id, worker), name=f"worker-{worker_id}")
+            logger.info(f"Worker {worker.task.get_name()} started")
+
+    def _retire(self, count: int):
+        """Cancel idle workers only; they are waiting on the queue and hold no task."""
+        idle = [worker_id for worker_id, worker in self._workers.items() if not worker.busy][:count]
+        for worker_id in idle:
+            self._workers.pop(worker_id).task.cancel()
+
+    def _p95(self) -> Optional[float]:
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def _reap(self):
+        """Drop worker tasks that ended on an error and refill the pool up to `min_workers`."""
+        dead = [worker_id for worker_id, worker in self._workers.items() if worker.task.done()]
+        for worker_id in dead:
+            task = self._workers.pop(worker_id).task
+            error = task.exception() if not task.cancelled() else None
+            logger.error(f"Worker {task.get_name()} died: {error!r}")
+            self._deaths += 1
+
+        if len(self._workers) < self.min_workers:
+            self._spawn(self.min_workers - len(self._workers))
+
+    def _scale(self):
+        self._reap()
+        now = time.monotonic()
+        size = len(self._workers)
+        busy = sum(1 for worker in self._workers.values() if worker.busy)
+        depth = self.queue.qsize()
+
+        # Parked tasks are backlog too, but more workers would not run them any sooner
+        if depth or self._parked:
+            self._last_backlog = now
+
+        if depth and size < self.max_workers and (self.queue.oldest_age() > self.target_wait or depth > size - busy):
+            # Workers needed to drain the backlog within target_wait at the current p95 latency
+            p95 = self._p95() or 1.0
+            desired = busy + math.ceil(depth * p95 / self.target_wait)
+            grow = min(self.max_workers - size, max(1, desired - size), max(1, size))
+            self._spawn(grow)
+            self._scale_ups += 1
+            logger.info(f"Scaled up to {size + grow} workers (depth {depth}, p95 {p95:.2f}s)")
+
+        elif size > self.min_workers and now - self._last_backlog >= self.idle_grace:
+            shrink = math.ceil((size - max(self.min_workers, busy)) / 2)
+            if shrink > 0:
+                self._retire(shrink)
+                self._scale_downs += 1
+                logger.info(f"Scaled down to {len(self._workers)} workers")
+
+    async def _scale_loop(self):
+        while not self._stopped.is_set():
+            await asyncio.sleep(self.scale_interval)
+            try:
+                self._scale()
+            except Exception as e:
+                logger.error(f"Worker scaling failed: {e}")
+
+    def _cap(self, exchange: str) -> Optional[int]:
+        return self.exchange_concurrency.get(exchange, self.default_exchange_concurrency)
+
+    async def _claim(self, task: Dict[str, Any]) -> Optional[str]:
+        """Reserve an exchange slot for `task`, or park it and return None."""
+        exchange = await self.exchange_of(task) or ""
+        cap = self._cap(exchange) if exchange else None
+        while True:
+            if cap is None or self._running.get(exchange, 0) < cap:
+                self._running[exchange] = self._running.get(exchange, 0) + 1
+                return exchange
+
+            parked = self._parked.setdefault(exchange, OrderedDict())
+            pending = parked.get(task["account_id"])
+            if pending is not None:
+                merge_tasks(pending, task)
+                return None
+
+            if len(parked) < self.max_parked:
+                parked[task["account_id"]] = task
+                return None
+
+            if self.queue.overflow == OVERFLOW_DROP_OLDEST:
+                parked.popitem(last=False)
+                self._parked_drops += 1
+                continue
+
+            self._room.clear()
+            await self._room.wait()
+
+    def _next_parked(self, exchange: str) -> Optional[Dict[str, Any]]:
+        parked = self._parked.get(exchange)
+        if not parked:
+            return None
+
+        _, task = parked.popitem(last=False)
+        if not parked:
+            del self._parked[exchange]
+        self._room.set()
+        return task
+
+    def _free(self, exchange: str):
+        self._running[exchange] -= 1
+        if not self._running[exchange]:
+            del self._running[exchange]
+        self._room.set()
+
+    async def _process(self, worker_id: int, task: Dict[str, Any]):
+        logger.debug("Worker[%s] processing %s for %s", worker_id, task.get("types"), task.get("account_id"))
+        started = time.monotonic()
+        try:
+            await self.processor.process(task)
+        except asyncio.CancelledError:
+            logger.info(f"Worker[{worker_id}] was cancelled during processing.")
+            raise
+        except Exception as e:
+            logger.warning("Worker %s error: %s", worker_id, e)
+        finally:
+            self._latencies.append(time.monotonic() - started)
+            self._processed += 1
+            await self.queue.task_done()
+
+    async def _worker_loop(self, worker_id: int, worker: _Worker):
         try:
             while not self._stopped.is_set():
                 task = await self.queue.get()
                 if not task:
-                    await asyncio.sleep(0.1)
                     continue
 
-                logger.info(f"Worker[{worker_id}] processing task: {task}")
-
+                worker.busy = True
                 try:
-                    await self.processor.process(task)
-                except asyncio.CancelledError:
-                    logger.info(f"Worker[{worker_id}] was cancelled during processing.")
-                    raise
-                except Exception as e:
-                    logger.warning(f"Worker {worker_id} error: {e}")
+                    if not self.exchange_of:
+                        await self._process(worker_id, task)
+                        continue
+
+                    try:
+                        exchange = await self._claim(task)
+                    except Exception as e:
+                        # Like a failed fetch: the scheduler enqueues the account again
+                        logger.warning("Worker %s dropped task for %s, exchange lookup failed: %s", worker_id, task.get("account_id"), e)
+                        self._unresolved += 1
+                        await self.queue.task_done()
+                        continue
+
+                    # The slot stays with this worker while parked tasks of the exchange remain
+                    while exchange is not None and task is not None:
+                        try:
+                            await self._process(worker_id, task)
+                        except asyncio.CancelledError:
+                            self._free(exchange)
+                            raise
+
+                        task = self._next_parked(exchange)
+                        if task is None:
+                            self._free(exchange)
                 finally:
-                    await self.queue.task_done()
+                    worker.busy = False
         except asyncio.CancelledError:
             logger.info(f"Worker[{worker_id}] cancelled.")
             raise
+
+    def stats(self) -> Dict[str, Any]:
+        p95 = self._p95()
+        return {
+            "workers": len(self._workers),
+            "busy": sum(1 for worker in self._workers.values() if worker.busy),
+            "processed": self._processed,
+            "p95_latency_s": round(p95, 3) if p95 is not None else None,
+            "scale_ups": self._scale_ups,
+            "scale_downs": self._scale_downs,
+            "deaths": self._deaths,
+            "unresolved": self._unresolved,
+            "running_by_exchange": dict(self._running),
+            "parked_by_exchange": {exchange: len(tasks) for exchange, tasks in self._parked.items()},
+            "parked_drops": self._parked_drops,
+        }
@@ -0,0 +1,199 @@
+import asyncio
+import itertools
+from typing import Dict, List, Optional, Type
+from app.ccxt.binance_stream import BinanceUserStreamSession
+from app.ws_sessions import CcxtAccountSession, StreamSession, UpdateCallback
+from app.utils.logging import get_logger
+
+logger = get_logger("ws_connections")
+
+# Exchanges whose user streams can be multiplexed over a shared connection
+SESSION_TYPES: Dict[str, Type[StreamSession]] = {
+    "binance": BinanceUserStreamSession,
+}
+
+
+class StreamConnectionManager:
+    """
+    Places streaming accounts onto sessions (shards). Accounts go to the least loaded
+    session of their exchange that still has room; a new session is opened only when
+    all of them are full, and emptied sessions are closed.
+    """
+
+    def __init__(self, on_update: UpdateCallback, rebalance_interval: float = 300):
+        self.on_update = on_update
+        self.rebalance_interval = rebalance_interval
+        # exchange -> sessions
+        self._sessions: Dict[str, List[StreamSession]] = {}
+        # account_id -> session
+        self._placement: Dict[str, StreamSession] = {}
+        # account_id -> resolved once its connect or move has finished
+        self._connecting: Dict[str, asyncio.Future] = {}
+        self._rebalancing = asyncio.Lock()
+        self._ids = itertools.count(1)
+        self._rebalancer: Optional[asyncio.Task] = None
+        self.moves = 0
+
+    def __contains__(self, account_id: str) -> bool:
+        return account_id in self._placement or account_id in self._connecting
+
+    def start(self):
+        if not self._rebalancer:
+            self._rebalancer = asyncio.create_task(self._rebalance_loop(), name="ws-rebalance")
+
+    async def stop(self):
+        if self._rebalancer:
+            self._rebalancer.cancel()
+            await asyncio.gather(self._rebalancer, return_exceptions=True)
+            self._rebalancer = None
+
+        sessions = [session for sessions in self._sessions.values() for session in sessions]
+        self._sessions.clear()
+        self._placement.clear()
+        await asyncio.gather(*(session.close() for session in sessions), return_exceptions=True)
+
+    def _new_session(self, exchange: str) -> StreamSession:
+        session_type = SESSION_TYPES.get(exchange, CcxtAccountSession)
+        session = session_type(exchange, f"{exchange}-{next(self._ids)}", self.on_update)
+        self._sessions.setdefault(exchange, []).append(session)
+        return session
+
+    def _select(self, exchange: str) -> StreamSession:
+        candidates = [session for session in self._sessions.get(exchange, []) if not session.full]
+        if candidates:
+            return min(candidates, key=lambda session: session.load)
+        return self._new_session(exchange)
+
+    async def _discard_if_empty(self, session: StreamSession):
+        if session.load:
+            return
+
+        sessions = self._sessions.get(session.exchange, [])
+        if session not in sessions:
+            return
+        sessions.remove(session)
+        if not sessions:
+            self._sessions.pop(session.exchange, None)
+        await session.close()
+
+    def _begin(self, account_id: str) -> asyncio.Future:
+        """Marks the account as connecting or moving; `remove` waits for the returned future."""
+        done = self._connecting[account_id] = asyncio.get_running_loop().create_future()
+        return done
+
+    def _end(self, account_id: str, done: asyncio.Future):
+        if self._connecting.get(account_id) is done:
+            del self._connecting[account_id]
+        done.set_result(None)
+
+    async def add(self, account_id: str, exchange: str, credentials: dict):
+        # Placement is decided and the slot reserved without awaiting, so connects run
+        # concurrently instead of one after another
+        if account_id in self._placement or account_id in self._connecting:
+            return
+
+        session = self._select(exchange)
+        session.reserved += 1
+        done = self._begin(account_id)
+        try:
+            await session.add_account(account_id, credentials)
+        except BaseException:
+            session.reserved -= 1
+            self._end(account_id, done)
+            await self._discard_if_empty(session)
+            raise
+
+        session.reserved -= 1
+        self._placement[account_id] = session
+        self._end(account_id, done)
+        logger.info(f"Placed account[{account_id}] on {session.name} ({session.load}/{session.capacity})")
+
+    async def remove(self, account_id: str):
+        connecting = self._connecting.get(account_id)
+        if connecting:
+            await asyncio.shield(connecting)
+
+        session = self._placement.pop(account_id, None)
+        if not session:
+            return
+
+        await session.remove_account(account_id)
+        await self._discard_if_empty(session)
+
+    async def rebalance(self):
+        """Drain the least loaded shared sessions into the others when fewer would do."""
+        async with self._rebalancing:
+            for exchange, sessions in list(self._sessions.items()):
+                capacity = sessions[0].capacity if sessions else 1
+                if capacity <= 1:
+                    continue
+
+                load = sum(session.load for session in sessions)
+                needed = max(1, -(-load // capacity))
+                if len(sessions) <= needed:
+                    continue
+
+                ordered = sorted(sessions, key=lambda session: session.load)
+                for source in ordered[:len(sessions) - needed]:
+                    for account_id, credentials in list(source.accounts.items()):
+                        if self._placement.get(account_id) is not source or account_id in self._connecting:
+                            continue
+
+                        targets = [s for s in self._sessions.get(exchange, []) if s is not source and not s.full]
+                        if not targets:
+                            break
+
+                        target = max(targets, key=lambda session: session.load)
+                        target.reserved += 1
+                        done = self._begin(account_id)
+                        try:
+                            await self._move(account_id, credentials, source, target)
+                        finally:
+                            target.reserved -= 1
+                            self._end(account_id, done)
+
+                    await self._discard_if_empty(source)
+
+    async def _move(self, account_id: str, credentials: dict, source: StreamSession, target: StreamSession):
+        # Binance hands out the same listenKey per API key, so the old
+        # subscription has to go before the new one is created
+        await source.remove_account(account_id)
+        try:
+            await target.add_account(account_id, credentials)
+        except Exception as e:
+            logger.error(f"Failed to move account[{account_id}] to {target.name}: {e}")
+            try:
+                await source.add_account(account_id, credentials)
+            except Exception as e:
+                logger.error(f"Failed to restore account[{account_id}] on {source.name}: {e}")
+                self._placement.pop(account_id, None)
+            return
+
+        self._placement[account_id] = target
+        self.moves += 1
+
+    async def _rebalance_loop(self):
+        while True:
+            await asyncio.sleep(self.rebalance_interval)
+            try:
+                await self.rebalance()
+            except Exception as e:
+                logger.error(f"Rebalance failed: {e}")
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "accounts": len(self._placement),
+            "moves": self.moves,
+            "sessions": {
+                exchange: {
+                    "count": len(sessions),
+                    "connecting": sum(session.reserved for session in sessions),
+                    "accounts": sum(len(session.accounts) for session in sessions),
+                    "capacity": sessions[0].capacity if sessions else 0,
+                    "errors": sum(session.errors for session in sessions),
+                    "stale": sum(session.stale for session in sessions),
+                    "gap_fills": sum(session.gap_fills for session in sessions),
+                }
+                for exchange, sessions in self._sessions.items()
+            },
+        }
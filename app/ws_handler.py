@@ -1,103 +1,115 @@
 import asyncio
-from typing import Dict
-from app.nats_publisher import nats_publisher
-from app.ccxt.adapters import get_adapter, BaseAdapter
-from app.credentials import get_credentials_for_account
+import time
+from typing import Dict, List, Optional, Tuple
+from app.delta_publisher import delta_publisher
+from app.snapshot_store import snapshot_store
+from app.records import Record
+from app.credentials import credentials_cache
 from app.account_registry import STREAMING_ACCOUNTS
+from app.sharding import ShardCoordinator
+from app.ws_connections import StreamConnectionManager
+from app.utils.ramp import ramp
+from app.metrics import WS_MESSAGES, WS_UPDATE_GAP, record_ws_update
 from app.utils.logging import get_logger
 
 logger = get_logger("ws_handler")
 
 
 class WebsocketHandler:
-    def __init__(self):
-        # account_id -> asyncio.Task
-        self.listening_accounts: Dict[str, asyncio.Task] = {}
-        self.listening = True
-
-    async def _watch_stream(self, adapter: BaseAdapter, account_id: str, exchange_id: str, stream_type: str):
-        topic_prefix = f"{stream_type}_ws.{exchange_id}.{account_id}"
-
-        while self.listening and account_id in self.listening_accounts:
-            try:
-                data = None
-
-                if stream_type == "balance":
-                    data = await asyncio.wait_for(adapter.watch_balance(), timeout=60.0)
-                elif stream_type == "positions":
-                    data = await asyncio.wait_for(adapter.watch_positions(), timeout=60.0)
-                else:
-                    logger.warning(f"Unknown stream type: {stream_type}")
-                    return
-
-                if not data:
-                    continue
-                
-                await nats_publisher.publish(topic_prefix, data)
-
-            except asyncio.TimeoutError:
-                logger.warning(f"No {stream_type} updates for {exchange_id}:{account_id} in 60s.")
-                continue
-            except Exception as e:
-                logger.error(f"WebSocket error ({stream_type}) for {exchange_id}:{account_id}: {e}")
-                await asyncio.sleep(5)
-
-    async def _account_runner(self, account_id):
-        creds_info = await get_credentials_for_account(account_id)
-        exchange_id = creds_info.get("exchange")
-        credentials = creds_info.get("credentials")
-
-        exchange_adapter = await get_adapter(exchange_id, credentials)
+    def __init__(self, shard: Optional[ShardCoordinator] = None):
+        self.connections = StreamConnectionManager(self._on_update)
+        # When set, only accounts of this instance's shard are streamed
+        self.shard = shard
+        self._starting: Optional[asyncio.Task] = None
+        # (account_id, stream type) -> monotonic time of the last update
+        self._last_update: Dict[Tuple[str, str], float] = {}
+
+    async def _on_update(self, account_id: str, exchange_id: str, stream_type: str, records: List[Record]):
+        now = time.monotonic()
+        previous = self._last_update.get((account_id, stream_type))
+        self._last_update[(account_id, stream_type)] = now
+        WS_MESSAGES.labels(exchange_id, stream_type).inc()
+        if previous is not None:
+            WS_UPDATE_GAP.labels(exchange_id, stream_type).observe(now - previous)
+        record_ws_update(account_id, stream_type)
+
+        snapshot_store.update(account_id, exchange_id, stream_type, records, source="ws")
+        await delta_publisher.publish(f"{stream_type}_ws", exchange_id, account_id, records)
 
-        async with exchange_adapter as adapter:
-            logger.info(f"Started websocket listener for {exchange_id}:{account_id}")
-
-            # Run multiple watchers concurrently using the same adapter
-            watchers = [
-                asyncio.create_task(self._watch_stream(adapter, account_id, exchange_id, "balance")),
-                asyncio.create_task(self._watch_stream(adapter, account_id, exchange_id, "positions")),
-            ]
+    async def watch_account(self, account_id: str):
+        if account_id in self.connections:
+            logger.warning(f"Already streaming for account[{account_id}]")
+            return
 
-            done, pending = await asyncio.wait(watchers, return_when=asyncio.FIRST_EXCEPTION)
+        if self.shard and not self.shard.owns(account_id):
+            logger.debug(f"Account[{account_id}] belongs to another instance, not streaming")
+            return
 
-            # Cancel any remaining watchers
-            for task in pending:
-                task.cancel()
+        creds_info = await credentials_cache.get(account_id)
+        if not creds_info:
+            logger.warning(f"No credentials for {account_id}, not streaming")
+            return
 
-            logger.info(f"Stopped websocket listener for {exchange_id}:{account_id}")
+        exchange_id = creds_info.get("exchange")
+        credentials = creds_info.get("credentials")
 
-    async def watch_account(self, account_id: str):
-        if account_id in self.listening_accounts:
-            logger.warning(f"Already streaming for account[{account_id}]")
+        try:
+            await self.connections.add(account_id, exchange_id, credentials)
+        except Exception as e:
+            logger.error(f"Failed to start websocket listener for {exchange_id}:{account_id}: {e}")
             return
 
-        task = asyncio.create_task(self._account_runner(account_id))
-        self.listening_accounts[account_id] = task
         logger.info(f"Added account[{account_id}] to websocket listening.")
 
     async def unwatch_account(self, account_id: str):
-        task = self.listening_accounts.pop(account_id, None)
-        if not task:
+        if account_id not in self.connections:
             logger.warning(f"Not listening for account[{account_id}]")
             return
 
         logger.info(f"Stopping websocket listener for account[{account_id}]...")
-        task.cancel()
-        await asyncio.gather(task, return_exceptions=True)
+        await self.connections.remove(account_id)
+        for key in [key for key in self._last_update if key[0] == account_id]:
+            del self._last_update[key]
         logger.info(f"Account[{account_id}] listener stopped.")
 
-    async def start(self):
-        for account_id in STREAMING_ACCOUNTS.keys():
+    async def reconnect(self, account_id: str):
+        """Restart an account's stream, e.g. with rotated credentials."""
+        if account_id in self.connections:
+            await self.unwatch_account(account_id)
             await self.watch_account(account_id)
 
-    async def stop(self):
-        logger.info("Stopping all websocket listeners...")
-        self.listening = False
+    async def _watch_registered(self, account_id: str):
+        # Ramped connects run late; skip accounts deregistered in the meantime
+        if account_id in STREAMING_ACCOUNTS:
+            await self.watch_account(account_id)
 
-        for account_id, task in list(self.listening_accounts.items()):
-            task.cancel()
-            logger.info(f"Canceled task for account[{account_id}]")
+    async def rebalance(self):
+        """After a membership change, stream the accounts this instance gained and stop the ones it lost."""
+        for account_id in list(STREAMING_ACCOUNTS.keys()):
+            owned = not self.shard or self.shard.owns(account_id)
+            if owned and account_id not in self.connections:
+                await self.watch_account(account_id)
+            elif not owned and account_id in self.connections:
+                await self.unwatch_account(account_id)
+
+    async def start(self, ramp_seconds: float = 0.0):
+        """Stream every registered account, with connects spread over `ramp_seconds` in the background."""
+        self.connections.start()
+        account_ids = list(STREAMING_ACCOUNTS.keys())
+        if not ramp_seconds:
+            for account_id in account_ids:
+                await self.watch_account(account_id)
+            return
+
+        self._starting = asyncio.create_task(ramp(account_ids, self._watch_registered, ramp_seconds), name="ws-start-ramp")
 
-        await asyncio.gather(*self.listening_accounts.values(), return_exceptions=True)
-        self.listening_accounts.clear()
+    async def stop(self):
+        logger.info("Stopping all websocket listeners...")
+        if self._starting:
+            self._starting.cancel()
+            await asyncio.gather(self._starting, return_exceptions=True)
+        await self.connections.stop()
         logger.info("All websocket listeners stopped.")
+
+    def stats(self) -> Dict[str, object]:
+        return self.connections.stats()
@@ -0,0 +1,173 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional
+from app.ccxt.adapters import BaseAdapter
+from app.ccxt.adapter_pool import adapter_pool
+from app.records import Record
+from app.stream_health import stream_health
+from app.utils.backoff import Backoff
+from app.utils.logging import get_logger
+
+logger = get_logger("ws_sessions")
+
+# (account_id, exchange, stream type, records)
+UpdateCallback = Callable[[str, str, str, List[Record]], Awaitable[None]]
+
+STREAM_TYPES = ("balance", "positions")
+
+# Seconds without a streamed update before the state is re-fetched over REST
+STALE_AFTER = 60.0
+
+# A stream that neither updated nor passed a stale check for this long counts as degraded
+HEALTH_TTL = 2.5 * STALE_AFTER
+
+
+class StreamSession:
+    """
+    One exchange connection (or group of connections) serving up to `capacity` accounts.
+    Sessions report every update through `on_update`; the connection manager decides which
+    session an account lives on.
+    """
+
+    capacity = 1
+
+    def __init__(self, exchange: str, name: str, on_update: UpdateCallback):
+        self.exchange = exchange
+        self.name = name
+        self.on_update = on_update
+        # account_id -> credentials
+        self.accounts: Dict[str, dict] = {}
+        self.errors = 0
+        self.stale = 0
+        self.gap_fills = 0
+        # Slots taken by accounts still connecting
+        self.reserved = 0
+
+    @property
+    def load(self) -> int:
+        return len(self.accounts) + self.reserved
+
+    @property
+    def full(self) -> bool:
+        return self.load >= self.capacity
+
+    async def add_account(self, account_id: str, credentials: dict):
+        raise NotImplementedError()
+
+    async def remove_account(self, account_id: str):
+        raise NotImplementedError()
+
+    async def close(self):
+        for account_id in list(self.accounts):
+            await self.remove_account(account_id)
+
+
+class CcxtAccountSession(StreamSession):
+    """
+    A ccxt.pro client per account. ccxt authenticates the socket itself, so the connection
+    cannot be shared between API keys; this is the fallback for exchanges without a
+    multiplexed session.
+    """
+
+    capacity = 1
+
+    def __init__(self, exchange: str, name: str, on_update: UpdateCallback):
+        super().__init__(exchange, name, on_update)
+        self._runners: Dict[str, asyncio.Task] = {}
+
+    async def add_account(self, account_id: str, credentials: dict):
+        self.accounts[account_id] = credentials
+        self._runners[account_id] = asyncio.create_task(
+            self._account_runner(account_id, credentials), name=f"ws-{self.exchange}-{account_id}"
+        )
+
+    async def remove_account(self, account_id: str):
+        self.accounts.pop(account_id, None)
+        runner = self._runners.pop(account_id, None)
+        if runner:
+            runner.cancel()
+            await asyncio.gather(runner, return_exceptions=True)
+
+    async def _gap_fill(self, adapter: BaseAdapter, account_id: str, stream_type: str, pending: asyncio.Task):
+        """One-off REST fetch covering whatever the stream missed while it was down or silent."""
+        fetch = adapter.fetch_balance if stream_type == "balance" else adapter.fetch_positions
+        try:
+            records = await fetch()
+        except Exception as e:
+            logger.error(f"Gap fill ({stream_type}) failed for {self.exchange}:{account_id}: {e}")
+            return
+
+        # A streamed update that arrived meanwhile is newer than the REST result
+        if records is None or pending.done():
+            return
+
+        self.gap_fills += 1
+        await self.on_update(account_id, self.exchange, stream_type, records)
+
+    async def _watch_stream(self, adapter: BaseAdapter, account_id: str, stream_type: str):
+        watch = adapter.watch_balance if stream_type == "balance" else adapter.watch_positions
+        backoff = Backoff()
+        gap_fill = True
+        pending: Optional[asyncio.Task] = None
+
+        try:
+            while account_id in self.accounts:
+                if pending is None:
+                    pending = asyncio.create_task(watch())
+
+                if gap_fill:
+                    gap_fill = False
+                    await self._gap_fill(adapter, account_id, stream_type, pending)
+
+                done, _ = await asyncio.wait({pending}, timeout=STALE_AFTER)
+                if not done:
+                    logger.warning(f"No {stream_type} updates for {self.exchange}:{account_id} in {STALE_AFTER:.0f}s, refreshing over REST")
+                    self.stale += 1
+                    # The watch call is still pending without error, so the socket is alive
+                    stream_health.mark_up(account_id, stream_type, HEALTH_TTL)
+                    gap_fill = True
+                    continue
+
+                task, pending = pending, None
+                try:
+                    data = task.result()
+                except Exception as e:
+                    delay = backoff.next_delay()
+                    logger.error(f"WebSocket error ({stream_type}) for {self.exchange}:{account_id}: {e}, reconnecting in {delay:.1f}s")
+                    self.errors += 1
+                    stream_health.mark_down(account_id, stream_type)
+                    await asyncio.sleep(delay)
+                    gap_fill = True
+                    continue
+
+                backoff.reset()
+                if data is None:
+                    logger.info(f"{self.exchange} does not stream {stream_type}")
+                    return
+
+                stream_health.mark_up(account_id, stream_type, HEALTH_TTL)
+                await self.on_update(account_id, self.exchange, stream_type, data)
+        finally:
+            stream_health.forget(account_id, stream_type)
+            if pending:
+                pending.cancel()
+                await asyncio.gather(pending, return_exceptions=True)
+
+    async def _account_runner(self, account_id: str, credentials: dict):
+        async with adapter_pool.lease(account_id, self.exchange, credentials) as adapter:
+            logger.info(f"Started websocket listener for {self.exchange}:{account_id}")
+
+            # Run multiple watchers concurrently using the same adapter
+            watchers = [
+                asyncio.create_task(self._watch_stream(adapter, account_id, stream_type))
+                for stream_type in STREAM_TYPES
+            ]
+
+            try:
+                await asyncio.wait(watchers, return_when=asyncio.FIRST_EXCEPTION)
+            finally:
+                # Cancel any remaining watchers
+                for task in watchers:
+                    task.cancel()
+                await asyncio.gather(*watchers, return_exceptions=True)
+
+            logger.info(f"Stopped websocket listener for {self.exchange}:{account_id}")
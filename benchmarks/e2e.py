@@ -0,0 +1,213 @@
+"""
+End-to-end load benchmark of the polling path:
+TaskScheduler -> TaskQueue -> WorkerPool -> FetchTaskHandler -> DeltaPublisher, with the
+adapters running against simulated exchanges and messages going to an in-process NATS sink.
+
+    python -m benchmarks.e2e --accounts 1000 10000 100000 --duration 60
+
+Reports per account count: fetch throughput, p50/p99 fetch-to-publish latency (task start
+to the publish of each fetch type), queue wait, RSS and CPU per account.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import resource
+import time
+from typing import Any, Dict, List, Optional
+
+from benchmarks.nats_sink import NatsSink
+from benchmarks.sim_exchange import SimConfig, install, uninstall
+from app.activity_tracker import activity_tracker
+from app.ccxt.adapter_pool import adapter_pool
+from app.ccxt.market_cache import market_cache
+from app.ccxt.rate_limiter import rate_limiter
+from app.credentials import StaticCredentialsBackend, credentials_cache
+from app.delta_publisher import delta_publisher
+from app.records import Record
+from app.snapshot_store import snapshot_store
+from app.task_handler import FetchTaskHandler, exchange_of, store_result
+from app.task_scheduler import TaskScheduler
+from app.utils.queue import TaskQueue, OVERFLOW_DROP_OLDEST
+from app.worker_pool import WorkerPool
+
+EXCHANGES = ("binance", "bybit", "deribit", "gateio")
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # Peak instead of current RSS where /proc is unavailable (kilobytes on Linux, bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class TimedHandler:
+    """FetchTaskHandler recording the time from task start to the publish of each fetch type."""
+
+    def __init__(self):
+        self.handler = FetchTaskHandler(on_result=self._on_result)
+        self.latencies: List[float] = []
+        self.queue_waits: List[float] = []
+        self.tasks = 0
+        self._started: Dict[str, float] = {}
+
+    async def process(self, task: Dict[str, Any]):
+        self.queue_waits.append(time.time() - task.get("enqueued_at", time.time()))
+        self._started[task["account_id"]] = time.perf_counter()
+        try:
+            await self.handler.process(task)
+        finally:
+            self._started.pop(task["account_id"], None)
+            self.tasks += 1
+
+    async def _on_result(self, account_id: str, exchange: str, fetch_type: str, records: List[Record], changed: bool):
+        await store_result(account_id, exchange, fetch_type, records, changed)
+        started = self._started.get(account_id)
+        if started is not None:
+            self.latencies.append(time.perf_counter() - started)
+
+
+async def run(accounts: int, args: argparse.Namespace) -> Dict[str, Any]:
+    account_ids = [f"bench-{accounts}-{i}" for i in range(accounts)]
+    registry = {
+        account_id: {
+            "account_id": account_id,
+            "intervals": {"balance": args.interval, "funding_fees": args.interval * 2},
+            "mode": "poll",
+            "types": None,
+        }
+        for account_id in account_ids
+    }
+    credentials_cache.backend = StaticCredentialsBackend({
+        account_id: {"exchange": EXCHANGES[i % len(EXCHANGES)], "credentials": {"apiKey": account_id, "secret": "simulated"}}
+        for i, account_id in enumerate(account_ids)
+    })
+    credentials_cache.max_size = max(credentials_cache.max_size, accounts)
+    adapter_pool.max_size = max(adapter_pool.max_size, accounts)
+
+    sink = NatsSink()
+    delta_publisher.publisher = sink
+    sim_stats = install(SimConfig(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+        change_rate=args.change_rate,
+    ))
+
+    queue = TaskQueue(maxsize=max(100_000, accounts), overflow=OVERFLOW_DROP_OLDEST)
+    handler = TimedHandler()
+    scheduler = TaskScheduler(registry, queue)
+    pool = WorkerPool(
+        queue,
+        handler,
+        min_workers=args.min_workers,
+        max_workers=args.workers,
+        exchange_of=exchange_of,
+        default_exchange_concurrency=max(1, args.workers // 2),
+    )
+
+    rss_before = rss_bytes()
+    cpu_before = time.process_time()
+    started = time.perf_counter()
+
+    await adapter_pool.start()
+    await scheduler.start()
+    await pool.start()
+    try:
+        await asyncio.sleep(args.duration)
+    finally:
+        await scheduler.stop()
+
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_before
+    rss = rss_bytes() - rss_before
+    workers = pool.stats()["workers"]
+    # Tasks still running are cancelled and not counted
+    await pool.stop()
+
+    result = {
+        "accounts": accounts,
+        "duration_s": round(elapsed, 1),
+        "tasks": handler.tasks,
+        "fetches": len(handler.latencies),
+        "fetches_per_s": round(len(handler.latencies) / elapsed, 1),
+        "published": sink.published,
+        "published_mb": round(sink.bytes / 1e6, 2),
+        "p50_fetch_to_publish_ms": _ms(percentile(handler.latencies, 0.50)),
+        "p99_fetch_to_publish_ms": _ms(percentile(handler.latencies, 0.99)),
+        "p99_queue_wait_ms": _ms(percentile(handler.queue_waits, 0.99)),
+        "queue_drops": queue.stats()["drops"],
+        "rss_kb_per_account": round(rss / 1024 / accounts, 2),
+        "cpu_ms_per_account": round(cpu * 1000 / accounts, 3),
+        "cpu_utilization": round(cpu / elapsed, 2),
+        "workers": workers,
+        "exchange": sim_stats.as_dict(),
+    }
+
+    for account_id in account_ids:
+        delta_publisher.forget(account_id)
+        snapshot_store.remove(account_id)
+        activity_tracker.forget(account_id)
+        credentials_cache.invalidate(account_id)
+    await adapter_pool.stop()
+    uninstall()
+    return result
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+def _rate_limit(value: str):
+    requests, _, seconds = value.partition("/")
+    return int(requests), float(seconds or 1)
+
+
+async def main(args: argparse.Namespace):
+    # Per-task logging would dominate the measurement
+    for name in list(logging.root.manager.loggerDict):
+        logging.getLogger(name).setLevel(logging.ERROR)
+
+    # Measure the service, not the exchanges' published limits, unless asked to
+    rate_limiter.share = args.rate_limit_share
+    await market_cache.start()
+
+    results = []
+    for accounts in args.accounts:
+        result = await run(accounts, args)
+        results.append(result)
+        print(json.dumps(result), flush=True)
+
+    await market_cache.stop()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": {k: v for k, v in vars(args).items() if k != "output"}, "results": results}, f, indent=2)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--accounts", type=int, nargs="+", default=[1000, 10_000, 100_000])
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds per account count")
+    parser.add_argument("--interval", type=int, default=10, help="balance polling interval in seconds (funding: twice that)")
+    parser.add_argument("--workers", type=int, default=256, help="maximum workers")
+    parser.add_argument("--min-workers", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated exchange latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of simulated calls failing")
+    parser.add_argument("--rate-limit", type=_rate_limit, default=None, help="simulated per-connector limit, e.g. 1200/60")
+    parser.add_argument("--rate-limit-share", type=float, default=1000.0, help="multiplier on the adapters' rate-limit budgets")
+    parser.add_argument("--change-rate", type=float, default=0.2, help="chance that an account changed between fetches")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,210 @@
+"""
+Replay micro-benchmarks of the per-account hot path over recorded fixtures
+(`benchmarks/fixtures/<exchange>/*.json`, see `benchmarks.record`). Each fixture runs
+through three stages:
+
+- parse: response unwrapping and filtering into records (`app/ccxt/parsers.py`)
+- diff: indexing and comparison against the previous result, as `DeltaPublisher` does
+  on an unchanged tick
+- encode: snapshot serialization and payload encoding, as `NatsPublisher` does
+
+    python -m benchmarks.micro                    # compare against baselines/micro.json
+    python -m benchmarks.micro --update-baseline  # rewrite the baseline
+
+Throughput is compared as `relative`: stage calls per call of a fixed calibration loop
+timed in runs alternating with the stage's, so CPU frequency, load from other
+processes and the machine itself largely cancel out. A stage fails the comparison when
+its relative throughput drops more than `--tolerance` below the baseline or its peak
+allocation grows more than `--alloc-tolerance` above it, also when measured again.
+Absolute ops/s are reported for information only.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from app.ccxt.parsers import (
+    parse_balances,
+    parse_binance_simple_earn,
+    parse_bybit_earn,
+    parse_deribit_settlements,
+    parse_funding_history,
+    parse_gateio_uni_lends,
+    parse_positions,
+)
+from app.delta_publisher import index_items, serialize_items
+from app.nats_publisher import ENCODINGS
+from app.records import Record
+
+BENCHMARKS_DIR = os.path.dirname(__file__)
+FIXTURES_DIR = os.path.join(BENCHMARKS_DIR, "fixtures")
+BASELINE_PATH = os.path.join(BENCHMARKS_DIR, "baselines", "micro.json")
+
+INVERSE_CONNECTORS = {"binancecoinm"}
+
+# method -> parser of its recorded response, given the fixture
+PARSERS: Dict[str, Callable[[Dict[str, Any]], List[Record]]] = {
+    "fetch_balance": lambda f: parse_balances(f["response"]),
+    "fetch_positions": lambda f: parse_positions(
+        f["response"],
+        "option" if f["params"].get("kind") == "option" else "inverse" if f["connector"] in INVERSE_CONNECTORS else "linear",
+    ),
+    "fetch_option_positions": lambda f: parse_positions(f["response"], "option"),
+    "fetch_funding_history": lambda f: parse_funding_history(f["response"]),
+    "sapi_get_simple_earn_flexible_position": lambda f: parse_binance_simple_earn(f["response"], "flexible"),
+    "sapi_get_simple_earn_locked_position": lambda f: parse_binance_simple_earn(f["response"], "locked"),
+    "private_get_v5_earn_position": lambda f: parse_bybit_earn(f["response"]),
+    "private_earn_get_uni_lends": lambda f: parse_gateio_uni_lends(f["response"]),
+    "private_get_get_settlement_history_by_currency": lambda f: parse_deribit_settlements(f["response"], f["params"].get("currency", "BTC")),
+}
+
+
+def load_fixtures(directory: str) -> List[Tuple[str, Dict[str, Any]]]:
+    fixtures = []
+    for path in sorted(glob.glob(os.path.join(directory, "*", "*.json"))):
+        with open(path) as f:
+            fixture = json.load(f)
+        if fixture.get("method") in PARSERS:
+            name = f"{fixture['exchange']}/{os.path.basename(path)[:-len('.json')]}"
+            fixtures.append((name, fixture))
+    return fixtures
+
+
+def stages(fixture: Dict[str, Any], encoding: str) -> Dict[str, Callable[[], Any]]:
+    parse = PARSERS[fixture["method"]]
+    encode = ENCODINGS[encoding][1]
+    records = parse(fixture)
+    previous = index_items(parse(fixture))
+
+    def diff():
+        items = index_items(records)
+        changed = {key: item for key, item in items.items() if previous.get(key) != item}
+        removed = [key for key in previous if key not in items]
+        return changed, removed
+
+    def snapshot():
+        message = {"kind": "snapshot", "seq": 1, "stream": fixture["method"], "exchange": fixture["exchange"],
+                   "account_id": "benchmark", "timestamp": 0, "items": serialize_items(index_items(records))}
+        return encode(message)
+
+    return {"parse": lambda: parse(fixture), "diff": diff, "encode": snapshot}
+
+
+_CALIBRATION_ITEMS = [{"currency": f"C{i}", "total": i * 1.5, "free": float(i), "used": i * 0.5} for i in range(32)]
+
+
+def calibrate():
+    """Fixed interpreter work of the same kind as the stages: dict building, comparison, JSON."""
+    items = {item["currency"]: dict(item) for item in _CALIBRATION_ITEMS}
+    changed = [key for key, item in items.items() if item != _CALIBRATION_ITEMS[0]]
+    return json.dumps({"items": list(items.values()), "changed": changed})
+
+
+def _rate(func: Callable[[], Any], min_time: float) -> float:
+    """Calls per second of one run of at least `min_time` seconds."""
+    calls = 0
+    started = time.perf_counter()
+    while True:
+        func()
+        calls += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            return calls / elapsed
+
+
+def measure(func: Callable[[], Any], min_time: float, repeats: int) -> Dict[str, float]:
+    """Throughput, absolute and relative to the calibration loop, and peak allocation of one call."""
+    func()
+    calibrate()
+    # Calibration and stage runs alternate, so both see the same machine state
+    reference = ops = 0.0
+    for _ in range(repeats):
+        reference = max(reference, _rate(calibrate, min_time))
+        ops = max(ops, _rate(func, min_time))
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {"ops_per_s": round(ops, 1), "relative": round(ops / reference, 4), "peak_kb": round(peak / 1024, 2)}
+
+
+def run(
+    fixtures_dir: str, encoding: str, min_time: float, repeats: int, only: Optional[str] = None, keys: Optional[Set[str]] = None
+) -> Dict[str, Dict[str, float]]:
+    results = {}
+    for name, fixture in load_fixtures(fixtures_dir):
+        if only and only not in name:
+            continue
+        for stage, func in stages(fixture, encoding).items():
+            key = f"{name}:{stage}"
+            if keys is None or key in keys:
+                results[key] = measure(func, min_time, repeats)
+    return results
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], tolerance: float, alloc_tolerance: float) -> List[Tuple[str, str]]:
+    """(stage key, message) per regression."""
+    failures = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        # Baselines from before the calibration loop only hold absolute numbers, which are not gated
+        if "relative" in base and result["relative"] < base["relative"] * (1 - tolerance):
+            failures.append((key, f"{key}: {result['relative']}x calibration, baseline {base['relative']}x"))
+        # 1 KB of slack keeps tiny stages from failing on allocator noise
+        if result["peak_kb"] > base["peak_kb"] * (1 + alloc_tolerance) + 1:
+            failures.append((key, f"{key}: peak {result['peak_kb']} KB, baseline {base['peak_kb']} KB"))
+    return failures
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixtures", default=FIXTURES_DIR)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--encoding", default="json", choices=sorted(ENCODINGS))
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per throughput run")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--only", help="run fixtures whose name contains this")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="allowed relative throughput drop against the baseline")
+    parser.add_argument("--alloc-tolerance", type=float, default=0.1, help="allowed peak allocation growth against the baseline")
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args(argv)
+
+    results = run(args.fixtures, args.encoding, args.min_time, args.repeats, args.only)
+    for key, result in results.items():
+        print(f"{key:<90} {result['ops_per_s']:>12.1f} ops/s {result['relative']:>9.4f}x {result['peak_kb']:>10.2f} KB")
+
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Wrote {len(results)} baselines to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --update-baseline")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    failures = compare(results, baseline, args.tolerance, args.alloc_tolerance)
+    if failures:
+        # Regressed stages are measured once more; a stall of the machine rarely hits twice
+        retried = run(args.fixtures, args.encoding, args.min_time, args.repeats, args.only, {key for key, _ in failures})
+        failures = compare(retried, baseline, args.tolerance, args.alloc_tolerance)
+    for _, failure in failures:
+        print(f"REGRESSION {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,42 @@
+"""
+In-process stand-in for `NatsPublisher`. Messages are encoded like the real publisher
+would encode them and then dropped, keeping message and byte counts.
+"""
+import json
+from typing import Any, Callable, Dict, List
+
+
+class NatsSink:
+    def __init__(self, encode: Callable[[Any], bytes] = lambda data: json.dumps(data).encode()):
+        self.encode = encode
+        self.connected = False
+        self.published = 0
+        self.bytes = 0
+        self.by_stream: Dict[str, int] = {}
+        self._subscriptions: Dict[str, List[Callable]] = {}
+
+    async def connect(self):
+        self.connected = True
+
+    async def disconnect(self):
+        self.connected = False
+
+    async def subscribe(self, subject: str, cb):
+        self._subscriptions.setdefault(subject, []).append(cb)
+
+    def decode(self, msg) -> Any:
+        return json.loads(msg.data or b"null")
+
+    async def request(self, subject: str, data: dict, timeout: float = 2.0) -> Any:
+        raise TimeoutError(f"No responders on {subject} in the NATS sink")
+
+    async def publish(self, subject: str, data: dict):
+        payload = self.encode(data)
+        self.published += 1
+        self.bytes += len(payload)
+
+        stream = subject.split(".", 1)[0]
+        self.by_stream[stream] = self.by_stream.get(stream, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"published": self.published, "bytes": self.bytes, "by_stream": dict(self.by_stream)}
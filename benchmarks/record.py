@@ -0,0 +1,121 @@
+"""
+Record mode: run accounts' adapters against the real exchanges and save every ccxt
+response to fixture files for the replay micro-benchmarks (`benchmarks.micro`).
+
+    python -m benchmarks.record demo-binance-account-123 demo-bybit-account-123
+
+Fixtures hold account data as the exchange returned it, so record from test accounts.
+"""
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import re
+import time
+from typing import Any, Dict, List, Optional
+import ccxt.pro as ccxt
+from app.ccxt.adapters import get_adapter
+from app.ccxt.connectors import set_connector_factory
+from app.credentials import credentials_cache
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+# Connector calls that are not account data
+NOT_RECORDED = {"load_markets", "close", "set_sandbox_mode", "enable_demo_trading"}
+
+
+def fixture_name(connector: str, method: str, params: Optional[Dict[str, Any]]) -> str:
+    """<connector>.<method>[.<param>-<value>...].json"""
+    tag = "".join(f".{key}-{value}" for key, value in sorted((params or {}).items()))
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", f"{connector}.{method}{tag}") + ".json"
+
+
+def save_fixture(directory: str, exchange: str, connector: str, method: str, params: Optional[Dict[str, Any]], response: Any):
+    os.makedirs(directory, exist_ok=True)
+    fixture = {
+        "exchange": exchange,
+        "connector": connector,
+        "method": method,
+        "params": params or {},
+        "recorded_at": int(time.time() * 1000),
+        "response": response,
+    }
+    with open(os.path.join(directory, fixture_name(connector, method, params)), "w") as f:
+        json.dump(fixture, f, indent=1, default=str)
+
+
+class RecordingConnector:
+    """Proxy of a ccxt connector that saves the result of every awaited call."""
+
+    def __init__(self, connector, name: str, exchange: str, directory: str):
+        object.__setattr__(self, "_connector", connector)
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_exchange", exchange)
+        object.__setattr__(self, "_directory", directory)
+
+    def __getattr__(self, attr: str):
+        value = getattr(self._connector, attr)
+        if attr in NOT_RECORDED or attr.startswith("_") or not callable(value):
+            return value
+
+        def recorded(*args, **kwargs):
+            result = value(*args, **kwargs)
+            if not inspect.isawaitable(result):
+                return result
+            return self._record(attr, kwargs.get("params"), result)
+
+        return recorded
+
+    def __setattr__(self, attr: str, value: Any):
+        setattr(self._connector, attr, value)
+
+    async def _record(self, method: str, params: Optional[Dict[str, Any]], result):
+        response = await result
+        save_fixture(self._directory, self._exchange, self._name, method, params, response)
+        return response
+
+
+def install_recorder(exchange: str, directory: str):
+    def factory(name: str):
+        real = getattr(ccxt, name, None)
+        if real is None:
+            return None
+        return lambda params: RecordingConnector(real(params), name, exchange, directory)
+
+    set_connector_factory(factory)
+
+
+async def record_account(account_id: str, fixtures_dir: str) -> List[str]:
+    creds_info = await credentials_cache.get(account_id)
+    if not creds_info:
+        raise SystemExit(f"No credentials for {account_id}")
+
+    exchange = creds_info["exchange"]
+    directory = os.path.join(fixtures_dir, exchange)
+    install_recorder(exchange, directory)
+    try:
+        adapter = await get_adapter(exchange, creds_info.get("credentials"))
+        async with adapter:
+            await adapter.fetch_balance()
+            await adapter.fetch_positions()
+            await adapter.fetch_options_positions()
+            await adapter.fetch_earn_balance()
+            await adapter.fetch_funding_fees()
+    finally:
+        set_connector_factory(None)
+
+    return sorted(os.listdir(directory))
+
+
+async def main(args: argparse.Namespace):
+    for account_id in args.accounts:
+        files = await record_account(account_id, args.fixtures)
+        print(f"{account_id}: {len(files)} fixtures in {os.path.join(args.fixtures, '<exchange>')}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("accounts", nargs="+", help="account ids resolved through the credentials backend")
+    parser.add_argument("--fixtures", default=FIXTURES_DIR)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,303 @@
+"""
+Simulated exchanges for load tests. `SimulatedExchange` stands in for a ccxt.pro connector
+and serves generated account data for the REST and websocket calls the adapters in
+`app/ccxt/` make, with configurable latency, error rate and rate limits. Install it with
+`install(SimConfig(...))`, which routes every connector name through the simulation.
+"""
+import asyncio
+import random
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+from ccxt.base.errors import DDoSProtection, NetworkError
+from app.ccxt.connectors import set_connector_factory
+
+# Currencies held by every simulated account
+CURRENCIES = ("BTC", "ETH", "USDT", "USDC", "SOL")
+
+# Connector name -> (symbols of its derivatives positions, rate-limit header, header kind)
+CONNECTORS: Dict[str, Tuple[Tuple[str, ...], Optional[str], str]] = {
+    "binance": ((), "x-mbx-used-weight-1m", "used"),
+    "binanceusdm": (("BTC/USDT:USDT", "ETH/USDT:USDT"), "x-mbx-used-weight-1m", "used"),
+    "binancecoinm": (("BTC/USD:BTC", "ETH/USD:ETH"), "x-mbx-used-weight-1m", "used"),
+    "bybit": (("BTC/USDT:USDT", "ETH/USDT:USDT", "BTC/USD:BTC"), "x-bapi-limit-status", "remaining"),
+    "deribit": (("BTC/USD:BTC", "ETH/USD:ETH"), None, "remaining"),
+    "gateio": (("BTC/USDT:USDT", "ETH/USDT:USDT"), "x-gate-ratelimit-requests-remain", "remaining"),
+}
+
+OPTION_SYMBOLS = ("BTC/USD:BTC-261225-100000-C", "ETH/USD:ETH-261225-4000-P")
+
+
+class SimConfig:
+    """
+    Behavior of the simulated exchanges. Every REST call takes `latency` seconds (uniformly
+    jittered by `jitter`) and fails with a network error with probability `error_rate`.
+    With `rate_limit` set to (requests, seconds), calls beyond it within the window fail
+    with a 429 and a Retry-After header, and responses carry the exchange's usage header.
+    Watch calls return a new state every `ws_interval` seconds. `change_rate` is the chance
+    that an account's balances moved since the previous call.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        jitter: float = 0.5,
+        error_rate: float = 0.0,
+        rate_limit: Optional[Tuple[int, float]] = None,
+        ws_interval: float = 1.0,
+        change_rate: float = 0.2,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.ws_interval = ws_interval
+        self.change_rate = change_rate
+        self.seed = seed
+
+
+class _Window:
+    """Fixed-window request counter of one connector, shared by all its instances."""
+
+    __slots__ = ("started", "used")
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.used = 0
+
+
+class SimStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.watch_updates = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "watch_updates": self.watch_updates,
+        }
+
+
+class SimulatedExchange:
+    """One simulated connector instance, i.e. one account on one ccxt connector."""
+
+    config = SimConfig()
+    stats = SimStats()
+    _windows: Dict[str, _Window] = {}
+
+    def __init__(self, name: str, params: Optional[Dict[str, Any]] = None):
+        params = params or {}
+        self.id = name
+        self.apiKey = params.get("apiKey") or ""
+        self.options: Dict[str, Any] = {}
+        self.verbose = False
+        self.newUpdates = True
+        self.last_response_headers: Dict[str, str] = {}
+        self.markets = None
+        self.positions: List[Dict[str, Any]] = []
+
+        self._symbols, self._header, self._header_kind = CONNECTORS.get(name, ((), None, "remaining"))
+        self._random = random.Random(zlib.crc32(f"{self.config.seed}:{name}:{self.apiKey}".encode()))
+        self._scale = 1 + self._random.random() * 10
+        self._calls = 0
+
+    def set_sandbox_mode(self, enabled: bool):
+        pass
+
+    def enable_demo_trading(self, enabled: bool):
+        pass
+
+    async def close(self):
+        pass
+
+    async def load_markets(self, reload: bool = False) -> Dict[str, Any]:
+        await asyncio.sleep(self.config.latency)
+        symbols = list(self._symbols) + list(OPTION_SYMBOLS)
+        self.markets = {symbol: {"symbol": symbol, "id": symbol.replace("/", "").replace(":", "_")} for symbol in symbols}
+        self.markets_by_id = {market["id"]: [market] for market in self.markets.values()}
+        self.symbols = symbols
+        self.ids = list(self.markets_by_id)
+        self.currencies = {code: {"code": code, "id": code} for code in CURRENCIES}
+        self.codes = list(CURRENCIES)
+        return self.markets
+
+    async def _call(self, weight: int = 1):
+        """Latency, rate limit and error injection shared by every REST call."""
+        config = self.config
+        self.stats.calls += 1
+        await asyncio.sleep(config.latency * (1 + config.jitter * (2 * random.random() - 1)))
+
+        if config.rate_limit:
+            limit, interval = config.rate_limit
+            window = self._windows.setdefault(self.id, _Window())
+            now = time.monotonic()
+            if now - window.started >= interval:
+                window.started, window.used = now, 0
+
+            window.used += weight
+            retry_after = interval - (now - window.started)
+            if window.used > limit:
+                self.stats.rate_limited += 1
+                self.last_response_headers = {"Retry-After": f"{retry_after:.3f}"}
+                raise DDoSProtection(f"{self.id} 429 Too Many Requests (simulated)")
+
+            if self._header:
+                value = window.used if self._header_kind == "used" else limit - window.used
+                self.last_response_headers = {self._header: str(value)}
+
+        if config.error_rate and random.random() < config.error_rate:
+            self.stats.errors += 1
+            raise NetworkError(f"{self.id} request failed (simulated)")
+
+    def _advance(self):
+        """Move the account's amounts on a `change_rate` share of calls."""
+        self._calls += 1
+        if self._calls > 1 and self._random.random() < self.config.change_rate:
+            self._scale *= 1 + (self._random.random() - 0.5) * 0.01
+
+    def _amount(self, index: int) -> float:
+        return round(self._scale * (index + 1) * 1.37, 8)
+
+    def _balance(self) -> Dict[str, Any]:
+        balance: Dict[str, Any] = {"info": {}, "free": {}, "used": {}, "total": {}}
+        for index, code in enumerate(CURRENCIES):
+            total = self._amount(index)
+            used = round(total * 0.1, 8)
+            entry = {"free": round(total - used, 8), "used": used, "total": total}
+            balance[code] = entry
+            for field in ("free", "used", "total"):
+                balance[field][code] = entry[field]
+        return balance
+
+    def _position_list(self, symbols) -> List[Dict[str, Any]]:
+        positions = []
+        for index, symbol in enumerate(symbols):
+            contracts = self._amount(index)
+            positions.append({
+                "symbol": symbol,
+                "side": "long" if index % 2 == 0 else "short",
+                "contracts": contracts,
+                "contractSize": 1.0,
+                "notional": contracts * 100,
+                "entryPrice": 100.0,
+                "markPrice": 100.0 * self._scale / 5,
+                "unrealizedPnl": contracts * (self._scale - 5),
+                "leverage": 5,
+                "marginMode": "cross",
+                "info": {},
+            })
+        return positions
+
+    # REST
+
+    async def fetch_balance(self, params=None) -> Dict[str, Any]:
+        await self._call()
+        self._advance()
+        return self._balance()
+
+    async def fetch_positions(self, symbols=None, params=None) -> List[Dict[str, Any]]:
+        await self._call()
+        self._advance()
+        params = params or {}
+        if params.get("kind") == "option" or params.get("type") == "option":
+            return self._position_list(OPTION_SYMBOLS)
+        if self.id == "deribit" and not params.get("kind"):
+            # Deribit returns every kind unless filtered
+            return self._position_list(self._symbols + OPTION_SYMBOLS)
+        return self._position_list(self._symbols)
+
+    async def fetch_option_positions(self, symbols=None, params=None) -> List[Dict[str, Any]]:
+        await self._call()
+        return self._position_list(OPTION_SYMBOLS)
+
+    async def fetch_funding_history(self, symbol=None, since=None, limit=None, params=None) -> List[Dict[str, Any]]:
+        await self._call()
+        # One funding event per symbol and simulated hour from `since` to `until`; Bybit and
+        # Gate.io list the newest first
+        hour = int(time.time() // 3600)
+        until = (params or {}).get("until")
+        events = [
+            {"id": f"{symbol}:{h}", "symbol": symbol, "code": "USDT", "amount": self._amount(i) / 100, "timestamp": h * 3600_000}
+            for h in range(hour - 3, hour + 1)
+            for i, symbol in enumerate(self._symbols)
+            if (since is None or h * 3600_000 >= since) and (until is None or h * 3600_000 <= until)
+        ]
+        if self.id in ("bybit", "gateio"):
+            events.reverse()
+        return events[:limit] if limit else events
+
+    async def sapi_get_simple_earn_flexible_position(self, params=None) -> Dict[str, Any]:
+        await self._call(150)
+        rows = [{"asset": code, "productId": f"{code}001", "totalAmount": str(self._amount(i)), "latestAnnualPercentageRate": "0.05"}
+                for i, code in enumerate(CURRENCIES[:2])]
+        return {"rows": rows, "total": len(rows)}
+
+    async def sapi_get_simple_earn_locked_position(self, params=None) -> Dict[str, Any]:
+        await self._call(150)
+        return {"rows": [], "total": 0}
+
+    async def private_get_v5_earn_position(self, params=None) -> Dict[str, Any]:
+        await self._call()
+        category = (params or {}).get("category")
+        items = [{"coin": "USDT", "category": category, "productId": "1", "amount": str(self._amount(2))}]
+        return {"retCode": 0, "result": {"list": items}}
+
+    async def private_earn_get_uni_lends(self, params=None) -> List[Dict[str, Any]]:
+        await self._call()
+        return [{"currency": "USDT", "current_amount": str(self._amount(2)), "min_rate": "0.0001"}]
+
+    async def private_get_get_settlement_history_by_currency(self, params=None) -> Dict[str, Any]:
+        await self._call()
+        # Newest first; the continuation token is the offset of the next page
+        params = params or {}
+        hour = int(time.time() // 3600)
+        settlements = [
+            {"instrument_name": f"{params.get('currency', 'BTC')}-PERPETUAL", "timestamp": h * 3600_000, "type": "settlement", "funding": -0.0001, "session_profit_loss": 0.0}
+            for h in range(hour, hour - 24, -1)
+        ]
+        offset = int(params.get("continuation") or 0)
+        count = int(params.get("count") or 20)
+        page = settlements[offset:offset + count]
+        continuation = str(offset + count) if offset + count < len(settlements) else "none"
+        return {"result": {"settlements": page, "continuation": continuation}}
+
+    # Websocket
+
+    async def _tick(self):
+        await asyncio.sleep(self.config.ws_interval * (0.5 + random.random()))
+        self.stats.watch_updates += 1
+        self._advance()
+
+    async def watch_balance(self, params=None) -> Dict[str, Any]:
+        await self._tick()
+        return self._balance()
+
+    async def watch_positions(self, symbols=None, since=None, limit=None, params=None) -> List[Dict[str, Any]]:
+        await self._tick()
+        self.positions = self._position_list(self._symbols)
+        return self.positions
+
+
+def connector(name: str) -> type:
+    """Connector class bound to `name`, built the way ccxt connectors are: `cls(params)`."""
+    return type(f"Simulated_{name}", (SimulatedExchange,), {"__init__": lambda self, params=None: SimulatedExchange.__init__(self, name, params)})
+
+
+def install(config: SimConfig) -> SimStats:
+    """Run every adapter against simulated exchanges configured by `config`."""
+    SimulatedExchange.config = config
+    SimulatedExchange.stats = SimStats()
+    SimulatedExchange._windows = {}
+
+    classes: Dict[str, type] = {}
+    set_connector_factory(lambda name: classes.setdefault(name, connector(name)))
+    return SimulatedExchange.stats
+
+
+def uninstall():
+    set_connector_factory(None)